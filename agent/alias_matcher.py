@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+别名匹配自动机（Aho-Corasick）
+- 把 catalog 中的规范名/别名一次性编译成自动机，问题文本只需单遍扫描
+- 匹配代价与别名数量无关，只与文本长度 + 命中数相关
+- 文本与模式统一做 _norm（去空白、小写），命中位置可映射回原文
+
+用法：
+    m = AliasMatcher()
+    m.add("营业收入", "营业收入"); m.add("营收", "营业收入")
+    m.build()
+    m.find_longest("2024Q1 营收是多少")  # -> [Match(start, end, text, payloads)]
+"""
+from __future__ import annotations
+import re
+from collections import deque
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+_WS_RE = re.compile(r"\s+")
+
+
+def norm_with_map(text: str) -> Tuple[str, List[int]]:
+    """去空白 + 小写；同时返回 规范化下标 -> 原文下标 的映射"""
+    out, idx = [], []
+    for i, ch in enumerate(text or ""):
+        if ch.isspace():
+            continue
+        low = ch.lower()          # 个别字符小写后长度会变，逐字符记录映射
+        out.append(low)
+        idx.extend([i] * len(low))
+    return "".join(out), idx
+
+
+def norm(text: str) -> str:
+    return _WS_RE.sub("", text or "").lower()
+
+
+class Match(NamedTuple):
+    start: int              # 原文起始下标（含）
+    end: int                # 原文结束下标（不含）
+    key: str                # 命中的规范化模式
+    payloads: Tuple[Any, ...]
+
+
+class AliasMatcher:
+    def __init__(self) -> None:
+        self._patterns: Dict[str, List[Any]] = {}
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Optional[str]] = [None]   # 以该节点结尾的模式
+        self._dict_link: List[int] = [0]          # 最近的、带输出的后缀节点
+        self._max_len = 0
+        self._built = False
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    def add(self, pattern: str, payload: Any) -> None:
+        key = norm(pattern)
+        if not key:
+            return
+        lst = self._patterns.setdefault(key, [])
+        self._max_len = max(self._max_len, len(key))
+        if payload not in lst:
+            lst.append(payload)
+        self._built = False
+
+    def add_many(self, patterns: Iterable[str], payload: Any) -> None:
+        for p in patterns:
+            self.add(p, payload)
+
+    def build(self) -> "AliasMatcher":
+        goto: List[Dict[str, int]] = [{}]
+        out: List[Optional[str]] = [None]
+        for key in self._patterns:
+            node = 0
+            for ch in key:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    out.append(None)
+                node = nxt
+            out[node] = key
+
+        fail = [0] * len(goto)
+        dict_link = [0] * len(goto)
+        q = deque(goto[0].values())
+        while q:
+            u = q.popleft()
+            for ch, v in goto[u].items():
+                f = fail[u]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fv = goto[f].get(ch, 0) if u else 0
+                fail[v] = fv if fv != v else 0
+                dict_link[v] = fail[v] if out[fail[v]] is not None else dict_link[fail[v]]
+                q.append(v)
+
+        self._goto, self._fail, self._out, self._dict_link = goto, fail, out, dict_link
+        self._built = True
+        return self
+
+    def _iter_hits(self, text: str):
+        """产出 (规范化起点, 规范化终点, key)；包含重叠命中"""
+        if not self._built:
+            self.build()
+        goto, fail, out, dlink = self._goto, self._fail, self._out, self._dict_link
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            k = node if out[node] is not None else dlink[node]
+            while k:
+                key = out[k]
+                yield (i + 1 - len(key), i + 1, key)
+                k = dlink[k]
+
+    def find_all(self, text: str) -> List[Match]:
+        """所有命中（可重叠），位置已映射回原文"""
+        nt, idx = norm_with_map(text)
+        res = []
+        for s, e, key in self._iter_hits(nt):
+            res.append(Match(idx[s], idx[e - 1] + 1, key, tuple(self._patterns[key])))
+        return res
+
+    def find_longest(self, text: str) -> List[Match]:
+        """最左最长、互不重叠的命中"""
+        hits = sorted(self.find_all(text), key=lambda m: (m.start, -(m.end - m.start)))
+        chosen: List[Match] = []
+        cursor = -1
+        for m in hits:
+            if m.start >= cursor:
+                chosen.append(m)
+                cursor = m.end
+        return chosen
+
+    def contained_in(self, text: str) -> List[Tuple[str, Tuple[Any, ...]]]:
+        """反向包含：返回规范化后包含整个 text 的模式（用于 “收入” → “营业收入” 这类短输入兜底）"""
+        t = norm(text)
+        if not t or len(t) > self._max_len:
+            return []
+        return [(k, tuple(v)) for k, v in self._patterns.items() if t in k]
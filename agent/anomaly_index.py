@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+异动预计算索引（financial_metrics → 本地 SQLite 表）
+- 后台线程按 ANOMALY_REFRESH_S 周期全量扫描 financial_metrics，对每个 (公司, 指标, 期间) 预先计算：
+    zscore     : 本期值相对同公司同指标前 ANOMALY_WINDOW 期历史的标准分（历史不足 ANOMALY_MIN_HISTORY 期为空）
+    target_gap : 本期值 - baseline_target（及相对比例）
+    yoy / qoq  : 同比、环比变动（优先取表中 last_year_value / last_period_value，缺失时用序列中的 t-4 / t-1 期）
+    score      : max(|z|, |同比%|、|环比%|、|目标差距%| 按 ANOMALY_PCT_UNIT 折算)；越大越异常
+- 结果写入新的 SQLite 文件后 os.replace 原子替换；读路径每次只读连接 + 主键前缀 (company, year, quarter) 查询，
+  异动下钻 / 列表接口即一次索引查找取 TOP-K
+- 索引未就绪时 ready() 为 False，调用方按原逻辑现算：只有本实例完成过一次 rebuild() 才算就绪，
+  临时目录里其它进程 / 上次运行遗留的索引文件不会被直接使用
+- 本期值为空的 (公司, 指标, 期间) 不入索引
+
+环境变量：
+  ANOMALY_INDEX_PATH=<tmp>/anomaly_index.sqlite3
+  ANOMALY_REFRESH_S=900        # 重建周期（秒）；<=0 只在启动时构建一次
+  ANOMALY_WINDOW=12            # z-score 使用的历史期数
+  ANOMALY_MIN_HISTORY=4
+  ANOMALY_PCT_UNIT=0.1         # 10% 的相对变动 ≈ 1 个标准差
+"""
+from __future__ import annotations
+import os, math, time, sqlite3, tempfile, threading, logging
+from statistics import mean, pstdev
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("anomaly_index")
+
+ANOMALY_INDEX_PATH = os.getenv("ANOMALY_INDEX_PATH") or os.path.join(tempfile.gettempdir(), "anomaly_index.sqlite3")
+ANOMALY_REFRESH_S = float(os.getenv("ANOMALY_REFRESH_S") or 900)
+ANOMALY_WINDOW = int(os.getenv("ANOMALY_WINDOW") or 12)
+ANOMALY_MIN_HISTORY = int(os.getenv("ANOMALY_MIN_HISTORY") or 4)
+ANOMALY_PCT_UNIT = float(os.getenv("ANOMALY_PCT_UNIT") or 0.1)
+
+COLUMNS = ("company", "metric", "year", "quarter", "value", "baseline_target", "yoy_change", "qoq_change",
+           "yoy_pct", "qoq_pct", "zscore", "target_gap", "target_gap_pct", "score")
+# 排序键 → 列表达式（均按绝对值降序）
+SORT_KEYS = {
+    "score": "score", "z": "abs(zscore)", "yoy": "abs(yoy_change)", "qoq": "abs(qoq_change)",
+    "yoy_pct": "abs(yoy_pct)", "qoq_pct": "abs(qoq_pct)", "target": "abs(target_gap_pct)",
+}
+
+_SCHEMA = """
+CREATE TABLE anomalies (
+    company TEXT NOT NULL, metric TEXT NOT NULL, year INTEGER NOT NULL, quarter INTEGER NOT NULL,
+    value REAL, baseline_target REAL, yoy_change REAL, qoq_change REAL, yoy_pct REAL, qoq_pct REAL,
+    zscore REAL, target_gap REAL, target_gap_pct REAL, score REAL,
+    PRIMARY KEY (company, year, quarter, metric)
+) WITHOUT ROWID;
+CREATE INDEX anomalies_period_score ON anomalies (year, quarter, score DESC);
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def _num(v: Any) -> Optional[float]:
+    try:
+        x = float(v)
+    except (TypeError, ValueError):
+        return None
+    return x if math.isfinite(x) else None
+
+
+def _pct(delta: Optional[float], base: Optional[float]) -> Optional[float]:
+    if delta is None or not base:
+        return None
+    return delta / abs(base)
+
+
+def score_series(points: List[Tuple[int, int, Dict[str, Any]]]) -> List[Tuple]:
+    """
+    单个 (公司, 指标) 的时间序列 → 索引行（不含公司/指标）。
+    points: [(year, quarter, row)]，按期间升序
+    """
+    by_idx = {y * 4 + q - 1: _num(r.get("metric_value")) for y, q, r in points}
+    hist: List[float] = []
+    out: List[Tuple] = []
+    for y, q, r in points:
+        idx = y * 4 + q - 1
+        cur = _num(r.get("metric_value"))
+        if cur is None:          # 无本期值：没有可评分的内容，不入索引
+            continue
+        yoy_b = _num(r.get("last_year_value"))
+        qoq_b = _num(r.get("last_period_value"))
+        if yoy_b is None:
+            yoy_b = by_idx.get(idx - 4)
+        if qoq_b is None:
+            qoq_b = by_idx.get(idx - 1)
+        base = _num(r.get("baseline_target"))
+        yoy = cur - yoy_b if yoy_b is not None else None
+        qoq = cur - qoq_b if qoq_b is not None else None
+        gap = cur - base if base is not None else None
+        z = None
+        window = hist[-ANOMALY_WINDOW:]
+        if len(window) >= ANOMALY_MIN_HISTORY:
+            sd = pstdev(window)
+            if sd > 0:
+                z = (cur - mean(window)) / sd
+        yoy_pct, qoq_pct, gap_pct = _pct(yoy, yoy_b), _pct(qoq, qoq_b), _pct(gap, base)
+        parts = [abs(z) if z is not None else 0.0]
+        parts += [abs(p) / ANOMALY_PCT_UNIT for p in (yoy_pct, qoq_pct, gap_pct) if p is not None]
+        out.append((y, q, cur, base, yoy, qoq, yoy_pct, qoq_pct, z, gap, gap_pct, max(parts)))
+        hist.append(cur)
+    return out
+
+
+class AnomalyIndex:
+    """
+    load : () -> Iterable[financial_metrics 行]（需含 company_name/metric_name/year/quarter/metric_value，
+           以及可选的 baseline_target/last_year_value/last_period_value）
+    """
+
+    def __init__(self, load: Callable[[], Iterable[Dict[str, Any]]], path: str = ANOMALY_INDEX_PATH,
+                 refresh_s: float = ANOMALY_REFRESH_S) -> None:
+        self._load = load
+        self.path = path
+        self.refresh_s = refresh_s
+        self._lock = threading.Lock()          # 串行化重建
+        self._thread: Optional[threading.Thread] = None
+        self._stats: Dict[str, Any] = {"builds": 0, "errors": 0, "rows": 0, "build_ms": None,
+                                       "built_at": None, "last_error": None}
+
+    # ---- 构建 ----
+    def rebuild(self) -> int:
+        with self._lock:
+            t0 = time.perf_counter()
+            tmp: Optional[str] = None
+            try:
+                series: Dict[Tuple[str, str], List[Tuple[int, int, Dict[str, Any]]]] = {}
+                for r in self._load() or []:
+                    try:
+                        key = (str(r["company_name"]), str(r["metric_name"]))
+                        y, q = int(r["year"]), int(r["quarter"])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    series.setdefault(key, []).append((y, q, r))
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", suffix=".tmp")
+                os.close(fd)
+                n = 0
+                conn = sqlite3.connect(tmp)
+                try:
+                    conn.executescript(_SCHEMA)
+                    placeholders = ",".join("?" * len(COLUMNS))
+                    for (company, metric), points in series.items():
+                        # 同一期间重复行：保留第一条
+                        seen, uniq = set(), []
+                        for p in sorted(points, key=lambda p: (p[0], p[1])):
+                            if (p[0], p[1]) not in seen:
+                                seen.add((p[0], p[1])); uniq.append(p)
+                        rows = [(company, metric) + t for t in score_series(uniq)]
+                        conn.executemany(f"INSERT INTO anomalies VALUES ({placeholders})", rows)
+                        n += len(rows)
+                    conn.execute("INSERT INTO meta VALUES ('built_at', ?)", (str(time.time()),))
+                    conn.commit()
+                finally:
+                    conn.close()
+                os.replace(tmp, self.path)
+            except Exception as e:
+                self._stats["errors"] += 1
+                self._stats["last_error"] = str(e)
+                logger.warning("[anomaly] rebuild failed (keep old index): %s", e)
+                if tmp:
+                    try:
+                        os.remove(tmp)
+                    except OSError:
+                        pass
+                raise
+            self._stats.update(builds=self._stats["builds"] + 1, rows=n, built_at=time.time(),
+                               build_ms=round((time.perf_counter() - t0) * 1000, 1), last_error=None)
+            logger.info("[anomaly] indexed %d rows in %.1f ms", n, self._stats["build_ms"])
+            return n
+
+    def start(self) -> None:
+        """后台线程：立即构建一次，之后按周期重建"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="anomaly-index", daemon=True)
+        self._thread.start()
+
+    def _loop(self) -> None:
+        while True:
+            try:
+                self.rebuild()
+            except Exception:
+                pass
+            if self.refresh_s <= 0:
+                return
+            time.sleep(self.refresh_s)
+
+    # ---- 查询 ----
+    def ready(self) -> bool:
+        """本实例已完成至少一次重建，且索引文件仍在"""
+        return self._stats["built_at"] is not None and os.path.exists(self.path)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def top(self, *, company: Optional[str] = None, year: Optional[int] = None, quarter: Optional[int] = None,
+            metric: Optional[str] = None, sort: str = "score", top_k: int = 20,
+            min_score: Optional[float] = None) -> List[Dict[str, Any]]:
+        """按条件取 TOP-K（sort 见 SORT_KEYS）；索引不可用时返回 []"""
+        if not self.ready():
+            return []
+        where, args = [], []
+        for col, val in (("company", company), ("year", year), ("quarter", quarter), ("metric", metric)):
+            if val is not None:
+                where.append(f"{col} = ?"); args.append(val)
+        if min_score is not None:
+            where.append("score >= ?"); args.append(float(min_score))
+        order = SORT_KEYS.get(sort, "score")
+        sql = (f"SELECT * FROM anomalies {'WHERE ' + ' AND '.join(where) if where else ''} "
+               f"ORDER BY {order} IS NULL, {order} DESC LIMIT ?")
+        args.append(max(1, int(top_k)))
+        try:
+            conn = self._connect()
+            try:
+                return [dict(r) for r in conn.execute(sql, args)]
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning("[anomaly] query failed: %s", e)
+            return []
+
+    def has_period(self, company: str, year: int, quarter: int) -> bool:
+        return bool(self.top(company=company, year=year, quarter=quarter, top_k=1))
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "path": self.path, "ready": self.ready(), "refresh_s": self.refresh_s}
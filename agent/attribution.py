@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+变量贡献归因（deepanalysis 指标/业务下钻共用）
+- 所有替换情景拼成一批，用 formula_engine 的 eval_batch 一次向量化求值（不再逐情景调用 safe_eval）
+- 方法：
+    shapley : 精确 Shapley 值：2^n 个“部分变量取新值”情景，交互效应按 Shapley 权重均摊，Σ贡献 = 总变动；
+              变量数 > SHAPLEY_MAX_VARS 时改为固定种子的随机排列抽样（每个排列 n+1 个情景，同样一批求值）
+    lmdi    : 加法型 LMDI-I：贡献_i = L(y1, y0) · ln(f(仅 i 取新值) / y0)，L 为对数平均；
+              连乘/连除型公式严格无残差，其它形式残差记入“交互/残差”；任一值 ≤0 时退回 shapley
+    oat     : 逐个变量替换（旧口径），残差记入“交互/残差”
+- 结果按 (公式, 方法, 基期值, 新期值) LRU 缓存：同一公式同一期间对的重复下钻直接命中
+
+环境变量：
+  ATTRIB_METHOD=shapley        # 默认方法
+  SHAPLEY_MAX_VARS=12          # 精确 Shapley 的变量上限（2^12=4096 个情景）
+  SHAPLEY_SAMPLES=256          # 超限时抽样的排列数
+  ATTRIB_CACHE_MAX=1024
+"""
+from __future__ import annotations
+import os, math, random, threading
+from collections import OrderedDict
+from math import isfinite
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+try:
+    from agent.formula_engine import compile_formula
+except ImportError:
+    from formula_engine import compile_formula
+
+ATTRIB_METHOD = (os.getenv("ATTRIB_METHOD") or "shapley").lower()
+SHAPLEY_MAX_VARS = int(os.getenv("SHAPLEY_MAX_VARS") or 12)
+SHAPLEY_SAMPLES = int(os.getenv("SHAPLEY_SAMPLES") or 256)
+ATTRIB_CACHE_MAX = int(os.getenv("ATTRIB_CACHE_MAX") or 1024)
+
+METHODS = ("shapley", "lmdi", "oat")
+METHOD_LABELS = {
+    "shapley": "Shapley 分解（交互效应按权重均摊）",
+    "shapley_sampled": "Shapley 分解（排列抽样近似）",
+    "lmdi": "LMDI 对数平均分解",
+    "oat": "逐个变量替换法",
+}
+
+_CACHE: "OrderedDict[tuple, List[Dict[str, Any]]]" = OrderedDict()
+_LOCK = threading.Lock()
+_STATS = {"hits": 0, "misses": 0, "scenarios": 0}
+
+
+def _columns(names: Sequence[str], base: Mapping[str, float], new: Mapping[str, float],
+             masks: Sequence[Sequence[bool]], keys: Sequence[str]) -> Dict[str, List[float]]:
+    """masks[s][j] = 情景 s 中 keys[j] 是否取新值；不在 keys 中的变量两期相同，取基期"""
+    pos = {k: j for j, k in enumerate(keys)}
+    cols: Dict[str, List[float]] = {}
+    for name in names:
+        b = base.get(name, new.get(name))
+        n = new.get(name, b)
+        j = pos.get(name)
+        cols[name] = [n if (j is not None and m[j]) else b for m in masks] if j is not None else [b] * len(masks)
+    return cols
+
+
+def _run(expr: str, base: Mapping[str, float], new: Mapping[str, float],
+         keys: Sequence[str], masks: Sequence[Sequence[bool]]) -> List[float]:
+    f = compile_formula(expr)
+    names = set(f.names) | set(base) | set(new)
+    ys = f.eval_batch(_columns(sorted(names), base, new, masks, keys))
+    with _LOCK:
+        _STATS["scenarios"] += len(masks)
+    return [float(y) for y in ys]
+
+
+def _log_mean(a: float, b: float) -> float:
+    if a == b:
+        return a
+    return (a - b) / (math.log(a) - math.log(b))
+
+
+def _shapley(expr, base, new, keys) -> Tuple[str, List[float], float, float]:
+    n = len(keys)
+    if n <= SHAPLEY_MAX_VARS:
+        masks = [[bool((m >> j) & 1) for j in range(n)] for m in range(1 << n)]
+        ys = _run(expr, base, new, keys, masks)
+        fact = [math.factorial(i) for i in range(n + 1)]
+        phi = [0.0] * n
+        for m in range(1 << n):
+            size = bin(m).count("1")
+            for j in range(n):
+                if not (m >> j) & 1:
+                    w = fact[size] * fact[n - size - 1] / fact[n]
+                    phi[j] += w * (ys[m | (1 << j)] - ys[m])
+        return "shapley", phi, ys[0], ys[-1]
+    # 抽样：每个排列从“全基期”逐个切换到新值，n+1 个情景；全部排列拼成一批
+    rng = random.Random(0)
+    perms = []
+    for _ in range(SHAPLEY_SAMPLES):
+        p = list(range(n)); rng.shuffle(p); perms.append(p)
+    masks: List[List[bool]] = []
+    for p in perms:
+        cur = [False] * n
+        masks.append(list(cur))
+        for j in p:
+            cur[j] = True
+            masks.append(list(cur))
+    ys = _run(expr, base, new, keys, masks)
+    phi = [0.0] * n
+    for s, p in enumerate(perms):
+        off = s * (n + 1)
+        for step, j in enumerate(p):
+            phi[j] += ys[off + step + 1] - ys[off + step]
+    phi = [v / len(perms) for v in phi]
+    return "shapley_sampled", phi, ys[0], ys[n]
+
+
+def _one_at_a_time(expr, base, new, keys) -> Tuple[List[float], float, float]:
+    """返回 [单独替换 i 的 y_i]、y0、y1（共 n+2 个情景，一批求值）"""
+    n = len(keys)
+    masks = [[False] * n, [True] * n] + [[j == i for j in range(n)] for i in range(n)]
+    ys = _run(expr, base, new, keys, masks)
+    return ys[2:], ys[0], ys[1]
+
+
+def _decompose(expr: str, base: Dict[str, float], new: Dict[str, float], method: str) -> List[Dict[str, Any]]:
+    keys = list(new.keys())
+    if method == "lmdi":
+        mids, y0, y1 = _one_at_a_time(expr, base, new, keys)
+        ok = y0 > 0 and y1 > 0 and all(isfinite(m) and m > 0 for m in mids) \
+            and all((base.get(k) or 0) > 0 and (new.get(k) or 0) > 0 for k in keys)
+        if ok:
+            L = _log_mean(y1, y0)
+            phi = [L * math.log(m / y0) for m in mids]
+        else:
+            method = "shapley"
+    if method == "oat":
+        mids, y0, y1 = _one_at_a_time(expr, base, new, keys)
+        phi = [m - y0 if isfinite(m) else None for m in mids]
+    if method not in ("lmdi", "oat"):
+        method, phi, y0, y1 = _shapley(expr, base, new, keys)
+    if not (isfinite(y0) and isfinite(y1)):
+        f = compile_formula(expr)
+        y0, y1 = f(base), f(new)      # 非有限值：按标量语义重算以得到具体异常
+    total = y1 - y0
+    rows: List[Dict[str, Any]] = []
+    for k, v in zip(keys, phi):
+        rows.append({"variable": k, "base": base.get(k), "new": new.get(k),
+                     "impact_estimate": v if (v is not None and isfinite(v)) else None})
+    explained = sum(r["impact_estimate"] for r in rows if r["impact_estimate"] is not None)
+    residual = total - explained
+    if abs(residual) > 1e-9 * max(1.0, abs(total)):
+        rows.append({"variable": "_interaction", "impact_estimate": residual})
+    rows.append({"variable": "_total", "impact_estimate": total, "method": method})
+    return rows
+
+
+def attribute(expr: str, base_vals: Mapping[str, float], new_vals: Mapping[str, float],
+              method: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    变量贡献分解：返回 [{variable, base, new, impact_estimate}, ..., {_interaction}?, {_total, method}]；
+    失败时返回 [{"variable": "_error", "message": ...}]（与旧 contribution_by_variables 一致）
+    """
+    method = (method or ATTRIB_METHOD).lower()
+    if method not in METHODS:
+        method = "shapley"
+    try:
+        base = {k: float(v) for k, v in base_vals.items() if v is not None}
+        new = {k: float(v) for k, v in new_vals.items() if v is not None}
+    except (TypeError, ValueError) as e:
+        return [{"variable": "_error", "message": f"计算失败: {e}"}]
+    key = (expr, method, tuple(sorted(base.items())), tuple(new.items()))
+    with _LOCK:
+        hit = _CACHE.get(key)
+        if hit is not None:
+            _CACHE.move_to_end(key)
+            _STATS["hits"] += 1
+            return [dict(r) for r in hit]
+        _STATS["misses"] += 1
+    try:
+        rows = _decompose(expr, base, new, method)
+    except Exception as e:
+        return [{"variable": "_error", "message": f"计算失败: {e}"}]
+    with _LOCK:
+        _CACHE[key] = rows
+        while len(_CACHE) > ATTRIB_CACHE_MAX:
+            _CACHE.popitem(last=False)
+    return [dict(r) for r in rows]
+
+
+def attribution_stats() -> Dict[str, Any]:
+    with _LOCK:
+        return {**_STATS, "entries": len(_CACHE), "method": ATTRIB_METHOD}
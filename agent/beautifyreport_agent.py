@@ -20,7 +20,7 @@ Beautify Report Agent
   EXPORT_ENABLED=1  # 1=上传 DOCX/PDF/HTML；0=只返回 HTML 字符串
 """
 
-import os, io, uuid, json, datetime as dt, re, logging, traceback
+import os, io, uuid, json, datetime as dt, re, logging, traceback, threading
 from typing import Optional, List, Dict, Any
 
 from fastapi import FastAPI, HTTPException, Header, Depends
@@ -28,20 +28,31 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from supabase import create_client, Client
 import html as html_lib
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.cidfonts import UnicodeCIDFont
-from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.platypus import Table, TableStyle
 from reportlab.lib import colors
 
-# 可选 LLM
-from openai import OpenAI
+# 可选 LLM（经共享网关调用：连接池 + 限流）
+try:
+    from agent.llm_gateway import get_gateway
+except ImportError:
+    from llm_gateway import get_gateway
+try:
+    from agent.chart_render import chart_stats, render_chart_png
+except ImportError:
+    from chart_render import chart_stats, render_chart_png
+try:
+    from agent.font_registry import FONTS
+except ImportError:
+    from font_registry import FONTS
+try:
+    from agent.export_jobs import EXPORT_JOBS, job_urls
+except ImportError:
+    from export_jobs import EXPORT_JOBS, job_urls
 
 
 
 import matplotlib
 matplotlib.use("Agg")           # 无界面环境
-from matplotlib import pyplot as plt
 # 导出依赖（与 report_agent 保持一致的简单导出策略）
 from docx.shared import Pt, Inches
 from docx import Document
@@ -261,87 +272,15 @@ def _parse_font_list(families: Optional[str]) -> list[str]:
     bad = {"sans-serif", "serif", "monospace", "system-ui", "ui-monospace"}
     return [x for x in raw if x and x not in bad]
 
-def _register_ttf_if_exists(path: str, name: str) -> bool:
-    try:
-        if os.path.exists(path):
-            pdfmetrics.registerFont(TTFont(name, path))
-            return True
-    except Exception:
-        pass
-    return False
-
-def _register_family_by_name(name: str) -> tuple[Optional[str], Optional[str]]:
-    """
-    按常见系统路径尝试注册某个家族的 Regular/Bold。
-    返回 (regular_font_name, bold_font_name)；失败返回 (None, None)
-    """
-    cand: list[tuple[str,str|None,str,str|None]] = []
-    # Windows
-    cand += [
-        ("C:/Windows/Fonts/msyh.ttc", "C:/Windows/Fonts/msyhbd.ttc", "MSYH", "MSYHBD"),           # Microsoft YaHei
-        ("C:/Windows/Fonts/simhei.ttf", None, "SimHei", None),                                     # SimHei（无粗体文件，用同名代替）
-        ("C:/Windows/Fonts/simsun.ttc", None, "SimSun", None),
-        ("C:/Windows/Fonts/Deng.ttf", "C:/Windows/Fonts/Dengb.ttf", "DengXian", "DengXian-Bold"),
-    ]
-    # Noto / Linux
-    cand += [
-        ("/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-         "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc", "NotoSansCJK", "NotoSansCJK-Bold"),
-        ("/usr/share/fonts/truetype/noto/NotoSansSC-Regular.ttf",
-         "/usr/share/fonts/truetype/noto/NotoSansSC-Bold.ttf", "NotoSansSC", "NotoSansSC-Bold"),
-        ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-         "DejaVuSans", "DejaVuSans-Bold"),
-    ]
-
-    # 按名称猜测对应文件
-    name_low = name.lower()
-    matched = []
-    if "yahei" in name_low or "microsoft yahei" in name_low:
-        matched = [cand[0]]
-    elif "simhei" in name_low:
-        matched = [cand[1]]
-    elif "simsun" in name_low:
-        matched = [cand[2]]
-    elif "deng" in name_low:
-        matched = [cand[3]]
-    elif "noto" in name_low:
-        matched = [cand[4], cand[5]]
-    elif "dejavu" in name_low:
-        matched = [cand[6]]
-    else:
-        matched = cand  # 不认识就全试一遍
-
-    for reg_path, bold_path, rname, bname in matched:
-        ok_r = _register_ttf_if_exists(reg_path, rname)
-        ok_b = _register_ttf_if_exists(bold_path, bname) if bold_path else False
-        if ok_r:
-            return (rname, bname if ok_b else rname)
-    return (None, None)
-
 def _resolve_pdf_fonts(style) -> tuple[str, str]:
     """
     根据用户设置解析并注册 PDF 用正文字体/粗体；失败时回退到 CID 字体（STSong）。
+    字体目录只扫描一次、每个 TTF 只注册一次（见 font_registry），重复导出不再做字体探测。
     """
-    # 1) 用户优先：body/heading 任意一个命中即可
+    # 用户优先：body/heading 任意一个命中即可；其后回退系统常见中文字体
     prefs = _parse_font_list(getattr(style, "font_family", None)) \
           + _parse_font_list(getattr(style, "heading_font_family", None))
-    for fam in prefs:
-        r, b = _register_family_by_name(fam)
-        if r:
-            return (r, b or r)
-
-    # 2) 回退：尝试系统常见中文字体
-    for fam in ["Microsoft YaHei", "Noto Sans SC", "SimHei", "DejaVu Sans"]:
-        r, b = _register_family_by_name(fam)
-        if r:
-            return (r, b or r)
-
-    # 3) 终极回退：CID 字体（中文可见，但无真粗体）
-    try:
-        pdfmetrics.registerFont(UnicodeCIDFont("STSong-Light"))
-        return ("STSong-Light", "STSong-Light")
-    except Exception:
-        return ("Helvetica", "Helvetica-Bold")
+    return FONTS.resolve(prefs)
 
 def _apply_docx_font(doc, family: Optional[str]):
     """让 Word 使用用户字体（若未提供则不强制）"""
@@ -392,7 +331,7 @@ if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
     raise RuntimeError("缺少 SUPABASE_URL 或 SUPABASE_SERVICE_ROLE_KEY")
 
 sb: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-llm = OpenAI(api_key=OPENAI_API_KEY or None, base_url=OPENAI_BASE_URL)
+_LLM = get_gateway(OPENAI_BASE_URL, OPENAI_API_KEY)
 def ensure_bucket(bucket: str):
     try:
         # 列出已有桶；不存在则创建为 public
@@ -421,6 +360,7 @@ class BeautifyPayload(BaseModel):
     language: Optional[str] = "zh"
     instructions: Optional[str] = ""                  # 自然语言美化要求（可选）
     style: Optional[BeautifyStyle] = None
+    wait_exports: bool = False                        # true=等待导出完成并在响应中带回各格式链接（旧行为）
 
 # ========= 安全 =========
 def auth_check(authorization: Optional[str] = Header(None)):
@@ -1244,91 +1184,9 @@ def _make_download_url(path: str, public_url: str, filename: str) -> str:
 def _render_chart_png(opt: dict, style: BeautifyStyle) -> bytes:
     """
     用 matplotlib 近似渲染 ECharts（支持 line/bar），并优先使用用户字体。
+    按 (option, 调色板, 字体, 尺寸) 记忆化：同一张图在 DOCX/PDF/PPTX 三种导出中只渲染一次。
     """
-    try:
-        # ★ 用户字体优先
-        fams = _parse_font_list(getattr(style, "font_family", None))
-        if fams:
-            rcParams['font.sans-serif'] = fams + rcParams.get('font.sans-serif', [])
-        rcParams['axes.unicode_minus'] = False
-
-        # --- robust x/y extraction (替换原有的 x_data/series 抽取逻辑) ---
-        x_data = []
-        xa = opt.get("xAxis")
-        if isinstance(xa, dict):
-            x_data = (xa.get("data") or [])[:]
-        elif isinstance(xa, list) and xa:
-            xa0 = xa[0]
-            if isinstance(xa0, dict):
-                x_data = (xa0.get("data") or [])[:]
-
-        # dataset.source 兜底
-        if not x_data and isinstance(opt.get("dataset"), dict):
-            src = opt["dataset"].get("source") or []
-            if src and isinstance(src[0], list):
-                # 若首行为表头，取第一列为类目
-                head = src[0]
-                body = src[1:] if any(isinstance(v, str) for v in head) else src
-                x_data = [row[0] for row in body if isinstance(row, list)]
-            elif src and isinstance(src[0], dict):
-                dim0 = list(src[0].keys())[0]
-                x_data = [row.get(dim0) for row in src]
-
-        series = opt.get("series")
-        series = series if isinstance(series, list) else ([series] if isinstance(series, dict) else [])
-
-        def _values(arr):
-            out = []
-            for v in (arr or []):
-                if isinstance(v, dict):
-                    out.append(v.get("value"))
-                else:
-                    out.append(v)
-            return out
-
-        # 若仍无 x_data，用第一个序列长度生成 1..N
-        if not x_data and series and isinstance(series[0], dict):
-            n = len(_values(series[0].get("data")))
-            x_data = list(range(1, n + 1))
-
-        # 无有效序列直接返回空
-        if not series:
-            return b""
-
-
-        palette = opt.get("color") or (style.palette or
-                   ["#2563eb","#10b981","#f59e0b","#ef4444","#8b5cf6","#06b6d4"])
-        fig = plt.figure(figsize=(7.2, 4.2), dpi=160)
-        ax = fig.gca()
-        x_idx = list(range(len(x_data)))
-
-        only_bar = all((s.get("type") == "bar") for s in series if isinstance(s, dict))
-        for i, s in enumerate(series):
-            y = s.get("data") or []
-            name = s.get("name") or f"系列{i+1}"
-            typ = s.get("type") or ("bar" if only_bar else "line")
-            color = palette[i % len(palette)]
-            if typ == "bar":
-                n = len(series); width = 0.8 / max(1, n)
-                ax.bar([t + (i - (n-1)/2)*width for t in x_idx], y, width=width, label=name, color=color)
-            else:
-                ax.plot(x_idx, y, marker='o', label=name, color=color)
-
-        ax.set_xticks(x_idx)
-        ax.set_xticklabels([str(x) for x in x_data], rotation=30, ha='right')
-        ax.grid(True, linestyle='--', alpha=0.25)
-        if isinstance(opt.get("title"), dict):
-            t = opt["title"].get("text") or ""
-            if t: ax.set_title(t)
-        ax.legend()
-
-        buf = io.BytesIO()
-        plt.tight_layout()
-        fig.savefig(buf, format="png")
-        plt.close(fig)
-        return buf.getvalue()
-    except Exception:
-        return b""
+    return render_chart_png(opt, style.palette, _parse_font_list(getattr(style, "font_family", None)))
 
 def _iter_md_segments(md_text: str):
     """迭代Markdown文本段落，分离文本和ECharts块"""
@@ -1561,94 +1419,6 @@ def export_pptx_from_md(md_text: str, style: BeautifyStyle) -> bytes:
     prs.save(buf)
     return buf.getvalue()
 
-def _render_chart_png(opt: dict, style: BeautifyStyle) -> bytes:
-    """
-    用 matplotlib 近似渲染 ECharts（支持 line/bar），并优先使用用户字体。
-    """
-    try:
-        # 用户字体优先
-        fams = _parse_font_list(getattr(style, "font_family", None))
-        if fams:
-            rcParams['font.sans-serif'] = fams + rcParams.get('font.sans-serif', [])
-        rcParams['axes.unicode_minus'] = False
-
-        # 提取数据
-        x_data = []
-        xa = opt.get("xAxis")
-        if isinstance(xa, dict):
-            x_data = (xa.get("data") or [])[:]
-        elif isinstance(xa, list) and xa:
-            xa0 = xa[0]
-            if isinstance(xa0, dict):
-                x_data = (xa0.get("data") or [])[:]
-
-        # dataset.source 兜底
-        if not x_data and isinstance(opt.get("dataset"), dict):
-            src = opt["dataset"].get("source") or []
-            if src and isinstance(src[0], list):
-                head = src[0]
-                body = src[1:] if any(isinstance(v, str) for v in head) else src
-                x_data = [row[0] for row in body if isinstance(row, list)]
-            elif src and isinstance(src[0], dict):
-                dim0 = list(src[0].keys())[0]
-                x_data = [row.get(dim0) for row in src]
-
-        series = opt.get("series")
-        series = series if isinstance(series, list) else ([series] if isinstance(series, dict) else [])
-
-        def _values(arr):
-            out = []
-            for v in (arr or []):
-                if isinstance(v, dict):
-                    out.append(v.get("value"))
-                else:
-                    out.append(v)
-            return out
-
-        # 若仍无 x_data，用第一个序列长度生成 1..N
-        if not x_data and series and isinstance(series[0], dict):
-            n = len(_values(series[0].get("data")))
-            x_data = list(range(1, n + 1))
-
-        # 无有效序列直接返回空
-        if not series:
-            return b""
-
-        palette = opt.get("color") or (style.palette or
-                   ["#2563eb","#10b981","#f59e0b","#ef4444","#8b5cf6","#06b6d4"])
-        fig = plt.figure(figsize=(7.2, 4.2), dpi=160)
-        ax = fig.gca()
-        x_idx = list(range(len(x_data)))
-
-        only_bar = all((s.get("type") == "bar") for s in series if isinstance(s, dict))
-        for i, s in enumerate(series):
-            y = s.get("data") or []
-            name = s.get("name") or f"系列{i+1}"
-            typ = s.get("type") or ("bar" if only_bar else "line")
-            color = palette[i % len(palette)]
-            if typ == "bar":
-                n = len(series); width = 0.8 / max(1, n)
-                ax.bar([t + (i - (n-1)/2)*width for t in x_idx], y, width=width, label=name, color=color)
-            else:
-                ax.plot(x_idx, y, marker='o', label=name, color=color)
-
-        ax.set_xticks(x_idx)
-        ax.set_xticklabels([str(x) for x in x_data], rotation=30, ha='right')
-        ax.grid(True, linestyle='--', alpha=0.25)
-        if isinstance(opt.get("title"), dict):
-            t = opt["title"].get("text") or ""
-            if t: ax.set_title(t)
-        ax.legend()
-
-        buf = io.BytesIO()
-        plt.tight_layout()
-        fig.savefig(buf, format="png")
-        plt.close(fig)
-        return buf.getvalue()
-    except Exception:
-        return b""
-
-
 def export_pdf_from_md(md_text: str, style: BeautifyStyle) -> bytes:
     """增强版PDF导出，支持更好的Markdown解析和样式"""
     base_font, bold_font = _resolve_pdf_fonts(style)
@@ -1975,9 +1745,44 @@ SYSTEM_PROMPT = (
 
 
 
+# ===== 后台导出任务 =====
+EXPORT_WAIT_S = float(os.getenv("EXPORT_WAIT_S", "180"))   # wait_exports=true 时最多等待的秒数
+
+_EXPORT_CONTENT_TYPES = {
+    "html": "text/html",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "pdf":  "application/pdf",
+    "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+}
+
+def _export_uploader(job_id: str, timestamp: str):
+    def _up(fmt: str, data: bytes) -> Dict[str, Any]:
+        path = f"beautified/{job_id}/report_{timestamp}.{fmt}"
+        pub = _upload(path, data, _EXPORT_CONTENT_TYPES.get(fmt, "application/octet-stream"))
+        return {"url": _make_download_url(path, pub, f"report_{timestamp}.{fmt}")}
+    return _up
+
+@app.get("/beautify/jobs/{job_id}")
+def beautify_job(job_id: str, _=Depends(auth_check)):
+    job = EXPORT_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(404, "job not found")
+    return {**job, **job_urls(job)}
+
+@app.on_event("startup")
+def _warm_fonts():
+    # 后台预扫描字体目录，首个 PDF 导出无需等待
+    threading.Thread(target=FONTS.describe, name="font-scan", daemon=True).start()
+
+@app.get("/beautify/fonts")
+def beautify_fonts(rescan: bool = False, _=Depends(auth_check)):
+    if rescan:
+        FONTS.rescan()
+    return FONTS.describe()
+
 @app.get("/health")
 def health():
-    return {"ok": True, "time": dt.datetime.utcnow().isoformat()}
+    return {"ok": True, "time": dt.datetime.utcnow().isoformat(), "charts": chart_stats()}
 
 @app.post("/beautify/run")
 def beautify_run(payload: BeautifyPayload, _=Depends(auth_check)):
@@ -2006,12 +1811,8 @@ def beautify_run(payload: BeautifyPayload, _=Depends(auth_check)):
 
 请返回优化后的Markdown内容：
 """
-                resp = llm.chat.completions.create(
-                    model=OPENAI_MODEL,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=0.3
-                )
-                improved_md = resp.choices[0].message.content or md
+                improved_md = _LLM.chat([{"role": "user", "content": prompt}],
+                                        model=OPENAI_MODEL, temperature=0.3, responses=False) or md
                 logger.info("LLM结构优化完成")
             except Exception as e:
                 logger.warning(f"LLM优化失败，使用原始内容: {e}")
@@ -2029,14 +1830,14 @@ def beautify_run(payload: BeautifyPayload, _=Depends(auth_check)):
         body_html = apply_layout_cards_and_toc(body_html, style.theme or "light")
         html_doc = build_html_document(body_html, style)
 
-        # 5) 导出/上传
-                # 5) 导出/上传（逐项 try，互不影响）
+        # 5) 导出/上传：请求内只构建 HTML；HTML/DOCX/PDF/PPTX 交给后台任务并行渲染与上传
         job_id = str(uuid.uuid4())
         timestamp = dt.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
 
         result = {
             "job_id": job_id,
             "timestamp": timestamp,
+            "html": html_doc,
             "style_applied": {
                 "template": style.template_style,
                 "theme": style.theme,
@@ -2048,53 +1849,21 @@ def beautify_run(payload: BeautifyPayload, _=Depends(auth_check)):
         }
 
         if not EXPORT_ENABLED:
-            result["html"] = html_doc
             logger.info("仅返回HTML内容（导出已禁用）")
             return result
 
-        # === HTML ===
-        try:
-            html_path = f"beautified/{job_id}/report_{timestamp}.html"
-            html_bytes = html_doc.encode("utf-8")
-            html_pub = _upload(html_path, html_bytes, "text/html")
-            result["html_url"] = _make_download_url(html_path, html_pub, f"report_{timestamp}.html")
-        except Exception as e:
-            logger.error("HTML 导出失败: %s", e)
-            # 兜底直接放内联 HTML，前端至少能“下载 HTML”
-            result["html"] = html_doc
-            result["html_error"] = str(e)
-
-        # === DOCX ===
-        try:
-            docx_bytes = export_docx_from_md(improved_md, style)
-            docx_path = f"beautified/{job_id}/report_{timestamp}.docx"
-            docx_pub = _upload(docx_path, docx_bytes,
-                               "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-            result["docx_url"] = _make_download_url(docx_path, docx_pub, f"report_{timestamp}.docx")
-        except Exception as e:
-            logger.error("DOCX 导出失败: %s", e)
-            result["docx_error"] = str(e)
-
-        # === PDF ===
-        try:
-            pdf_bytes = export_pdf_from_md(improved_md, style)
-            pdf_path = f"beautified/{job_id}/report_{timestamp}.pdf"
-            pdf_pub = _upload(pdf_path, pdf_bytes, "application/pdf")
-            result["pdf_url"] = _make_download_url(pdf_path, pdf_pub, f"report_{timestamp}.pdf")
-        except Exception as e:
-            logger.error("PDF 导出失败: %s", e)
-            result["pdf_error"] = str(e)
-
-        # === PPTX（新增）===
-        try:
-            pptx_bytes = export_pptx_from_md(improved_md, style)
-            pptx_path = f"beautified/{job_id}/report_{timestamp}.pptx"
-            pptx_pub = _upload(pptx_path, pptx_bytes, "application/vnd.openxmlformats-officedocument.presentationml.presentation")
-            result["pptx_url"] = _make_download_url(pptx_path, pptx_pub, f"report_{timestamp}.pptx")
-        except Exception as e:
-            logger.error("PPTX 导出失败: %s", e)
-            result["pptx_error"] = str(e)
-            
+        renders = {
+            "html": html_doc.encode("utf-8"),
+            "docx": (export_docx_from_md, (improved_md, style)),
+            "pdf":  (export_pdf_from_md,  (improved_md, style)),
+            "pptx": (export_pptx_from_md, (improved_md, style)),
+        }
+        EXPORT_JOBS.submit(renders, _export_uploader(job_id, timestamp), job_id=job_id, meta={"kind": "beautify"})
+        result["export_job_id"] = job_id
+        result["export_status_url"] = f"/beautify/jobs/{job_id}"
+
+        if payload.wait_exports:
+            result.update(job_urls(EXPORT_JOBS.wait(job_id, timeout=EXPORT_WAIT_S)))
         return result
 
 
@@ -3,9 +3,15 @@ import os, io, json, csv, base64, re
 from typing import List, Union, Optional
 from fastapi import FastAPI, UploadFile, File, Form, Header, HTTPException
 from pydantic import BaseModel
+import asyncio
 import httpx
 import pandas as pd
 
+try:
+    from agent.extract_cache import EXTRACT_CACHE
+except ImportError:
+    from extract_cache import EXTRACT_CACHE
+
 APP_TOKEN = os.getenv("BUDGET_AGENT_TOKEN", "")
 OPENAI_BASE = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 OPENAI_KEY  = os.getenv("OPENAI_API_KEY", "")
@@ -152,6 +158,7 @@ async def diag(authorization: Optional[str] = Header(None)):
         "has_service_role": bool(SUPABASE_SERVICE_ROLE),
         "supabase_url": SUPABASE_URL,
         "alias_count": None,
+        "extract_cache": EXTRACT_CACHE.stats(),
     }
     if SUPABASE_URL and SUPABASE_SERVICE_ROLE:
         try:
@@ -303,6 +310,16 @@ async def read_db(data: ReadDBIn, authorization: Optional[str] = Header(None)):
     return {"filledSheet": filled, "mapped": mapped}
 
 
+def _parse_table(content: bytes, is_csv: bool) -> dict:
+    df = pd.read_csv(io.BytesIO(content)) if is_csv else pd.read_excel(io.BytesIO(content))
+    return json.loads(df.to_json(orient="split", date_format="iso", force_ascii=False))
+
+def _read_table_cached(content: bytes, filename: str) -> pd.DataFrame:
+    is_csv = filename.lower().endswith(".csv")
+    split = EXTRACT_CACHE.get_or_extract(content, "budget.table.v1." + ("csv" if is_csv else "excel"),
+                                         lambda b: _parse_table(b, is_csv))
+    return pd.DataFrame(split.get("data") or [], columns=split.get("columns") or None)
+
 @app.post("/ai/read-attachment")
 async def read_attachment(
     authorization: Optional[str] = Header(None),
@@ -318,14 +335,11 @@ async def read_attachment(
     quarters = json.loads(quarters)
     sheet = json.loads(sheet)
 
-    # 读附件到 DataFrame
+    # 读附件到 DataFrame（按文件内容 sha256 缓存解析结果，同一文件重复上传不再解析）
     content = await file.read()
     df = None
     try:
-        if file.filename.lower().endswith(".csv"):
-            df = pd.read_csv(io.BytesIO(content))
-        else:
-            df = pd.read_excel(io.BytesIO(content))
+        df = await asyncio.to_thread(_read_table_cached, content, file.filename or "")
     except Exception as e:
         raise HTTPException(400, f"bad file: {e}")
 
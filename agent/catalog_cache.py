@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+共享 catalog 缓存（company_catalog / metric_alias_catalog / metric_formulas ...）
+- 每个 agent 每张表只持有一份内存快照（Snapshot），读路径只做一次引用读取，不访问 DB
+- 后台守护线程按 CATALOG_REFRESH_S 周期刷新：先做轻量版本探测（ETag / max(updated_at)+行数），
+  版本未变则跳过全量加载；变化时在后台加载并 build 完整快照后整体替换引用（原子切换）
+- 只有进程内第一次 get() 会同步加载；加载失败时保留旧快照，并对重试做节流
+
+环境变量：
+  CATALOG_REFRESH_S=60        # 后台刷新周期（秒）
+  CATALOG_RETRY_S=5           # 首次加载失败后的最小重试间隔（秒）
+"""
+from __future__ import annotations
+import os, time, threading, logging
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+try:
+    from agent.sb_pool import sb_request
+except ImportError:
+    from sb_pool import sb_request
+
+logger = logging.getLogger("catalog_cache")
+
+CATALOG_REFRESH_S = float(os.getenv("CATALOG_REFRESH_S") or 60)
+CATALOG_RETRY_S = float(os.getenv("CATALOG_RETRY_S") or 5)
+
+
+class Snapshot(NamedTuple):
+    version: Optional[str]     # 探测到的版本号；None=不支持探测（每周期全量重载）
+    data: Any                  # build(rows) 的结果，约定只读
+    loaded_at: float
+
+
+class CatalogCache:
+    """
+    name   : 表名/缓存名（用于日志与统计）
+    load   : () -> rows        全量加载（失败应抛异常，以便保留旧快照）
+    build  : (rows) -> data    由行构建索引结构；默认原样返回 rows
+    probe  : () -> version     轻量版本探测；返回 None 或抛异常则视为“未知”，按周期全量加载
+    """
+
+    def __init__(self, name: str, load: Callable[[], List[Dict[str, Any]]], *,
+                 build: Optional[Callable[[List[Dict[str, Any]]], Any]] = None,
+                 probe: Optional[Callable[[], Optional[str]]] = None,
+                 refresh_s: Optional[float] = None) -> None:
+        self.name = name
+        self._load = load
+        self._build = build or (lambda rows: rows)
+        self._probe = probe
+        self.refresh_s = refresh_s if refresh_s is not None else CATALOG_REFRESH_S
+        self._snap: Optional[Snapshot] = None
+        self._lock = threading.Lock()          # 串行化加载；读路径不加锁
+        self._last_fail = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"loads": 0, "skipped": 0, "errors": 0}
+        _REGISTRY[name] = self
+
+    # ---- read path ----
+    def get(self) -> Snapshot:
+        snap = self._snap
+        if snap is None:
+            snap = self._initial_load()
+        self._ensure_thread()
+        return snap
+
+    @property
+    def data(self) -> Any:
+        return self.get().data
+
+    def _initial_load(self) -> Snapshot:
+        with self._lock:
+            if self._snap is not None:
+                return self._snap
+            if time.time() - self._last_fail < CATALOG_RETRY_S:
+                return Snapshot(None, self._build([]), 0.0)
+            try:
+                self._reload_locked(version=self._safe_probe())
+            except Exception as e:
+                self._last_fail = time.time()
+                self._stats["errors"] += 1
+                logger.warning("[catalog] %s initial load failed: %s", self.name, e)
+                return Snapshot(None, self._build([]), 0.0)
+            return self._snap
+
+    # ---- refresh ----
+    def _safe_probe(self) -> Optional[str]:
+        if not self._probe:
+            return None
+        try:
+            return self._probe()
+        except Exception as e:
+            logger.debug("[catalog] %s probe failed: %s", self.name, e)
+            return None
+
+    def _reload_locked(self, version: Optional[str]) -> None:
+        rows = self._load() or []
+        data = self._build(rows)
+        self._snap = Snapshot(version, data, time.time())   # 单次引用赋值 = 原子切换
+        self._stats["loads"] += 1
+
+    def refresh(self, force: bool = False) -> bool:
+        """探测版本并在需要时重载；返回是否发生了替换"""
+        version = self._safe_probe()
+        cur = self._snap
+        if not force and cur is not None and version is not None and version == cur.version:
+            self._stats["skipped"] += 1
+            return False
+        with self._lock:
+            try:
+                self._reload_locked(version)
+                return True
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.warning("[catalog] %s refresh failed (keep old snapshot): %s", self.name, e)
+                return False
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None or self.refresh_s <= 0:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            t = threading.Thread(target=self._loop, name=f"catalog-{self.name}", daemon=True)
+            self._thread = t
+            t.start()
+
+    def _loop(self) -> None:
+        while True:
+            time.sleep(self.refresh_s)
+            self.refresh()
+
+    def stats(self) -> Dict[str, Any]:
+        snap = self._snap
+        return {
+            **self._stats,
+            "version": snap.version if snap else None,
+            "age_s": round(time.time() - snap.loaded_at, 1) if snap and snap.loaded_at else None,
+            "refresh_s": self.refresh_s,
+        }
+
+
+_REGISTRY: Dict[str, CatalogCache] = {}
+
+
+def catalog_stats() -> Dict[str, Any]:
+    return {name: c.stats() for name, c in _REGISTRY.items()}
+
+
+# ---------------- 版本探测 ---------------- #
+def postgrest_probe(base_url: str, key: str, table: str,
+                    column: str = "updated_at") -> Callable[[], Optional[str]]:
+    """
+    生成一个 PostgREST 版本探测函数：
+    - 若网关返回 ETag，则带 If-None-Match 发起条件请求，304 直接沿用上次版本
+    - 否则用 “行数 + max(column)” 作为版本号（只取 1 行，且 count=exact 走 Content-Range）
+    表中没有该列时请求会 400 → 抛异常 → 视为不可探测（按周期全量加载）
+    """
+    state: Dict[str, Optional[str]] = {"etag": None, "version": None}
+
+    def _probe() -> Optional[str]:
+        headers = {"Prefer": "count=exact"}
+        if state["etag"]:
+            headers["If-None-Match"] = state["etag"]
+        r = sb_request("GET", base_url, key, table, params={
+            "select": column, "order": f"{column}.desc.nullslast", "limit": "1",
+        }, headers=headers, timeout=10)
+        if r.status_code == 304 and state["version"]:
+            return state["version"]
+        if r.status_code >= 400:
+            raise RuntimeError(f"probe {table}: {r.status_code} {r.text[:200]}")
+        rows = r.json() or []
+        total = (r.headers.get("Content-Range") or "").split("/")[-1]
+        latest = rows[0].get(column) if rows else None
+        etag = r.headers.get("ETag")
+        version = f"etag:{etag}" if etag else f"{total}|{latest}"
+        state["etag"], state["version"] = etag, version
+        return version
+
+    return _probe
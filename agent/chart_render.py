@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+ECharts option → PNG（matplotlib 近似渲染 line/bar），带记忆化
+- key = sha256(option JSON + 调色板 + 字体 + 尺寸/dpi + 渲染版本)：同一报告的 DOCX/PDF/PPTX 共用一次渲染
+- 两级缓存：进程内 LRU（字节数上限）+ 本地磁盘 PNG；磁盘写入用临时文件 + os.replace
+- 跨进程只渲染一次：导出任务在进程池中并行跑三种格式，同一张图用 <key>.lock 文件锁串行，后到者直接读磁盘
+- 不读写全局 rcParams（rc_context 也会临时改写全局值，多线程下会互相串字体）：字体通过 FontProperties
+  逐个传给标题/刻度/图例，负号用 ASCII 格式化；图用 Figure + FigureCanvasAgg（不经 pyplot 全局状态），
+  因此可以在多线程/多进程中并行渲染
+
+环境变量：
+  CHART_CACHE_DIR=<tmp>/report_chart_cache
+  CHART_CACHE_MEM_MB=64
+"""
+from __future__ import annotations
+import os, io, json, hashlib, tempfile, threading, logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.font_manager import FontProperties
+from matplotlib.ticker import FuncFormatter
+
+try:
+    import fcntl
+except ImportError:     # 非 POSIX：不做跨进程锁（最多重复渲染一次）
+    fcntl = None
+
+logger = logging.getLogger("chart_render")
+
+CHART_CACHE_DIR = os.getenv("CHART_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "report_chart_cache")
+CHART_CACHE_MEM_BYTES = int(float(os.getenv("CHART_CACHE_MEM_MB") or 64) * 1024 * 1024)
+RENDER_VERSION = "v2"   # 修改绘图逻辑时递增，使旧缓存失效
+
+DEFAULT_PALETTE = ["#2563eb", "#10b981", "#f59e0b", "#ef4444", "#8b5cf6", "#06b6d4"]
+BASE_FONTS = ["Microsoft YaHei", "SimHei", "Noto Sans CJK SC", "Arial Unicode MS", "DejaVu Sans", "sans-serif"]
+
+_MEM: "OrderedDict[str, bytes]" = OrderedDict()
+_MEM_BYTES = 0
+_MEM_LOCK = threading.Lock()
+_KEY_LOCKS: Dict[str, threading.Lock] = {}
+_STATS = {"mem_hits": 0, "disk_hits": 0, "renders": 0, "errors": 0}
+
+
+def chart_key(opt: Dict[str, Any], palette: Optional[Sequence[str]], fonts: Sequence[str],
+              size: Tuple[float, float], dpi: int) -> str:
+    raw = json.dumps([RENDER_VERSION, opt, list(palette or []), list(fonts), list(size), dpi],
+                     ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# ---------------- 绘图（纯函数，无全局状态） ---------------- #
+def _values(arr) -> List[Any]:
+    return [v.get("value") if isinstance(v, dict) else v for v in (arr or [])]
+
+
+def _draw(opt: Dict[str, Any], palette: Optional[Sequence[str]], fonts: Sequence[str],
+          size: Tuple[float, float], dpi: int) -> bytes:
+    # x 轴类目：xAxis.data → dataset.source 第一列 → 1..N
+    x_data: List[Any] = []
+    xa = opt.get("xAxis")
+    if isinstance(xa, dict):
+        x_data = (xa.get("data") or [])[:]
+    elif isinstance(xa, list) and xa and isinstance(xa[0], dict):
+        x_data = (xa[0].get("data") or [])[:]
+
+    if not x_data and isinstance(opt.get("dataset"), dict):
+        src = opt["dataset"].get("source") or []
+        if src and isinstance(src[0], list):
+            # 若首行为表头，取第一列为类目
+            head = src[0]
+            body = src[1:] if any(isinstance(v, str) for v in head) else src
+            x_data = [row[0] for row in body if isinstance(row, list)]
+        elif src and isinstance(src[0], dict):
+            dim0 = list(src[0].keys())[0]
+            x_data = [row.get(dim0) for row in src]
+
+    series = opt.get("series")
+    series = series if isinstance(series, list) else ([series] if isinstance(series, dict) else [])
+    if not x_data and series and isinstance(series[0], dict):
+        x_data = list(range(1, len(_values(series[0].get("data"))) + 1))
+    if not series:
+        return b""
+
+    palette = list(opt.get("color") or palette or DEFAULT_PALETTE)
+    fp = FontProperties(family=list(fonts) + BASE_FONTS)
+    fig = Figure(figsize=size, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.gca()
+    x_idx = list(range(len(x_data)))
+
+    only_bar = all((s.get("type") == "bar") for s in series if isinstance(s, dict))
+    for i, s in enumerate(series):
+        y = s.get("data") or []
+        name = s.get("name") or f"系列{i+1}"
+        typ = s.get("type") or ("bar" if only_bar else "line")
+        color = palette[i % len(palette)]
+        if typ == "bar":
+            n = len(series); width = 0.8 / max(1, n)
+            ax.bar([t + (i - (n-1)/2)*width for t in x_idx], y, width=width, label=name, color=color)
+        else:
+            ax.plot(x_idx, y, marker='o', label=name, color=color)
+
+    ax.set_xticks(x_idx)
+    ax.set_xticklabels([str(x) for x in x_data], rotation=30, ha='right', fontproperties=fp)
+    # ASCII 负号（等价于 axes.unicode_minus=False，CJK 字体多数缺 U+2212）
+    ax.yaxis.set_major_formatter(FuncFormatter(lambda v, _pos: f"{v:g}"))
+    for lbl in ax.get_yticklabels():
+        lbl.set_fontproperties(fp)
+    ax.grid(True, linestyle='--', alpha=0.25)
+    if isinstance(opt.get("title"), dict):
+        t = opt["title"].get("text") or ""
+        if t: ax.set_title(t, fontproperties=fp)
+    ax.legend(prop=fp)
+
+    buf = io.BytesIO()
+    fig.tight_layout()
+    fig.savefig(buf, format="png")
+    return buf.getvalue()
+
+
+# ---------------- 缓存 ---------------- #
+def _mem_get(key: str) -> Optional[bytes]:
+    with _MEM_LOCK:
+        png = _MEM.get(key)
+        if png is not None:
+            _MEM.move_to_end(key)
+            _STATS["mem_hits"] += 1
+        return png
+
+
+def _mem_put(key: str, png: bytes) -> None:
+    global _MEM_BYTES
+    with _MEM_LOCK:
+        if key in _MEM:
+            return
+        _MEM[key] = png
+        _MEM_BYTES += len(png)
+        while _MEM_BYTES > CHART_CACHE_MEM_BYTES and len(_MEM) > 1:
+            _, old = _MEM.popitem(last=False)
+            _MEM_BYTES -= len(old)
+
+
+def _disk_path(key: str) -> str:
+    return os.path.join(CHART_CACHE_DIR, key[:2], key + ".png")
+
+
+def _disk_get(key: str) -> Optional[bytes]:
+    try:
+        with open(_disk_path(key), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _disk_put(key: str, png: bytes) -> None:
+    path = _disk_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(png)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning("[chart] cache write failed: %s", e)
+
+
+class _FileLock:
+    """同一 key 跨进程互斥（fcntl.flock）；不可用时退化为空操作"""
+
+    def __init__(self, key: str) -> None:
+        self.path = _disk_path(key)[:-4] + ".lock"
+        self.fd: Optional[int] = None
+
+    def __enter__(self) -> "_FileLock":
+        if fcntl is None:
+            return self
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except OSError:
+            self.fd = None
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+
+
+def render_chart_png(opt: Dict[str, Any], palette: Optional[Sequence[str]] = None,
+                     fonts: Sequence[str] = (), size: Tuple[float, float] = (7.2, 4.2), dpi: int = 160) -> bytes:
+    """渲染（或取缓存）一张图；失败返回 b""（调用方按“图表渲染失败”兜底）"""
+    key = chart_key(opt, palette, fonts, size, dpi)
+    png = _mem_get(key)
+    if png is not None:
+        return png
+    with _MEM_LOCK:
+        gate = _KEY_LOCKS.setdefault(key, threading.Lock())
+    try:
+        with gate, _FileLock(key):
+            png = _mem_get(key)
+            if png is None:
+                png = _disk_get(key)
+                if png is not None:
+                    with _MEM_LOCK:
+                        _STATS["disk_hits"] += 1
+            if png is None:
+                try:
+                    png = _draw(opt, palette, fonts, size, dpi)
+                    with _MEM_LOCK:
+                        _STATS["renders"] += 1
+                except Exception as e:
+                    logger.warning("[chart] render failed: %s", e)
+                    with _MEM_LOCK:
+                        _STATS["errors"] += 1
+                    return b""
+                if png:
+                    _disk_put(key, png)
+            if png:
+                _mem_put(key, png)
+        return png
+    finally:
+        with _MEM_LOCK:
+            _KEY_LOCKS.pop(key, None)
+
+
+def chart_stats() -> Dict[str, Any]:
+    with _MEM_LOCK:
+        return {**_STATS, "mem_entries": len(_MEM), "mem_bytes": _MEM_BYTES, "dir": CHART_CACHE_DIR}
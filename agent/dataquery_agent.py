@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import os, json, re, math
+import os, json, re
 from typing import Any, Dict, Optional, List, Tuple
 
 import requests
@@ -20,6 +20,32 @@ import time
 p = find_dotenv(".env.backend", raise_error_if_not_found=False)
 load_dotenv(p, override=True)
 
+# 共享 PostgREST 连接池（uvicorn agent.dataquery_agent:app 与 agent/ 目录内启动均可导入）
+try:
+    from agent.sb_pool import sb_get, pool_stats
+except ImportError:
+    from sb_pool import sb_get, pool_stats
+try:
+    from agent.alias_matcher import AliasMatcher
+except ImportError:
+    from alias_matcher import AliasMatcher
+try:
+    from agent.catalog_cache import CatalogCache, postgrest_probe, catalog_stats
+except ImportError:
+    from catalog_cache import CatalogCache, postgrest_probe, catalog_stats
+try:
+    from agent.llm_cache import LLM_CACHE
+except ImportError:
+    from llm_cache import LLM_CACHE
+try:
+    from agent.formula_engine import evaluate
+except ImportError:
+    from formula_engine import evaluate
+try:
+    from agent.formula_graph import FormulaGraph, compute_order, formula_parts
+except ImportError:
+    from formula_graph import FormulaGraph, compute_order, formula_parts
+
 LLM_BASE  = (os.getenv("OPENAI_BASE_URL") or os.getenv("OPENAI_API_BASE") or os.getenv("LLM_BASE_URL") or "").rstrip("/")
 LLM_KEY   = os.getenv("OPENAI_API_KEY") or os.getenv("LLM_API_KEY") or ""
 LLM_MODEL = os.getenv("OPENAI_MODEL") or os.getenv("LLM_MODEL") or ""
@@ -83,18 +109,23 @@ async def require_token(authorization: str = Header(None)):
 def _sb(path: str, params: Dict[str,Any]) -> Any:
     if not (SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY):
         raise HTTPException(500, "Supabase credentials not configured")
-    url = f"{SUPABASE_URL.rstrip('/')}/rest/v1/{path.lstrip('/')}"
-    r = requests.get(
-        url, params=params, timeout=20,
-        headers={
-            "apikey": SUPABASE_SERVICE_ROLE_KEY,
-            "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-        },
-    )
+    # 走共享 keep-alive 连接池，避免每次查询重新握手
+    r = sb_get(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, path, params)
     if r.status_code >= 400:
         raise HTTPException(r.status_code, r.text)
     return r.json()
 
+def _sb_paged(path: str, params: Dict[str,Any], page_size: int = 1000) -> List[Dict[str,Any]]:
+    """limit/offset 分页读到空页为止（服务端 max-rows 小于 page_size 时短页不代表读完）；params 须带唯一 order"""
+    rows: List[Dict[str,Any]] = []
+    offset = 0
+    while True:
+        page = _sb(path, {**params, "limit": page_size, "offset": offset}) or []
+        if not page:
+            return rows
+        rows.extend(page)
+        offset += len(page)
+
 def _sb_safe(path: str, params: Dict[str,Any]) -> Any:
     try:
         return _sb(path, params)
@@ -219,13 +250,7 @@ def _now_sgt():
 # metric_alias_catalog: canonical_name + aliases + unit + is_derived + compute_key
 _ALIAS_CACHE: Dict[str,Dict[str,Any]] = {}
 
-def load_metric_alias_cache(force: bool=False):
-    global _ALIAS_CACHE
-    if _ALIAS_CACHE and not force:
-        return
-    rows = _sb_safe("metric_alias_catalog", {
-        "select": "canonical_name,aliases,unit,is_derived,compute_key"
-    })
+def _build_alias_cache(rows: List[Dict[str,Any]]) -> Dict[str,Dict[str,Any]]:
     cache = {}
     for r in rows:
         als = _to_alias_list(r.get("aliases"))
@@ -235,53 +260,88 @@ def load_metric_alias_cache(force: bool=False):
             "is_derived": bool(r.get("is_derived")),
             "compute_key": r.get("compute_key") or r["canonical_name"],
         }
-    _ALIAS_CACHE = cache
+    return cache
+
+# 共享快照缓存：后台按版本探测刷新，请求线程只读当前快照
+_METRIC_CATALOG = CatalogCache(
+    "metric_alias_catalog",
+    lambda: _sb("metric_alias_catalog", {"select": "canonical_name,aliases,unit,is_derived,compute_key"}),
+    build=_build_alias_cache,
+    probe=postgrest_probe(SUPABASE_URL or "", SUPABASE_SERVICE_ROLE_KEY or "", "metric_alias_catalog"),
+)
+
+def load_metric_alias_cache(force: bool=False):
+    global _ALIAS_CACHE
+    if force:
+        _METRIC_CATALOG.refresh(force=True)
+    _ALIAS_CACHE = _METRIC_CATALOG.get().data
+
+# 别名自动机：catalog 对象被替换（重新加载）时才重建
+_METRIC_AC: Optional[AliasMatcher] = None
+_METRIC_AC_SRC: Optional[Dict[str,Dict[str,Any]]] = None
+_METRIC_GROWTH: Dict[str,bool] = {}
+_METRIC_ORDER: Dict[str,int] = {}
+
+def _metric_matcher() -> AliasMatcher:
+    global _METRIC_AC, _METRIC_AC_SRC, _METRIC_GROWTH, _METRIC_ORDER
+    load_metric_alias_cache()
+    src = _ALIAS_CACHE
+    if _METRIC_AC is not None and _METRIC_AC_SRC is src:
+        return _METRIC_AC
+    m = AliasMatcher()
+    growth: Dict[str,bool] = {}
+    order: Dict[str,int] = {}
+    for i, (canonical, meta) in enumerate(src.items()):
+        names = [canonical] + meta["aliases"]
+        m.add_many(names, canonical)
+        growth[canonical] = any(_has_any(n, GROWTH_KWS) for n in names)
+        order[canonical] = i
+    _METRIC_AC, _METRIC_AC_SRC, _METRIC_GROWTH, _METRIC_ORDER = m.build(), src, growth, order
+    return _METRIC_AC
+
+def _isolated(text: str, start: int, end: int) -> bool:
+    """命中片段两侧都不是字母数字/汉字（等价于原来的 lookaround 正则）"""
+    def _wordish(ch: str) -> bool:
+        return ch.isalnum() or ch == "_" or "\u4e00" <= ch <= "\u9fff"
+    return not (start > 0 and _wordish(text[start-1])) and not (end < len(text) and _wordish(text[end]))
 
 def match_metric_canonical(text: str) -> Optional[str]:
     """
     规则：
-    1) 先按别名/规范名在问题里出现的“长度”打分（越长越好）
+    1) 先按别名/规范名在问题里出现的“长度”打分（越长越好；两侧独立成词再加分）
     2) 若候选是“增长类”(包含 增长率/同比/环比/增速)，但问题里没有这些词 → 直接重罚，优先选基准值类
     3) 若问题里出现增长类词，但候选不是增长类 → 轻微扣分
+    问题文本在别名自动机上单遍扫描；无正向命中时才做“问题被别名包含”的反向兜底。
     """
-    load_metric_alias_cache()
+    matcher = _metric_matcher()
     q = text or ""
-    qn = _norm(q)
-    if not qn:
+    if not _norm(q):
         return None
 
     q_has_growth = _has_any(q, GROWTH_KWS)
 
-    best_name, best_score = None, -1e9
-    for canonical, meta in _ALIAS_CACHE.items():
-        names = [canonical] + meta["aliases"]
-        cand_has_growth = _has_any(canonical, GROWTH_KWS) or any(_has_any(a, GROWTH_KWS) for a in names)
-
-        base = -1e6
-        for n in names:
-            ns = _norm(n)
-            if not ns:
-                continue
-            if ns in qn or qn in ns:   # 双向包含
-                base = max(base, len(ns) * 10)
-                try:
-                    if re.search(rf'(?<![\w\u4e00-\u9fff]){re.escape(n)}(?![\w\u4e00-\u9fff])', q):
-                        base = max(base, len(ns) * 12)
-                except Exception:
-                    pass
-
-        if base < 0:
-            continue
-
+    base: Dict[str,int] = {}
+    for m in matcher.find_all(q):
+        score = len(m.key) * (12 if _isolated(q, m.start, m.end) else 10)
+        for canonical in m.payloads:
+            if score > base.get(canonical, -1):
+                base[canonical] = score
+    if not base:
+        for key, payloads in matcher.contained_in(q):
+            for canonical in payloads:
+                base[canonical] = max(base.get(canonical, -1), len(key) * 10)
+
+    best_name, best_key = None, None
+    for canonical, sc in base.items():
+        cand_has_growth = _METRIC_GROWTH.get(canonical, False)
         penalty = 0
         if cand_has_growth and not q_has_growth:
             penalty -= 1000
         elif q_has_growth and not cand_has_growth:
             penalty -= 20
-
-        score = base + penalty
-        if score > best_score:
-            best_name, best_score = canonical, score
+        key = (sc + penalty, -_METRIC_ORDER.get(canonical, 0))
+        if best_key is None or key > best_key:
+            best_name, best_key = canonical, key
 
     return best_name
 
@@ -292,14 +352,7 @@ def metric_meta(canonical: str) -> Optional[Dict[str,Any]]:
 # company_catalog: company_name + aliases
 _COMPANY_CACHE: Dict[str,Dict[str,Any]] = {}
 
-def load_company_catalog_cache(force: bool=False):
-    """Load company canonical + aliases. Try company_catalog"""
-    global _COMPANY_CACHE
-    if _COMPANY_CACHE and not force:
-        return
-    rows = _sb_safe("company_catalog", {"select": "display_name,aliases"})
-    if not rows:
-        rows = _sb_safe("company_catalog", {"select": "display_name,aliases"})
+def _build_company_cache(rows: List[Dict[str,Any]]) -> Dict[str,Dict[str,Any]]:
     cache: Dict[str,Dict[str,Any]] = {}
     for r in rows:
         canonical = (r.get("display_name"))
@@ -312,27 +365,53 @@ def load_company_catalog_cache(force: bool=False):
                 als.append(v)
         seen = set(); als = [a for a in als if not (a in seen or seen.add(a))]
         cache[str(canonical)] = {"aliases": als}
-    _COMPANY_CACHE = cache
+    return cache
 
-def match_company_name(text: str) -> Optional[str]:
+_COMPANY_CATALOG = CatalogCache(
+    "company_catalog",
+    lambda: _sb("company_catalog", {"select": "display_name,aliases"}),
+    build=_build_company_cache,
+    probe=postgrest_probe(SUPABASE_URL or "", SUPABASE_SERVICE_ROLE_KEY or "", "company_catalog"),
+)
+
+def load_company_catalog_cache(force: bool=False):
+    """Load company canonical + aliases (company_catalog 快照)"""
+    global _COMPANY_CACHE
+    if force:
+        _COMPANY_CATALOG.refresh(force=True)
+    _COMPANY_CACHE = _COMPANY_CATALOG.get().data
+
+_COMPANY_AC: Optional[AliasMatcher] = None
+_COMPANY_AC_SRC: Optional[Dict[str,Dict[str,Any]]] = None
+
+def _company_matcher() -> AliasMatcher:
+    global _COMPANY_AC, _COMPANY_AC_SRC
     load_company_catalog_cache()
-    t = _norm(text)
-    if not t:
+    src = _COMPANY_CACHE
+    if _COMPANY_AC is not None and _COMPANY_AC_SRC is src:
+        return _COMPANY_AC
+    m = AliasMatcher()
+    for canonical, meta in src.items():
+        for n in [canonical] + meta.get("aliases", []):
+            m.add_many([n, *_gen_variants(n)], canonical)
+    _COMPANY_AC, _COMPANY_AC_SRC = m.build(), src
+    return _COMPANY_AC
+
+def match_company_name(text: str) -> Optional[str]:
+    """文本中出现的最长公司名/别名；无正向命中时兜底“文本被别名包含”（如简称输入）"""
+    matcher = _company_matcher()
+    if not _norm(text):
         return None
     best = None
     best_len = 0
-    for canonical, meta in _COMPANY_CACHE.items():
-        names = [canonical] + meta.get("aliases", [])
-        expanded = set()
-        for n in names:
-            expanded.update([n, *_gen_variants(n)])
-        for n in expanded:
-            ns = _norm(n)
-            if not ns:
-                continue
-            if ns in t or t in ns:
-                if len(ns) > best_len:
-                    best, best_len = canonical, len(ns)
+    for m in matcher.find_all(text):
+        if len(m.key) > best_len:
+            best, best_len = m.payloads[0], len(m.key)
+    if best:
+        return best
+    for key, payloads in matcher.contained_in(text):
+        if len(key) > best_len:
+            best, best_len = payloads[0], len(key)
     return best
 
 # ---------------- Lightweight parser (兜底) ---------------- #
@@ -352,9 +431,15 @@ def parse_question(question: str) -> Dict[str,Any]:
         m2 = {"一":"1","二":"2","三":"3","四":"4"}
         q = int(m2.get(q, q))
         out["quarter"] = q
-    m = re.search(r'([\u4e00-\u9fa5A-Za-z0-9]+?(?:集团公司|港口公司|金融公司|地产公司|公司|集团))', question)
-    if m:
-        out["company"] = m.group(1)
+    # 公司：catalog 自动机命中优先（最左最长、不重叠），否则退回后缀正则
+    hits = _company_matcher().find_longest(question)
+    if hits:
+        best = max(hits, key=lambda h: h.end - h.start)
+        out["company"] = best.payloads[0]
+    else:
+        m = re.search(r'([\u4e00-\u9fa5A-Za-z0-9]+?(?:集团公司|港口公司|金融公司|地产公司|公司|集团))', question)
+        if m:
+            out["company"] = m.group(1)
     cn = match_metric_canonical(question)
     if cn:
         out["metric"] = cn
@@ -391,11 +476,58 @@ def fetch_metric_row(company_name: str, year: int, quarter: int, metric_name: st
     rows = _sb_safe("financial_metrics", params)
     return rows[0] if rows else None
 
-# ---------------- Formula utils ---------------- #
-SAFE_FUNCS = {"abs": abs, "min": min, "max": max, "round": round, "sqrt": math.sqrt}
+# ---------------- Batch fetch (in.() 批量读) ---------------- #
+BATCH_MAX_ITEMS = int(os.getenv("DQ_BATCH_MAX_ITEMS") or 200)
+_FM_ROW_COLS = "company_name,metric_name,year,quarter,metric_value,baseline_target,last_year_value,last_period_value,source"
+
+def _pg_in(values) -> str:
+    """PostgREST in.() 过滤值：统一加双引号，兼容含逗号/括号的中文名"""
+    out = []
+    for v in values:
+        sv = str(v).replace("\\", "\\\\").replace('"', '\\"')
+        out.append(f'"{sv}"')
+    return f"in.({','.join(out)})"
+
+FM_BULK_METRIC_CHUNK = int(os.getenv("FM_BULK_METRIC_CHUNK") or 100)
+
+def fetch_metric_rows_bulk(companies, metrics, years, quarters) -> Dict[Tuple[str,int,int,str], Dict[str,Any]]:
+    """
+    按 (公司 × 年) 分组、指标名每 FM_BULK_METRIC_CHUNK 个一组读取 (公司 × 指标 × 年 × 季) 的超集，
+    每组分页读全，返回 {(company, year, quarter, metric): row}，由调用方再按实际请求的组合取用。
+    读取失败直接抛出（不吞成空结果，避免整批被误报为“未找到直取值”）。
+    """
+    companies = sorted({c for c in companies if c})
+    metrics = sorted({m for m in metrics if m})
+    years = sorted({int(y) for y in years if y})
+    quarters = sorted({int(q) for q in quarters if q})
+    if not (companies and metrics and years and quarters):
+        return {}
+    q_in = f"in.({','.join(str(q) for q in quarters)})"
+    rows: List[Dict[str,Any]] = []
+    for company in companies:
+        for year in years:
+            for i in range(0, len(metrics), FM_BULK_METRIC_CHUNK):
+                rows.extend(_sb_paged("financial_metrics", {
+                    "select": _FM_ROW_COLS,
+                    "company_name": f"eq.{company}",
+                    "metric_name": _pg_in(metrics[i:i + FM_BULK_METRIC_CHUNK]),
+                    "year": f"eq.{year}",
+                    "quarter": q_in,
+                    "order": "id.asc",
+                }))
+    out: Dict[Tuple[str,int,int,str], Dict[str,Any]] = {}
+    for r in rows or []:
+        try:
+            k = (str(r["company_name"]), int(r["year"]), int(r["quarter"]), str(r["metric_name"]))
+        except Exception:
+            continue
+        out.setdefault(k, r)
+    return out
 
+# ---------------- Formula utils ---------------- #
 def safe_eval(expr: str, env: Dict[str, float]) -> float:
-    return float(eval(expr, {"__builtins__": {}, **SAFE_FUNCS}, env))
+    # AST 白名单编译一次并缓存（abs/min/max/round/sqrt），不再走 eval
+    return evaluate(expr, env)
 
 def fmt_num(v: float) -> str:
     try:
@@ -410,15 +542,38 @@ def fmt_num(v: float) -> str:
     else:
         return f"{x:,.2f}"
 
-def load_formula(metric_name_cn: str) -> Optional[Dict[str,Any]]:
-    rows = _sb_safe("metric_formulas", {
+# 公式依赖图：metric_formulas 全表一次加载并构建 DAG，后台按版本探测刷新（与别名 catalog 相同机制）
+_FORMULA_GRAPH = CatalogCache(
+    "metric_formulas",
+    lambda: _sb("metric_formulas", {
         "select": "metric_name,description,variables,compute,enabled,is_standard,id",
-        "metric_name": f"eq.{metric_name_cn}",
         "enabled": "eq.true",
-        "order": "is_standard.desc,id.desc",
-        "limit": "1",
-    })
-    return rows[0] if rows else None
+        "order": "metric_name.asc,is_standard.desc,id.desc",
+    }),
+    build=FormulaGraph,
+    probe=postgrest_probe(SUPABASE_URL or "", SUPABASE_SERVICE_ROLE_KEY or "", "metric_formulas"),
+)
+
+def formula_graph() -> FormulaGraph:
+    return _FORMULA_GRAPH.get().data
+
+def load_formula(metric_name_cn: str) -> Optional[Dict[str,Any]]:
+    node = formula_graph().get(metric_name_cn)
+    return node.row if node else None
+
+def resolve_metric_values(company: str, year: int, quarter: int, metrics) -> Dict[str, float]:
+    """
+    目标指标（及其全部传递依赖）经 fetch_metric_rows_bulk 一次批量取数，再按公式依赖拓扑序求出派生值。
+    派生层级多深都不再逐层往返；返回 {指标名: 值}（直取值优先于公式值）
+    """
+    g = formula_graph()
+    targets = [m for m in metrics if m]
+    need = set()
+    for m in targets:
+        need |= g.closure(m)
+    rows = fetch_metric_rows_bulk([company], need, [year], [quarter])
+    known = {k[3]: r.get("metric_value") for k, r in rows.items()}
+    return g.resolve(targets, known)
 
 def compute_by_formula(metric_cn: str,
                        variables: Dict[str, str],
@@ -435,26 +590,16 @@ def compute_by_formula(metric_cn: str,
             base_vals[var_key] = v
     if missing:
         raise HTTPException(404, f"基础指标缺失：{', '.join(missing)}，请补充 {env_hint}")
-    values = dict(base_vals)
-    pending = dict(compute_graph)
-    order = list(pending.keys())
-    for _ in range(len(pending) + 2):
-        done = []
-        for k, expr in pending.items():
-            try:
-                values[k] = safe_eval(expr, values)
-                done.append(k)
-            except Exception:
-                pass
-        for k in done:
-            pending.pop(k)
-        if not pending:
-            break
-    if pending:
-        raise HTTPException(400, f"公式未能解析：{list(pending.keys())}")
-    result_var = order[-1] if order else None
+    result_var = list(compute_graph.keys())[-1] if compute_graph else None
     if not result_var:
         raise HTTPException(400, "公式未提供结果变量")
+    values = dict(base_vals)
+    try:
+        # 按引用关系拓扑排序后顺序求值（不再逐轮试算）
+        for k in compute_order(compute_graph, variables.keys()):
+            values[k] = safe_eval(compute_graph[k], values)
+    except Exception as e:
+        raise HTTPException(400, f"公式未能解析：{e}")
     result = float(values[result_var])
     return result, values, base_vals, result_var
 
@@ -466,7 +611,7 @@ def make_expression(metric_cn: str, result_var: str,
     def replace_vars_with_cn(expr: str) -> str:
         out = expr
         for k in sorted(variables.keys(), key=len, reverse=True):
-            out = re.sub(rf"\b{k}\b", variables[k])
+            out = re.sub(rf"\b{k}\b", variables[k], out)
         out = re.sub(rf"\b{result_var}\b", metric_cn, out)
         return out
     expr_cn_rhs = replace_vars_with_cn(rhs)
@@ -483,34 +628,9 @@ def make_expression(metric_cn: str, result_var: str,
     table = [{"指标/变量": cn, "值": fmt_num(val)} for cn, val in cn2val.items()]
     return expr, sub, table
 
-def compute_or_fetch_metric(company: str, year: int, quarter: int, metric_cn: str, depth: int = 0) -> Optional[float]:
-    if depth > 3:
-        return None
-    # 1) 直取
-    v = fetch_metric_value(company, year, quarter, metric_cn)
-    if v is not None:
-        return v
-    # 2) 公式
-    f = load_formula(metric_cn)
-    if not f:
-        return None
-    variables = f.get("variables") or {}
-    compute = f.get("compute") or {}
-    if isinstance(variables, str):
-        try: variables = json.loads(variables)
-        except Exception: variables = {}
-    if isinstance(compute, str):
-        try: compute = json.loads(compute)
-        except Exception: compute = {}
-    try:
-        result, *_ = compute_by_formula(
-            metric_cn, variables, compute,
-            lambda base_cn: compute_or_fetch_metric(company, year, quarter, base_cn, depth+1),
-            env_hint={"company_name": company, "year": year, "quarter": f"Q{quarter}"}
-        )
-        return result
-    except Exception:
-        return None
+def compute_or_fetch_metric(company: str, year: int, quarter: int, metric_cn: str) -> Optional[float]:
+    # 先直取、再公式（任意深度）：一次批量取数 + 拓扑序求值
+    return resolve_metric_values(company, int(year), int(quarter), [metric_cn]).get(metric_cn)
 
 # ---------------- LLM-first structured parsing ---------------- #
 def _parse_quarter_to_int(q: Any) -> Optional[int]:
@@ -528,8 +648,9 @@ def _parse_quarter_to_int(q: Any) -> Optional[int]:
 def _catalog_payload_for_llm():
     load_company_catalog_cache()
     load_metric_alias_cache()
-    companies = [{"display_name": c, "aliases": _COMPANY_CACHE[c]["aliases"]} for c in _COMPANY_CACHE]
-    metrics   = [{"canonical_name": m, "aliases": _ALIAS_CACHE[m]["aliases"]} for m in _ALIAS_CACHE]
+    comp_cache, alias_cache = _COMPANY_CACHE, _ALIAS_CACHE   # 固定本次使用的快照
+    companies = [{"display_name": c, "aliases": v["aliases"]} for c, v in comp_cache.items()]
+    metrics   = [{"canonical_name": m, "aliases": v["aliases"]} for m, v in alias_cache.items()]
     return companies, metrics
 
 def llm_structured_parse(question: str) -> Dict[str, Any]:
@@ -576,6 +697,17 @@ def llm_structured_parse(question: str) -> Dict[str, Any]:
     }
 
     
+    # —— 内容寻址缓存：同一提示词（含 now/catalog/最新期）直接复用上次解析结果 —— #
+    cache_key = LLM_CACHE.key(LLM_MODEL, [
+        {"role": "system", "content": sys_prompt},
+        {"role": "user",   "content": json.dumps(user_prompt, ensure_ascii=False)},
+    ], 0)
+    cached = LLM_CACHE.get(cache_key)
+    if cached is not None:
+        return _finish_llm_parse(json.loads(json.dumps(cached)), {
+            "ok": True, "status": 200, "endpoint": "cache",
+            "elapsed_ms": int((time.time() - start_ts) * 1000), "model": LLM_MODEL, "cache": "hit"})
+
     # —— 根据模型名选择端点与 payload —— #
     is_responses = str(LLM_MODEL).lower().startswith(("gpt-5", "o4", "o3"))
     url = f"{LLM_BASE.rstrip('/')}/responses" if is_responses else f"{LLM_BASE.rstrip('/')}/chat/completions"
@@ -709,16 +841,18 @@ def llm_structured_parse(question: str) -> Dict[str, Any]:
     }
 
 
+    if isinstance(data_obj, dict):
+        LLM_CACHE.set(cache_key, json.loads(json.dumps(data_obj, ensure_ascii=False)))
+    return _finish_llm_parse(data_obj, {"ok": True, "status": r.status_code, "endpoint": endpoint,
+                                        "elapsed_ms": elapsed_ms, "model": LLM_MODEL, "cache": "miss"})
+
+def _finish_llm_parse(data_obj: Dict[str, Any], debug: Dict[str, Any]) -> Dict[str, Any]:
     if data_obj.get("need_clarification"):
         return {"need_clarification": True, "ask": data_obj.get("ask") or "请补充公司、指标或时间（年/季）。"}
 
-    comp = data_obj.get("company")
-    metr = data_obj.get("metric")
-    year = data_obj.get("year")
-    q    = _parse_quarter_to_int(data_obj.get("quarter"))
+    q = _parse_quarter_to_int(data_obj.get("quarter"))
 
-    data_obj["_debug"] = {"ok": True, "status": r.status_code, "endpoint": endpoint,
-                        "elapsed_ms": elapsed_ms, "model": LLM_MODEL}
+    data_obj["_debug"] = debug
     # 统一 quarter 为 1~4 的整数，避免后续解析异常
     if q is not None:
         data_obj["quarter"] = q
@@ -932,19 +1066,14 @@ def metrics_query(req: QueryReq, _=Depends(require_token)):
         )
 
 
-    variables = fml.get("variables") or {}
-    compute   = fml.get("compute") or {}
-    if isinstance(variables, str):
-        try: variables = json.loads(variables)
-        except Exception: variables = {}
-    if isinstance(compute, str):
-        try: compute = json.loads(compute)
-        except Exception: compute = {}
+    variables, compute = formula_parts(fml)
 
     try:
+        # 公式的全部传递依赖一次取回，中间派生指标按拓扑序在内存中求出
+        known = resolve_metric_values(canon_company, int(year), int(quarter_int), variables.values())
         result, steps_values, base_values, result_var = compute_by_formula(
             canon_metric, variables, compute,
-            lambda base_cn: compute_or_fetch_metric(canon_company, int(year), int(quarter_int), base_cn, 1),
+            known.get,
             env_hint={"company_name": canon_company, "year": int(year), "quarter": q_label}
         )
         dbg["fetch_ok"] = True
@@ -977,6 +1106,140 @@ def metrics_query(req: QueryReq, _=Depends(require_token)):
             resolved=resolved,
             message="公式解析失败", debug=dbg, steps=steps
         )
+# ---------------- Batch API ---------------- #
+class BatchItem(BaseModel):
+    company: str
+    metric: str
+    year: int
+    quarter: str            # "Q1".."Q4" 或 1..4
+    scenario: Optional[str] = "actual"
+
+class BatchQueryReq(BaseModel):
+    items: List[BatchItem]
+
+class BatchQueryResp(BaseModel):
+    results: List[QueryResp]
+    debug: Optional[Dict[str,Any]] = None
+
+
+@app.post("/metrics/query_batch", response_model=BatchQueryResp)
+def metrics_query_batch(req: BatchQueryReq, _=Depends(require_token)):
+    """
+    批量取数：显式 (公司, 指标, 年, 季) 列表 → 与 /metrics/query 相同结构的结果列表（顺序与入参一致）。
+    DB 往返：公式来自内存依赖图，financial_metrics 一次 in.() 读取（含全部传递依赖），与条目数、派生深度无关。
+    """
+    items = req.items or []
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(400, f"单次批量最多 {BATCH_MAX_ITEMS} 条")
+
+    # 1) 规范化（只用内存 catalog）
+    resolved_list: List[Optional[Dict[str,Any]]] = []
+    for it in items:
+        q = _parse_quarter_to_int(it.quarter)
+        company = match_company_name(it.company) or it.company
+        metric = match_metric_canonical(it.metric) or it.metric
+        if not (company and metric and it.year and q):
+            resolved_list.append(None)
+            continue
+        resolved_list.append({
+            "metric_canonical": metric,
+            "company_name": company,
+            "year": int(it.year),
+            "quarter": f"Q{q}",
+            "scenario": it.scenario or "actual",
+        })
+    valid = [r for r in resolved_list if r]
+
+    # 2) 公式依赖图（内存快照）：目标指标的传递依赖集合
+    graph = formula_graph()
+    all_metrics = set()
+    for r in valid:
+        all_metrics |= graph.closure(r["metric_canonical"])
+    round_trips = 0
+
+    # 3) 批量读 financial_metrics（按 公司×年 分组、分页）
+    rows = fetch_metric_rows_bulk(
+        [r["company_name"] for r in valid], all_metrics,
+        [r["year"] for r in valid], [int(r["quarter"][1:]) for r in valid],
+    )
+    if valid:
+        round_trips += 1
+
+    # 4) 逐条组装（纯内存；同一 公司×期间 的派生值只求一次）
+    known_by_period: Dict[Tuple[str,int,int], Dict[str,float]] = {}
+    results: List[QueryResp] = []
+    for it, resolved in zip(items, resolved_list):
+        if not resolved:
+            results.append(QueryResp(need_clarification=True,
+                                     ask="请补充：公司、指标、年份、季度（Q1-Q4）。",
+                                     message="参数不完整"))
+            continue
+        company, metric = resolved["company_name"], resolved["metric_canonical"]
+        year, q = resolved["year"], int(resolved["quarter"][1:])
+        meta = metric_meta(metric) or {}
+        key = (company, year, q, metric)
+        row = rows.get(key)
+        if row and row.get("metric_value") is not None:
+            try:
+                cur_val = float(row["metric_value"])
+            except Exception:
+                cur_val = None
+            card = build_indicator_card(row, meta.get("unit"), company, year, q, metric)
+            results.append(QueryResp(
+                resolved=resolved,
+                value={"metric_name": metric, "metric_value": cur_val, "unit": meta.get("unit")},
+                indicator_card=card, message="直取完成",
+            ))
+            continue
+
+        node = graph.get(metric)
+        if not node:
+            results.append(QueryResp(
+                need_clarification=True,
+                ask=f"未查到『{metric}』的数值，且 metric_formulas 中无该指标公式。",
+                resolved=resolved, message="未找到直取值 & 缺少公式",
+            ))
+            continue
+        variables, compute = node.variables, node.compute
+        period = (company, year, q)
+        if period not in known_by_period:
+            known_by_period[period] = graph.resolve(
+                [r["metric_canonical"] for r in valid if (r["company_name"], r["year"], int(r["quarter"][1:])) == period],
+                {k[3]: row_.get("metric_value") for k, row_ in rows.items() if k[:3] == period},
+            )
+        try:
+            result, values, _base, result_var = compute_by_formula(
+                metric, variables, compute,
+                known_by_period[period].get,
+                env_hint={"company_name": company, "year": year, "quarter": f"Q{q}"}
+            )
+            expr, substituted, table = make_expression(metric, result_var, values, variables, compute)
+            card = build_indicator_card({"metric_value": result, "source": "formula"},
+                                        meta.get("unit"), company, year, q, metric)
+            results.append(QueryResp(
+                resolved=resolved,
+                value={"metric_name": metric, "metric_value": result, "unit": meta.get("unit")},
+                formula={"expression": expr, "substituted": substituted, "result": result,
+                         "result_str": fmt_num(result), "table": table},
+                indicator_card=card, message="公式计算完成",
+            ))
+        except HTTPException as e:
+            results.append(QueryResp(
+                need_clarification=True,
+                ask=f"计算『{metric}』需要的基础指标缺失：{str(e.detail)}。",
+                resolved=resolved, message="公式所需基础指标缺失",
+            ))
+        except Exception as e:
+            results.append(QueryResp(
+                need_clarification=True, ask=f"『{metric}』公式解析失败：{e}。",
+                resolved=resolved, message="公式解析失败",
+            ))
+
+    return BatchQueryResp(results=results, debug={
+        "items": len(items), "resolved": len(valid), "db_round_trips": round_trips,
+    })
+
+
 @app.get("/llm/ping")
 def llm_ping():
     if not (LLM_BASE and LLM_KEY and LLM_MODEL):
@@ -991,4 +1254,5 @@ def llm_ping():
 
 @app.get("/healthz")
 def healthz():
-    return {"ok": True}
+    return {"ok": True, "supabase": pool_stats(), "catalogs": catalog_stats(),
+            "formula_graph": formula_graph().describe(), "llm_cache": LLM_CACHE.stats()}
@@ -31,11 +31,42 @@ from dotenv import load_dotenv, find_dotenv
 p = find_dotenv(".env.backend", raise_error_if_not_found=False)
 load_dotenv(p, override=True)
 
+# 共享 catalog 快照缓存（兼容 `uvicorn agent.deepanalysis_agent:app` 与 agent/ 目录内启动）
+try:
+    from agent.catalog_cache import CatalogCache, postgrest_probe
+except ImportError:
+    from catalog_cache import CatalogCache, postgrest_probe
+try:
+    from agent.llm_cache import LLM_CACHE
+except ImportError:
+    from llm_cache import LLM_CACHE
+try:
+    from agent.llm_gateway import get_gateway
+except ImportError:
+    from llm_gateway import get_gateway
+try:
+    from agent.sse_bus import EventBus, sse_format
+except ImportError:
+    from sse_bus import EventBus, sse_format
+try:
+    from agent.formula_engine import FormulaError, compile_formula
+except ImportError:
+    from formula_engine import FormulaError, compile_formula
+try:
+    from agent.attribution import METHOD_LABELS, attribute
+except ImportError:
+    from attribution import METHOD_LABELS, attribute
+try:
+    from agent.anomaly_index import SORT_KEYS, AnomalyIndex
+except ImportError:
+    from anomaly_index import SORT_KEYS, AnomalyIndex
+
 LLM_BASE  = (os.getenv("OPENAI_BASE_URL") or os.getenv("OPENAI_API_BASE") or os.getenv("LLM_BASE_URL") or "").rstrip("/")
 LLM_KEY   = os.getenv("OPENAI_API_KEY") or os.getenv("LLM_API_KEY") or ""
 LLM_MODEL = os.getenv("OPENAI_MODEL") or os.getenv("LLM_MODEL") or ""
 LLM_CONNECT_TIMEOUT = int(os.getenv("LLM_CONNECT_TIMEOUT") or 30)   # 原来 5
 LLM_READ_TIMEOUT    = int(os.getenv("LLM_READ_TIMEOUT")    or 90)   # 原来 20
+_LLM = get_gateway(LLM_BASE, LLM_KEY)   # 超时取 LLM_CONNECT_TIMEOUT / LLM_READ_TIMEOUT
 # 是否在维度下钻里隐藏完整表，仅输出 TOP 表（默认是）
 COMPACT_DIMENSION_TABLES = (os.getenv("COMPACT_DIMENSION_TABLES") or "true").lower() == "true"
 # === Google CSE for policy/news ===
@@ -135,68 +166,28 @@ def _down_headers(token: Optional[str]) -> dict:
         h["Authorization"] = f"Bearer {t}"
     return h
 
-def llm_chat(system: str, user: str, *, temperature: float = 0.3, want_json: bool = False):
+def llm_chat(system: str, user: str, *, temperature: float = 0.3, want_json: bool = False, cache: bool = False):
     """
     适配 gpt-5/o4/o3：/responses + input，不发送 temperature；
     其它：/chat/completions + messages 可带 temperature。
     返回：want_json=True 时尝试提取 JSON，否则返回纯文本（None 表示失败）。
+    cache=True：相同 (model, messages, temperature) 直接复用上次成功结果（失败结果不缓存）。
     """
     if not (LLM_BASE and LLM_KEY and LLM_MODEL):
         return {} if want_json else None
-
-    is_responses = str(LLM_MODEL).lower().startswith(("gpt-5", "o4", "o3"))
-    endpoint = "/responses" if is_responses else "/chat/completions"
-    url = f"{LLM_BASE}{endpoint}"
-
-    if is_responses:
-        payload = {
-            "model": LLM_MODEL,
-            "input": [
-                {"role": "system", "content": system},
-                {"role": "user",   "content": user},
-            ]
-        }
-    else:
-        payload = {
-            "model": LLM_MODEL,
-            "messages": [
-                {"role": "system", "content": system},
-                {"role": "user",   "content": user},
-            ],
-            "temperature": temperature,
-        }
-
+    if cache:
+        messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
+        out = LLM_CACHE.cached(LLM_MODEL, messages, temperature,
+                               lambda: llm_chat(system, user, temperature=temperature, want_json=want_json),
+                               want_json=want_json)
+        return json.loads(json.dumps(out)) if isinstance(out, (dict, list)) else out
+
+    # gpt-5/o4/o3 走 /responses（不带 temperature），失败自动回退 /chat/completions —— 由 LLM 网关统一处理
     try:
-        r = requests.post(
-            url,
-            headers={"Authorization": f"Bearer {LLM_KEY}", "Content-Type": "application/json"},
-            json=payload,
-            timeout=(LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT),
+        text = _LLM.chat(
+            [{"role": "system", "content": system}, {"role": "user", "content": user}],
+            model=LLM_MODEL, temperature=temperature,
         )
-        if not r.ok:
-            # 返回更可读的错误，方便你在进度面板看到真正原因
-            try:
-                err = r.json()
-            except Exception:
-                err = {"text": r.text}
-            return {} if want_json else None
-
-        data = r.json()
-        # —— 解析文本（多种返回形态） —— #
-        text = None
-        if isinstance(data, dict) and "output_text" in data:  # responses 直出
-            text = data.get("output_text")
-        if text is None and isinstance(data, dict) and "choices" in data and data["choices"]:
-            ch0 = data["choices"][0]
-            text = (ch0.get("message") or {}).get("content") or ch0.get("text")
-        if text is None and isinstance(data, dict) and "output" in data and data["output"]:
-            try:
-                parts = data["output"][0].get("content", [])
-                texts = [p.get("text") for p in parts if isinstance(p, dict) and p.get("text")]
-                text = "\n".join(texts) if texts else None
-            except Exception:
-                pass
-
         if want_json:
             return _extract_json_block(text or "") or {}
         return (text or "").strip() or None
@@ -204,6 +195,26 @@ def llm_chat(system: str, user: str, *, temperature: float = 0.3, want_json: boo
         return {} if want_json else None
 
 
+async def allm_chat(system: str, user: str, *, temperature: float = 0.3, want_json: bool = False, cache: bool = False):
+    """协程版 llm_chat：await 网关（不占线程），返回约定与缓存口径同 llm_chat"""
+    if not (LLM_BASE and LLM_KEY and LLM_MODEL):
+        return {} if want_json else None
+    messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
+    key = LLM_CACHE.key(LLM_MODEL, messages, temperature, want_json=want_json) if cache else None
+    if key:
+        hit = LLM_CACHE.get(key)
+        if hit is not None:
+            return json.loads(json.dumps(hit)) if isinstance(hit, (dict, list)) else hit
+    try:
+        text = await _LLM.achat(messages, model=LLM_MODEL, temperature=temperature)
+    except Exception:
+        return {} if want_json else None
+    out = (_extract_json_block(text or "") or {}) if want_json else ((text or "").strip() or None)
+    if key and out:
+        LLM_CACHE.set(key, out)
+    return out
+
+
 def _quarter_bounds(year: int, q: str) -> tuple[str, str]:
     qn = int(str(q).upper().replace("Q",""))
     start_month = (qn-1)*3 + 1
@@ -372,51 +383,71 @@ def evaluate_formula(conn, company, year, quarter, variables_json, compute_json)
     if missing:
         return {"ok": False, "reason": "基础指标缺失: " + "，".join(missing)}
 
-    # 代入表达式
+    # 代入表达式（仅用于展示；计算走公式引擎）
     substituted = expr
     for k, v in key2val.items():
         substituted = re.sub(rf"\b{k}\b", f"({v})", substituted)
 
-    if VAR_WORD.search(substituted):  # 仍有未替换变量
+    try:
+        formula = compile_formula(expr)
+    except FormulaError as e:
+        return {"ok": False, "reason": f"公式不合法: {e}", "substituted": substituted}
+    if any(n not in key2val for n in formula.names):  # 仍有未替换变量
         return {"ok": False, "reason": "存在未替换变量", "substituted": substituted}
 
     try:
-        result = eval(substituted, {"__builtins__": {}})
-        if not (isinstance(result, (int, float)) and isfinite(result)):
+        result = formula(key2val)
+        if not isfinite(result):
             return {"ok": False, "reason": "结果非数值", "substituted": substituted}
         return {"ok": True, "result": float(result), "substituted": substituted, "variables_cn": list(variables.values())}
     except Exception as e:
         return {"ok": False, "reason": f"计算异常: {e}", "substituted": substituted}
     
-_CACHE_TTL = 60
-_LAST_LOAD = 0.0
 _COMPANIES: List[Dict[str, Any]] = []
 _METRIC_ALIASES: List[Dict[str, Any]] = []
 _FORMULAS: List[Dict[str, Any]] = []
 _KEY2CANON: Dict[str, str] = {}
 _ALIAS2CANON: Dict[str, str] = {}
 
-def _rebuild_alias_maps():
-    global _KEY2CANON, _ALIAS2CANON
-    _KEY2CANON, _ALIAS2CANON = {}, {}
-    for r in _METRIC_ALIASES:
+def _build_alias_maps(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    key2canon: Dict[str, str] = {}
+    alias2canon: Dict[str, str] = {}
+    for r in rows:
         canon = (r.get("canonical_name") or "").strip()
         if not canon: continue
         ck = (r.get("compute_key") or "").strip()
-        if ck: _KEY2CANON[ck] = canon
+        if ck: key2canon[ck] = canon
         for a in _split_aliases(r.get("aliases")) + [r.get("display_name_cn") or "", canon]:
             a = str(a).strip()
-            if a: _ALIAS2CANON[a] = canon
+            if a: alias2canon[a] = canon
+    return {"rows": rows, "key2canon": key2canon, "alias2canon": alias2canon}
+
+# 三张 catalog 各一份共享快照：后台按版本探测刷新，请求路径只读引用
+_COMPANY_CAT = CatalogCache(
+    "company_catalog", lambda: _sb_select("company_catalog", {"order": "id.asc"}),
+    probe=postgrest_probe(SUPABASE_URL or "", SUPABASE_SERVICE_ROLE_KEY or "", "company_catalog"),
+)
+_METRIC_CAT = CatalogCache(
+    "metric_alias_catalog", lambda: _sb_select("metric_alias_catalog", {"order": "id.asc"}),
+    build=_build_alias_maps,
+    probe=postgrest_probe(SUPABASE_URL or "", SUPABASE_SERVICE_ROLE_KEY or "", "metric_alias_catalog"),
+)
+_FORMULA_CAT = CatalogCache(
+    "metric_formulas", lambda: _sb_select("metric_formulas", {"order": "id.asc"}),
+    probe=postgrest_probe(SUPABASE_URL or "", SUPABASE_SERVICE_ROLE_KEY or "", "metric_formulas"),
+)
 
 def _reload_caches(force=False):
-    global _LAST_LOAD, _COMPANIES, _METRIC_ALIASES, _FORMULAS
-    now = time.time()
-    if (now - _LAST_LOAD < _CACHE_TTL) and not force and _COMPANIES: return
-    _COMPANIES = _sb_select("company_catalog", {"order": "id.asc"})
-    _METRIC_ALIASES = _sb_select("metric_alias_catalog", {"order": "id.asc"})
-    _FORMULAS = _sb_select("metric_formulas", {"order": "id.asc"})
-    _rebuild_alias_maps()
-    _LAST_LOAD = now
+    """把模块级引用指向三张 catalog 的当前快照（不阻塞；仅进程首次会同步加载）"""
+    global _COMPANIES, _METRIC_ALIASES, _FORMULAS, _KEY2CANON, _ALIAS2CANON
+    if force:
+        for c in (_COMPANY_CAT, _METRIC_CAT, _FORMULA_CAT):
+            c.refresh(force=True)
+    maps = _METRIC_CAT.get().data
+    _COMPANIES = _COMPANY_CAT.get().data
+    _METRIC_ALIASES = maps["rows"]
+    _KEY2CANON, _ALIAS2CANON = maps["key2canon"], maps["alias2canon"]
+    _FORMULAS = _FORMULA_CAT.get().data
 
 def fmt_num(v: Any) -> Optional[str]:
     try:
@@ -483,15 +514,54 @@ def canon_from_key_or_alias(name: str) -> Optional[str]:
     if name in _ALIAS2CANON: return _ALIAS2CANON[name]
     return None
 
+# parent_id → 子公司列表：按 company_catalog 快照构建一次，快照替换后自动重建
+_CHILDREN_IDX: Dict[str, List[Dict[str, Any]]] = {}
+_CHILDREN_SRC: Any = None
+
+def _children_index() -> Dict[str, List[Dict[str, Any]]]:
+    global _CHILDREN_IDX, _CHILDREN_SRC
+    _reload_caches()
+    src = _COMPANIES
+    if src is _CHILDREN_SRC:
+        return _CHILDREN_IDX
+
+    def _norm_name(x: str) -> str:
+        return re.sub(r"\s+", "", str(x or "")).lower()
+
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for r in src or []:
+        pid = str(r.get("parent_id") or "").strip()
+        if pid:
+            groups.setdefault(pid, []).append(r)
+
+    # 去重：按 display_name / id，避免 catalog 存在同名不同 id 导致重复/丢失
+    idx: Dict[str, List[Dict[str, Any]]] = {}
+    for pid, children in groups.items():
+        seen_names, seen_ids, out = set(), set(), []
+        for c in children:
+            cid = str(c.get("id") or "").strip()
+            cname = _norm_name(c.get("display_name") or "")
+            if not cname:
+                continue
+            if cname in seen_names:
+                continue
+            if cid and cid in seen_ids:
+                continue
+            out.append(c)
+            seen_names.add(cname)
+            if cid:
+                seen_ids.add(cid)
+        idx[pid] = out
+    _CHILDREN_IDX, _CHILDREN_SRC = idx, src
+    return idx
+
 def get_children(parent: Dict[str, Any] | str) -> List[Dict[str, Any]]:
     """
     严格父子关系：仅用 company_catalog 的 id 与 parent_id 精确匹配。
     - parent 可传公司行或其 id（字符串）
-    - 返回所有满足 row.parent_id == parent.id 的公司行
+    - 返回所有满足 row.parent_id == parent.id 的公司行（查预建索引，不再逐行扫描）
     - 结果按 display_name 去重，避免 catalog 存在同名不同 id 导致重复/丢失
     """
-    _reload_caches()
-
     if isinstance(parent, dict):
         pid = str(parent.get("id") or "").strip()
     else:
@@ -499,29 +569,7 @@ def get_children(parent: Dict[str, Any] | str) -> List[Dict[str, Any]]:
 
     if not pid:
         return []
-
-    # 1) 精确 parent_id 匹配
-    children = [r for r in _COMPANIES if str(r.get("parent_id") or "").strip() == pid]
-
-    # 2) 去重
-    def _norm_name(x: str) -> str:
-        return re.sub(r"\s+", "", str(x or "")).lower()
-
-    seen_names, seen_ids, out = set(), set(), []
-    for c in children:
-        cid = str(c.get("id") or "").strip()
-        cname = _norm_name(c.get("display_name") or "")
-        if not cname:
-            continue
-        if cname in seen_names:
-            continue
-        if cid and cid in seen_ids:
-            continue
-        out.append(c)
-        seen_names.add(cname)
-        if cid:
-            seen_ids.add(cid)
-    return out
+    return list(_children_index().get(pid, []))
 
 
 
@@ -548,6 +596,22 @@ def fetch_metric_row_by_name(company_name: str, metric_name: str, year: int, qua
     })
     return rows[0] if rows else None
 
+def fetch_metric_rows_by_names(company_name: str, metric_names: List[str], year: int, quarter_int: int) -> Dict[str, Dict[str, Any]]:
+    names = sorted({str(m) for m in metric_names if m})
+    if not names:
+        return {}
+    quoted = ",".join('"' + m.replace("\\", "\\\\").replace('"', '\\"') + '"' for m in names)
+    rows = _sb_select("financial_metrics", {
+        "company_name": f"eq.{company_name}",
+        "metric_name": f"in.({quoted})",
+        "year": f"eq.{year}",
+        "quarter": f"eq.{quarter_int}",
+    })
+    out: Dict[str, Dict[str, Any]] = {}
+    for r in rows or []:
+        out.setdefault(str(r.get("metric_name")), r)
+    return out
+
 def list_company_metrics_by_name(company_name: str, year: int, quarter_int: int) -> List[Dict[str, Any]]:
     return _sb_select("financial_metrics", {
         "company_name": f"eq.{company_name}",
@@ -620,37 +684,15 @@ def get_indicator_card(question: str, company: Optional[str], metric: Optional[s
 
 
 def safe_eval_compute(expr: str, vals: Dict[str, float]) -> float:
-    allow = set("0123456789.+-*/() ")
-    cleaned = []; i = 0
-    while i < len(expr):
-        ch = expr[i]
-        if ch.isalpha() or ch == "_":
-            j = i+1
-            while j < len(expr) and (expr[j].isalnum() or expr[j] == "_"): j += 1
-            name = expr[i:j]
-            if name not in vals: raise ValueError(f"未知变量: {name}")
-            cleaned.append(str(vals[name])); i = j; continue
-        if ch in allow: cleaned.append(ch); i += 1; continue
-        raise ValueError(f"非法字符: {ch}")
-    return float(eval("".join(cleaned), {"__builtins__": {}}))
-
-def contribution_by_variables(expr: str, base_vals: Dict[str, float], new_vals: Dict[str, float]) -> List[Dict[str, Any]]:
-    res = []
-    try:
-        base_y = safe_eval_compute(expr, base_vals)
-        new_y  = safe_eval_compute(expr, new_vals)
-    except Exception as e:
-        return [{"variable":"_error","message":f"计算失败: {e}"}]
-    total_delta = new_y - base_y
-    for k in new_vals.keys():
-        mid = dict(base_vals); mid[k] = new_vals[k]
-        try:
-            mid_y = safe_eval_compute(expr, mid); impact = mid_y - base_y
-        except Exception:
-            impact = None
-        res.append({"variable":k,"base":base_vals.get(k),"new":new_vals.get(k),"impact_estimate":impact})
-    res.append({"variable":"_total","impact_estimate":total_delta})
-    return res
+    # 公式引擎：AST 白名单编译并缓存；未知变量抛 FormulaError（ValueError 子类）
+    return compile_formula(expr)(vals)
+
+def contribution_by_variables(expr: str, base_vals: Dict[str, float], new_vals: Dict[str, float],
+                              method: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    变量贡献分解（shapley / lmdi / oat，默认 ATTRIB_METHOD）：全部替换情景一批向量化求值，按 公式×期间对 缓存。
+    """
+    return attribute(expr, base_vals, new_vals, method)
 
 def _parse_formula(f: Dict[str, Any]) -> Dict[str, Any]:
     vars_raw = f.get("variables"); comp_raw = f.get("compute")
@@ -711,7 +753,7 @@ def build_basic_summary(indicator_card: Optional[Dict[str, Any]], sections: List
             if qtop: lines.append(f"环比看，「{qtop[0]['company']}」贡献/拖累最大（Δ={qtop[0].get('qoq_delta_str') or fmt_num(qtop[0].get('qoq_delta'))}）。")
         if t in {"metric","business"}:
             rows = s.get("contribution_yoy") or []
-            rows = [r for r in rows if r.get("variable") not in {"合计"} and isinstance(r.get("impact_raw"), (int,float))]
+            rows = [r for r in rows if r.get("variable") not in {"合计", "交互/残差"} and isinstance(r.get("impact_raw"), (int,float))]
             rows.sort(key=lambda r: abs(r.get("impact_raw",0)), reverse=True)
             if rows[:2]:
                 k = "；".join([f"「{r['variable']}」≈{r.get('impact') or fmt_num(r.get('impact_raw'))}" for r in rows[:2]])
@@ -728,7 +770,9 @@ def _wrap_contrib_rows(contrib: List[Dict[str, Any]], cn_map: Dict[str,str]) ->
     for item in contrib:
         key = item.get("variable")
         if key == "_error": rows.append(item); continue
-        cname = "合计" if key == "_total" else (canon_from_key_or_alias(key) or cn_map.get(key) or key)
+        if key == "_total": cname = "合计"
+        elif key == "_interaction": cname = "交互/残差"
+        else: cname = canon_from_key_or_alias(key) or cn_map.get(key) or key
         base = item.get("base"); newv = item.get("new"); imp = item.get("impact_estimate")
         rows.append({
             "variable": cname, "base": fmt_num(base), "new": fmt_num(newv), "impact": fmt_num(imp),
@@ -736,13 +780,71 @@ def _wrap_contrib_rows(contrib: List[Dict[str, Any]], cn_map: Dict[str,str]) ->
         })
     return rows
 
+# ---------------- 维度下钻：子公司并发取数 ---------------- #
+DRILL_CONCURRENCY = int(os.getenv("DRILL_CONCURRENCY") or 8)          # 同时在途的 /metrics/query 数
+DRILL_DEADLINE_S = float(os.getenv("DRILL_DEADLINE_S") or 25)         # 整个下钻的截止时间；超时未返回的子公司记为 deadline
+DRILL_CALL_TIMEOUT_S = float(os.getenv("DRILL_CALL_TIMEOUT_S") or 20) # 单个子公司请求超时
+
+async def _fetch_child_cards(names: List[str], metric_name: str, year: int, quarter_int: int) -> Dict[str, Dict[str, Any]]:
+    """
+    并发调用 dataquery /metrics/query（信号量限流）；到 DRILL_DEADLINE_S 仍未完成的请求直接取消，
+    已返回的结果照常使用（部分结果）。返回 {name: {"ok", "card" | "reason"}}
+    """
+    import httpx
+    results: Dict[str, Dict[str, Any]] = {}
+    if not names:
+        return results
+    sem = asyncio.Semaphore(max(1, DRILL_CONCURRENCY))
+    timeout = httpx.Timeout(DRILL_CALL_TIMEOUT_S, connect=min(5.0, DRILL_CALL_TIMEOUT_S))
+    limits = httpx.Limits(max_connections=max(1, DRILL_CONCURRENCY))
+    async with httpx.AsyncClient(headers=_down_headers(DATA_AGENT_TOKEN), timeout=timeout, limits=limits) as cli:
+        async def _one(name: str) -> None:
+            payload = {
+                "question": "",                       # 避免再走 LLM
+                "company": name,
+                "metric": metric_name,                # 已在上游 canonical 过
+                "year": int(year),
+                "quarter": f"Q{int(quarter_int)}",
+                "scenario": "actual"
+            }
+            async with sem:
+                try:
+                    r = await cli.post(f"{DATA_AGENT_BASE_URL}/metrics/query", json=payload)
+                    if r.status_code >= 400:
+                        results[name] = {"ok": False, "reason": f"HTTP {r.status_code}"}
+                        return
+                    dq = r.json() or {}
+                    results[name] = {"ok": True, "card": dq.get("indicator_card") or {}}
+                except Exception as e:
+                    results[name] = {"ok": False, "reason": str(e) or type(e).__name__}
+
+        tasks = [asyncio.create_task(_one(n)) for n in dict.fromkeys(names)]
+        _done, pending = await asyncio.wait(tasks, timeout=DRILL_DEADLINE_S)
+        for t in pending:
+            t.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+    for n in names:
+        results.setdefault(n, {"ok": False, "reason": f"deadline {DRILL_DEADLINE_S:g}s"})
+    return results
+
+def _run_async(coro):
+    """在同步代码里跑协程：_analyze_core 运行于工作线程（无事件循环）时直接 asyncio.run；否则借独立线程"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        return ex.submit(asyncio.run, coro).result()
+
 def _drill_dimension(company_row: Dict[str, Any], metric_name: str, year: int, quarter_int: int, top_k: int = 3) -> Dict[str, Any]:
 
     """
     维度下钻（严格要求）：
     1) 用 company_catalog.id → parent_id 找到所有子公司；
     2) 拿子公司 display_name；
-    3) 逐个调用 dataquery_agent /metrics/query 取 {current, yoy_delta, qoq_delta}；
+    3) 并发调用 dataquery_agent /metrics/query 取 {current, yoy_delta, qoq_delta}（限流 + 截止时间，超时的子公司记为未命中）；
     4) 汇总表格与**单个**饼图（避免重复图表）。
     """
     children = get_children(company_row)
@@ -763,52 +865,35 @@ def _drill_dimension(company_row: Dict[str, Any], metric_name: str, year: int, q
 
 
     rows = []
-    for c in children:
-        child_name = str(c.get("display_name") or "").strip()
-        if not child_name:
-            continue
-
-        payload = {
-            "question": "",                       # 避免再走 LLM
-            "company": child_name,
-            "metric": metric_name,                # 已在上游 canonical 过
-            "year": int(year),
-            "quarter": f"Q{int(quarter_int)}",
-            "scenario": "actual"
-        }
-        try:
-            r = requests.post(
-                f"{DATA_AGENT_BASE_URL}/metrics/query",
-                headers=_down_headers(DATA_AGENT_TOKEN),
-                json=payload,
-                timeout=30
-            )
-
-            if r.status_code >= 400:
-                probe.append({"name": child_name, "ok": False, "reason": f"HTTP {r.status_code}"})  # [ADD]
-                continue
+    child_names = [str(c.get("display_name") or "").strip() for c in children]
+    child_names = [n for n in child_names if n]
+    t0 = time.time()
+    fetched = _run_async(_fetch_child_cards(child_names, metric_name, year, quarter_int))
+    elapsed_ms = int((time.time() - t0) * 1000)
 
-            dq = r.json() or {}
-            card = dq.get("indicator_card") or {}
-            cur = card.get("current")
-            yoy = card.get("yoy_delta")
-            qoq = card.get("qoq_delta")
+    for child_name in child_names:
+        res = fetched.get(child_name) or {"ok": False, "reason": "missing"}
+        if not res.get("ok"):
+            probe.append({"name": child_name, "ok": False, "reason": res.get("reason")})  # [ADD]
+            continue
 
-            if cur is None and yoy is None and qoq is None:
-                probe.append({"name": child_name, "ok": False, "reason": "no values"})  # [ADD]
-                continue
+        card = res.get("card") or {}
+        cur = card.get("current")
+        yoy = card.get("yoy_delta")
+        qoq = card.get("qoq_delta")
 
-            rows.append({
-                "company": child_name,
-                "current": cur, "current_str": fmt_num(cur),
-                "yoy_delta": yoy, "yoy_delta_str": fmt_num(yoy),
-                "qoq_delta": qoq, "qoq_delta_str": fmt_num(qoq),
-            })
-            probe.append({"name": child_name, "ok": True, "current": cur})  # [ADD]
-        except Exception as e:
-            probe.append({"name": child_name, "ok": False, "reason": str(e)})  # [ADD]
+        if cur is None and yoy is None and qoq is None:
+            probe.append({"name": child_name, "ok": False, "reason": "no values"})  # [ADD]
             continue
 
+        rows.append({
+            "company": child_name,
+            "current": cur, "current_str": fmt_num(cur),
+            "yoy_delta": yoy, "yoy_delta_str": fmt_num(yoy),
+            "qoq_delta": qoq, "qoq_delta_str": fmt_num(qoq),
+        })
+        probe.append({"name": child_name, "ok": True, "current": cur})  # [ADD]
+
     if not rows:
         return {
             "type": "dimension",
@@ -817,7 +902,7 @@ def _drill_dimension(company_row: Dict[str, Any], metric_name: str, year: int, q
             "table": [],
             "chart": {"type": "pie", "data": []},
             "conclusion": {"yoy_top": [], "qoq_top": []},
-            "debug": {"children_found": found_names, "data_calls": probe}  # [ADD]
+            "debug": {"children_found": found_names, "data_calls": probe, "elapsed_ms": elapsed_ms}  # [ADD]
         }
 
 
@@ -838,6 +923,7 @@ def _drill_dimension(company_row: Dict[str, Any], metric_name: str, year: int, q
     debug_extra = {
         "children_found": found_names,
         "data_calls": probe,
+        "elapsed_ms": elapsed_ms,
         "table_full": rows if COMPACT_DIMENSION_TABLES else None
     }
 
@@ -856,6 +942,21 @@ def _drill_dimension(company_row: Dict[str, Any], metric_name: str, year: int, q
 
 
 
+def _yoy_variable_values(company_name: str, expr: str, var_keys: List[str], cn_map: Dict[str, str],
+                         year: int, quarter_int: int) -> tuple[Dict[str, float], Dict[str, float]]:
+    """公式变量的 本期/去年同期 值：一次 in.() 取回全部变量行（不再逐变量查询）"""
+    tokens = set(re.findall(r"\b[a-zA-Z_]\w*\b", expr))
+    keys = [k for k in var_keys if k in tokens]
+    if not keys:
+        return {}, {}
+    rows = fetch_metric_rows_by_names(company_name, [cn_map.get(k, k) for k in keys], year, quarter_int)
+    base_vals, new_vals = {}, {}
+    for k in keys:
+        r_cur = rows.get(cn_map.get(k, k))
+        if r_cur and r_cur.get("metric_value") is not None and r_cur.get("last_year_value") is not None:
+            new_vals[k]  = r_cur.get("metric_value"); base_vals[k] = r_cur.get("last_year_value")
+    return base_vals, new_vals
+
 def _drill_metric(company_row: Dict[str, Any], metric_name: str, year: int, quarter_int: int) -> Dict[str, Any]:
     f = find_formula(metric_name, is_standard=True) or find_formula(metric_name, label="标准公式")
     if not f: return {"type":"metric","title":"指标下钻","message": f"未找到『{metric_name}』的标准公式，无法指标下钻。"}
@@ -868,18 +969,10 @@ def _drill_metric(company_row: Dict[str, Any], metric_name: str, year: int, quar
             cn = canon_from_key_or_alias(k)
             if cn: cn_map[k] = cn
 
-    base_vals, new_vals = {}, {}
-    for k in var_keys:
-        cn = cn_map.get(k, k)
-        r_cur = fetch_metric_row_by_name(company_row.get("display_name"), cn, year, quarter_int)
-        if r_cur and r_cur.get("metric_value") is not None and r_cur.get("last_year_value") is not None:
-            new_vals[k]  = r_cur.get("metric_value"); base_vals[k] = r_cur.get("last_year_value")
-
-    tokens = set(re.findall(r"\b[a-zA-Z_]\w*\b", expr))
-    new_vals = {k:v for k,v in new_vals.items() if k in tokens}
-    base_vals = {k:v for k,v in base_vals.items() if k in tokens}
-
-    contrib_rows = _wrap_contrib_rows(contribution_by_variables(expr, base_vals, new_vals), cn_map)
+    base_vals, new_vals = _yoy_variable_values(company_row.get("display_name"), expr, var_keys, cn_map, year, quarter_int)
+    contrib = contribution_by_variables(expr, base_vals, new_vals)
+    method = (contrib[-1].get("method") if contrib else None) or "oat"
+    contrib_rows = _wrap_contrib_rows(contrib, cn_map)
     return {
         "type":"metric","title":"指标下钻（标准公式）",
         "formula":{
@@ -888,7 +981,8 @@ def _drill_metric(company_row: Dict[str, Any], metric_name: str, year: int, quar
             "compute":expr,"compute_cn":expr_to_cn(expr, cn_map)
         },
         "contribution_yoy":contrib_rows,
-        "note":"贡献估算基于逐个变量替换法，作为定性解释。"
+        "method":method,
+        "note":f"贡献估算基于{METHOD_LABELS.get(method, method)}，作为定性解释。"
     }
 
 def _drill_business(company_row: Dict[str, Any], metric_name_for_biz: str, year: int, quarter_int: int) -> Dict[str, Any]:
@@ -903,18 +997,10 @@ def _drill_business(company_row: Dict[str, Any], metric_name_for_biz: str, year:
             cn = canon_from_key_or_alias(k)
             if cn: cn_map[k] = cn
 
-    base_vals, new_vals = {}, {}
-    for k in var_keys:
-        cn = cn_map.get(k, k)
-        r_cur = fetch_metric_row_by_name(company_row.get("display_name"), cn, year, quarter_int)
-        if r_cur and r_cur.get("metric_value") is not None and r_cur.get("last_year_value") is not None:
-            new_vals[k]  = r_cur.get("metric_value"); base_vals[k] = r_cur.get("last_year_value")
-
-    tokens = set(re.findall(r"\b[a-zA-Z_]\w*\b", expr))
-    new_vals = {k:v for k,v in new_vals.items() if k in tokens}
-    base_vals = {k:v for k,v in base_vals.items() if k in tokens}
-
-    contrib_rows = _wrap_contrib_rows(contribution_by_variables(expr, base_vals, new_vals), cn_map)
+    base_vals, new_vals = _yoy_variable_values(company_row.get("display_name"), expr, var_keys, cn_map, year, quarter_int)
+    contrib = contribution_by_variables(expr, base_vals, new_vals)
+    method = (contrib[-1].get("method") if contrib else None) or "oat"
+    contrib_rows = _wrap_contrib_rows(contrib, cn_map)
     return {
         "type":"business","title":f"业务下钻（{metric_name_for_biz}）",
         "formula":{
@@ -923,7 +1009,8 @@ def _drill_business(company_row: Dict[str, Any], metric_name_for_biz: str, year:
             "compute":expr,"compute_cn":expr_to_cn(expr, cn_map)
         },
         "contribution_yoy":contrib_rows,
-        "note":"贡献估算基于逐个变量替换法，作为定性解释。"
+        "method":method,
+        "note":f"贡献估算基于{METHOD_LABELS.get(method, method)}，作为定性解释。"
     }
 
 class DrillMode(str, Enum):
@@ -992,22 +1079,14 @@ def _analyze_core(req: AnalyzeReq, on_push=None) -> AnalyzeResp:
 
     sections: List[Dict[str, Any]] = []
 
-    # (A) 规划
-    push("分析问题中（意图识别/规划）", "start")
-    try:
-        plan_ctx = {
-            "company": comp_row.get("display_name") or comp_row.get("company_id"),
-            "metric": canon_metric, "year": year, "quarter": quarter_int,
-            "modes": [m.value for m in req.modes],
-        }
-        plan = llm_chat(PROMPT_PLANNER, json.dumps(plan_ctx, ensure_ascii=False), temperature=0.2) or ""
-        push("分析问题中（意图识别/规划）", "done",
-             detail=(str(plan).strip()[:300] + ("..." if len(str(plan)) > 300 else "")) if plan else None)
-    except Exception as e:
-        push("分析问题中（意图识别/规划）", "error", detail=e)
+    # (A) 规划 与 (B) 下钻 并行：规划只用于进度展示，LLM 请求在网关事件循环中 await，下钻在工作线程里执行
+    plan_ctx = {
+        "company": comp_row.get("display_name") or comp_row.get("company_id"),
+        "metric": canon_metric, "year": year, "quarter": quarter_int,
+        "modes": [m.value for m in req.modes],
+    }
 
-    # (B) 下钻
-    if not req.policy_only and req.modes:
+    def _run_drills() -> None:
         push("下钻执行中", "start")
         for mode in req.modes:
             if mode == DrillMode.dimension:
@@ -1023,6 +1102,23 @@ def _analyze_core(req: AnalyzeReq, on_push=None) -> AnalyzeResp:
                 sections.append({"type": "unknown", "message": f"未知模式：{mode}"})
         push("下钻执行中", "done")
 
+    async def _plan() -> None:
+        push("分析问题中（意图识别/规划）", "start")
+        try:
+            plan = await allm_chat(PROMPT_PLANNER, json.dumps(plan_ctx, ensure_ascii=False), temperature=0.2, cache=True) or ""
+            push("分析问题中（意图识别/规划）", "done",
+                 detail=(str(plan).strip()[:300] + ("..." if len(str(plan)) > 300 else "")) if plan else None)
+        except Exception as e:
+            push("分析问题中（意图识别/规划）", "error", detail=e)
+
+    async def _plan_and_drill() -> None:
+        jobs = [_plan()]
+        if not req.policy_only and req.modes:
+            jobs.append(asyncio.to_thread(_run_drills))
+        await asyncio.gather(*jobs)
+
+    _run_async(_plan_and_drill())
+
     #     # (C) 政策上下文
     # if not req.skip_policy:
     #     try:
@@ -1247,8 +1343,54 @@ def list_business_formulas(_:bool=True):
     return out
 
 
+# ---------------- 异动索引：financial_metrics 全量预计算（后台周期重建） ---------------- #
+ANOMALY_PAGE_SIZE = int(os.getenv("ANOMALY_PAGE_SIZE") or 1000)
+
+def _load_all_financial_metrics() -> List[Dict[str, Any]]:
+    """
+    全表分页读取：读到空页才结束（服务端 max-rows 可能小于 ANOMALY_PAGE_SIZE，短页不代表读完）；
+    order 以 id 收尾保证排序唯一，翻页不重不漏
+    """
+    rows: List[Dict[str, Any]] = []
+    offset = 0
+    while True:
+        page = _sb_select("financial_metrics", {
+            "select": "company_name,metric_name,year,quarter,metric_value,baseline_target,last_year_value,last_period_value",
+            "order": "company_name.asc,metric_name.asc,year.asc,quarter.asc,id.asc",
+            "limit": ANOMALY_PAGE_SIZE, "offset": offset,
+        }) or []
+        if not page:
+            return rows
+        rows.extend(page)
+        offset += len(page)
+
+ANOMALY_INDEX = AnomalyIndex(_load_all_financial_metrics)
+
+@app.on_event("startup")
+def _start_anomaly_index():
+    ANOMALY_INDEX.start()
+
+def _anomaly_item(r: Dict[str, Any]) -> Dict[str, Any]:
+    cur, yoy, qoq = r.get("value"), r.get("yoy_change"), r.get("qoq_change")
+    return {"metric": r.get("metric"),
+            "current": cur, "yoy_change": yoy, "qoq_change": qoq,
+            "current_str": fmt_num(cur), "yoy_change_str": fmt_num(yoy), "qoq_change_str": fmt_num(qoq),
+            "zscore": r.get("zscore"), "target_gap": r.get("target_gap"), "target_gap_str": fmt_num(r.get("target_gap")),
+            "score": r.get("score")}
+
 def _drill_anomaly(company_row: Dict[str, Any], year: int, quarter_int: int, top_k: int) -> Dict[str, Any]:
-    rows = list_company_metrics_by_name(company_row.get("display_name"), year, quarter_int)
+    company_name = company_row.get("display_name")
+    k = max(1, top_k)
+    # 索引已覆盖该 公司×期间：三次主键前缀查询直接取 TOP-K
+    if ANOMALY_INDEX.has_period(company_name, year, quarter_int):
+        q = {"company": company_name, "year": year, "quarter": quarter_int, "top_k": k}
+        return {"type":"anomaly","title":f"异动分析（TOP{top_k}）",
+                "top_yoy":[_anomaly_item(r) for r in ANOMALY_INDEX.top(sort="yoy", **q)],
+                "top_qoq":[_anomaly_item(r) for r in ANOMALY_INDEX.top(sort="qoq", **q)],
+                "top_score":[_anomaly_item(r) for r in ANOMALY_INDEX.top(sort="score", **q)],
+                "source":"index"}
+    # 兜底：索引未就绪 / 新数据尚未入索引 → 现算
+    rows = list_company_metrics_by_name(company_name, year, quarter_int)
     table = []
     for r in rows:
         cur = r.get("metric_value"); yoyb = r.get("last_year_value"); qoqb = r.get("last_period_value")
@@ -1259,9 +1401,33 @@ def _drill_anomaly(company_row: Dict[str, Any], year: int, quarter_int: int, top
                       "current_str": fmt_num(cur), "yoy_change_str": fmt_num(yoy), "qoq_change_str": fmt_num(qoq)})
     def key_yoy(x): v = x.get("yoy_change"); return abs(v) if isinstance(v,(int,float)) else -1
     def key_qoq(x): v = x.get("qoq_change"); return abs(v) if isinstance(v,(int,float)) else -1
-    top_yoy = sorted(table, key=key_yoy, reverse=True)[:max(1, top_k)]
-    top_qoq = sorted(table, key=key_qoq, reverse=True)[:max(1, top_k)]
-    return {"type":"anomaly","title":f"异动分析（TOP{top_k}）","top_yoy":top_yoy,"top_qoq":top_qoq}
+    top_yoy = sorted(table, key=key_yoy, reverse=True)[:k]
+    top_qoq = sorted(table, key=key_qoq, reverse=True)[:k]
+    return {"type":"anomaly","title":f"异动分析（TOP{top_k}）","top_yoy":top_yoy,"top_qoq":top_qoq,"source":"live"}
+
+@app.get("/deepanalysis/anomalies")
+def list_anomalies(company: Optional[str] = None, year: Optional[int] = None, quarter: Optional[str] = None,
+                   metric: Optional[str] = None, sort: str = "score", top_k: int = 20,
+                   min_score: Optional[float] = None, _=Depends(require_token)):
+    """
+    异动列表（读预计算索引）：可按 公司/年/季/指标 过滤，sort ∈ score|z|yoy|qoq|yoy_pct|qoq_pct|target
+    """
+    if sort not in SORT_KEYS:
+        raise HTTPException(400, f"sort 仅支持：{', '.join(SORT_KEYS)}")
+    quarter_int = None
+    if quarter:
+        qs = str(quarter).strip().upper().lstrip("Q")
+        if qs not in {"1", "2", "3", "4"}:
+            raise HTTPException(400, "quarter 需为 Q1-Q4")
+        quarter_int = int(qs)
+    company_name = None
+    if company:
+        row = match_company(company)
+        company_name = (row or {}).get("display_name") or company
+    metric_name = (canonical_metric(metric) or metric) if metric else None
+    items = ANOMALY_INDEX.top(company=company_name, year=year, quarter=quarter_int, metric=metric_name,
+                              sort=sort, top_k=min(max(1, top_k), 500), min_score=min_score)
+    return {"items": items, "count": len(items), "index": ANOMALY_INDEX.stats()}
 
 @app.post("/deepanalysis/analyze", response_model=AnalyzeResp)
 def analyze(req: AnalyzeReq, _=Depends(require_token)):
@@ -1273,32 +1439,33 @@ def analyze(req: AnalyzeReq, _=Depends(require_token)):
 # deepanalysis_agent.py -> analyze_stream()
 async def analyze_stream(req: AnalyzeReq, _=Depends(require_token)):
     async def event_gen():
-        q: asyncio.Queue = asyncio.Queue()
+        # 推送式事件总线：工作线程 publish → 事件循环直接唤醒消费者，无轮询
+        bus = EventBus(asyncio.get_running_loop())
 
         def on_push(ev: Dict[str, Any]):
-            try: q.put_nowait(("progress", ev))
-            except Exception: pass
-
-        task = asyncio.create_task(asyncio.to_thread(_analyze_core, req, on_push))
-
-        while True:
-            if task.done():
-                # ← 在真正发送最终结果之前，等至少 THOUGHT_DELAY_MS
-                await asyncio.sleep(max(THOUGHT_DELAY_MS, 500)/1000.0)
-                try:
-                    resp: AnalyzeResp = task.result()
-                    payload = json.dumps(resp.dict(), ensure_ascii=False)
-                    yield f"event: done\ndata:{payload}\n\n"
-                except Exception as e:
-                    yield f"event: done\ndata:{json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
-                break
+            # start/done/error 为关键进度；其它状态（思考/中间态）为低优先级，按 step 合并
+            low = ev.get("status") not in ("start", "done", "error")
+            bus.publish("progress", ev, low=low, key=ev.get("step") if low else None)
 
+        async def _run() -> AnalyzeResp:
             try:
-                typ, ev = await asyncio.wait_for(q.get(), timeout=0.1)
-                yield f"event: {typ}\ndata:{json.dumps(ev, ensure_ascii=False)}\n\n"
-            except asyncio.TimeoutError:
-                continue
-
+                return await asyncio.to_thread(_analyze_core, req, on_push)
+            finally:
+                bus.close()
+
+        task = asyncio.create_task(_run())
+        async for typ, ev in bus:
+            yield sse_format(typ, ev)
+
+        # 思考展示节奏：最后一条进度之后至少停留 THOUGHT_DELAY_MS 再给结果（已空闲足够久则不再等待）
+        wait_s = THOUGHT_DELAY_MS / 1000.0 - bus.idle_s()
+        if wait_s > 0:
+            await asyncio.sleep(wait_s)
+        try:
+            resp: AnalyzeResp = await task
+            yield sse_format("done", {**resp.dict(), "stream_stats": bus.stats()})
+        except Exception as e:
+            yield sse_format("done", {"error": str(e), "stream_stats": bus.stats()})
 
     return StreamingResponse(event_gen(), media_type="text/event-stream")
 
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+后台导出任务（DOCX / PDF / PPTX / HTML 渲染 + 上传）
+- 请求路径只负责构建 HTML 并 submit()，立刻返回 job_id；各格式在后台并行渲染、上传
+- 渲染（matplotlib 画图 + reportlab/docx/pptx 排版）是 CPU 密集且 pyplot 非线程安全 → 放进进程池并行；
+  进程池不可用（无法 fork / 函数不可 pickle / BrokenProcessPool）时退回当前进程串行渲染（全局锁保护 pyplot）
+- 上传是 I/O：在线程池中完成；每个格式独立成功/失败，互不影响
+- 任务状态保存在内存（按创建顺序淘汰），供 /beautify/jobs/{id}、/report/jobs/{id} 查询
+
+用法：
+    job_id = EXPORT_JOBS.submit(
+        {"html": html_bytes, "docx": (export_docx_from_md, (md, style)), ...},
+        upload=lambda fmt, data: {"url": ...},
+    )
+    EXPORT_JOBS.get(job_id)     # {"status": "running"|"done"|"partial"|"failed", "formats": {...}}
+
+环境变量：
+  EXPORT_WORKERS=4            # 进程池大小（同时渲染的格式数）；<=1 则不用进程池
+  EXPORT_JOBS_MAX=500         # 内存中保留的任务数
+"""
+from __future__ import annotations
+import os, time, uuid, pickle, threading, logging
+import datetime as dt
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+logger = logging.getLogger("export_jobs")
+
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS") or min(4, os.cpu_count() or 1))
+EXPORT_JOBS_MAX = int(os.getenv("EXPORT_JOBS_MAX") or 500)
+
+Render = Union[bytes, Tuple[Callable[..., bytes], tuple]]
+Upload = Callable[[str, bytes], Dict[str, Any]]
+
+_RENDER_LOCK = threading.Lock()     # 进程内兜底渲染时串行（pyplot 全局状态）
+
+
+def _render_inline(fn: Callable[..., bytes], args: tuple) -> bytes:
+    with _RENDER_LOCK:
+        return fn(*args)
+
+
+class ExportJobs:
+    def __init__(self, workers: int = EXPORT_WORKERS, max_jobs: int = EXPORT_JOBS_MAX) -> None:
+        self.workers = max(1, int(workers))
+        self.max_jobs = max(1, int(max_jobs))
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._done: Dict[str, threading.Event] = {}
+        self._threads = ThreadPoolExecutor(max_workers=self.workers * 2, thread_name_prefix="export")
+        self._procs: Optional[ProcessPoolExecutor] = None
+        self._procs_lock = threading.Lock()
+
+    # ---- 进程池 ----
+    def _pool(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers <= 1:
+            return None
+        with self._procs_lock:
+            if self._procs is None:
+                self._procs = ProcessPoolExecutor(max_workers=self.workers)
+            return self._procs
+
+    def _reset_pool(self) -> None:
+        with self._procs_lock:
+            if self._procs is not None:
+                self._procs.shutdown(wait=False, cancel_futures=True)
+            self._procs = None
+
+    def _render(self, fn: Callable[..., bytes], args: tuple) -> bytes:
+        pool = self._pool()
+        if pool is not None:
+            # 提交前先确认可 pickle：不可 pickle → 就地渲染；渲染函数自身的 TypeError/AttributeError 等原样上抛
+            try:
+                pickle.dumps((fn, args))
+            except Exception as e:
+                logger.info("[export] %s not picklable (%s), render inline", getattr(fn, "__name__", fn), e)
+                return _render_inline(fn, args)
+            try:
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool as e:
+                logger.warning("[export] process pool broken (%s), render inline", e)
+                self._reset_pool()
+            except pickle.PicklingError as e:
+                logger.warning("[export] pickling failed (%s), render inline", e)
+        return _render_inline(fn, args)
+
+    # ---- 任务 ----
+    def submit(self, renders: Dict[str, Render], upload: Upload, *,
+               job_id: Optional[str] = None, meta: Optional[Dict[str, Any]] = None) -> str:
+        job_id = job_id or str(uuid.uuid4())
+        job = {
+            "job_id": job_id,
+            "status": "running",
+            "created_at": dt.datetime.utcnow().isoformat(),
+            "finished_at": None,
+            "formats": {fmt: {"status": "queued"} for fmt in renders},
+            **(meta or {}),
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            self._done[job_id] = threading.Event()
+            while len(self._jobs) > self.max_jobs:
+                old, _ = self._jobs.popitem(last=False)
+                self._done.pop(old, None)
+        if not renders:
+            self._finish(job_id)
+            return job_id
+        remaining = [len(renders)]
+        for fmt, spec in renders.items():
+            self._threads.submit(self._run_one, job_id, fmt, spec, upload, remaining)
+        return job_id
+
+    def _run_one(self, job_id: str, fmt: str, spec: Render, upload: Upload, remaining: list) -> None:
+        t0 = time.perf_counter()
+        self._update(job_id, fmt, {"status": "rendering"})
+        try:
+            data = spec if isinstance(spec, (bytes, bytearray)) else self._render(*spec)
+            self._update(job_id, fmt, {"status": "uploading", "render_ms": round((time.perf_counter() - t0) * 1000, 1)})
+            info = upload(fmt, bytes(data)) or {}
+            self._update(job_id, fmt, {"status": "done", **info, "ms": round((time.perf_counter() - t0) * 1000, 1)})
+        except Exception as e:
+            logger.error("[export] %s %s failed: %s", job_id, fmt, e)
+            self._update(job_id, fmt, {"status": "error", "error": str(e)})
+        finally:
+            with self._lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._finish(job_id)
+
+    def _update(self, job_id: str, fmt: str, patch: Dict[str, Any]) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job["formats"][fmt].update(patch)
+
+    def _finish(self, job_id: str) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                states = [f["status"] for f in job["formats"].values()]
+                ok = sum(1 for s in states if s == "done")
+                job["status"] = "done" if ok == len(states) else ("partial" if ok else "failed")
+                job["finished_at"] = dt.datetime.utcnow().isoformat()
+            ev = self._done.get(job_id)
+        if ev is not None:
+            ev.set()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {**job, "formats": {k: dict(v) for k, v in job["formats"].items()}}
+
+    def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """阻塞等待任务结束（SSE 等需要在同一连接里拿到结果的场景）；超时返回当前快照"""
+        with self._lock:
+            ev = self._done.get(job_id)
+        if ev is not None:
+            ev.wait(timeout)
+        return self.get(job_id)
+
+
+def job_urls(job: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """任务快照 → 旧版同步接口的扁平字段：{fmt}_url / {fmt}_error（以及 file_name 等 meta）"""
+    out: Dict[str, Any] = {}
+    for fmt, st in ((job or {}).get("formats") or {}).items():
+        if st.get("url"):
+            out[f"{fmt}_url"] = st["url"]
+        elif st.get("error"):
+            out[f"{fmt}_error"] = st["error"]
+    if job and job.get("file_name"):
+        out["file_name"] = job["file_name"]
+    return out
+
+
+EXPORT_JOBS = ExportJobs()
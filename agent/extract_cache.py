@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+附件抽取缓存（freereports / budget 共用）
+- key = sha256(文件字节) + 抽取口径（kind）：同一份文件无论来自哪个 upload 记录、哪次请求，只抽取一次
+- 抽取结果（正文 text / 表格快照 tables_md / 表格 records 等 JSON 可序列化 dict）落本地磁盘，进程重启后仍命中
+- 按总字节数做 LRU 淘汰（读取时刷新 mtime；启动时按 mtime 重建顺序）；写入走临时文件 + os.replace，多进程安全
+- run_concurrently：多个附件的 下载+抽取 并发执行（PDF/Excel 解析多在 C 扩展中，线程即可并行 I/O 与大部分解析）
+
+环境变量：
+  EXTRACT_CACHE_DIR=<tmp>/report_extract_cache
+  EXTRACT_CACHE_MAX_MB=512
+  EXTRACT_WORKERS=4
+"""
+from __future__ import annotations
+import os, json, hashlib, tempfile, threading, logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, TypeVar
+
+logger = logging.getLogger("extract_cache")
+
+EXTRACT_CACHE_DIR = os.getenv("EXTRACT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "report_extract_cache")
+EXTRACT_CACHE_MAX_MB = float(os.getenv("EXTRACT_CACHE_MAX_MB") or 512)
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS") or 4)
+
+T = TypeVar("T")
+
+
+def content_key(data: bytes, kind: str = "") -> str:
+    h = hashlib.sha256(data or b"").hexdigest()
+    return f"{h}.{kind}" if kind else h
+
+
+class ExtractCache:
+    def __init__(self, root: str = EXTRACT_CACHE_DIR, max_bytes: int = int(EXTRACT_CACHE_MAX_MB * 1024 * 1024)) -> None:
+        self.root = root
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[str, int]" = OrderedDict()   # key -> 文件大小（最旧在前）
+        self._total = 0
+        self._stats = {"hits": 0, "misses": 0, "evicted": 0, "errors": 0}
+        self._inflight: Dict[str, threading.Lock] = {}
+        self._loaded = False
+
+    # ---- 磁盘布局：<root>/<key[:2]>/<key>.json ----
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key + ".json")
+
+    def _load_index(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        entries = []
+        try:
+            for sub in os.scandir(self.root):
+                if not sub.is_dir():
+                    continue
+                for f in os.scandir(sub.path):
+                    if f.name.endswith(".json"):
+                        st = f.stat()
+                        entries.append((st.st_mtime, f.name[:-5], st.st_size))
+        except FileNotFoundError:
+            return
+        for _mt, key, size in sorted(entries):
+            self._lru[key] = size
+            self._total += size
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            self._load_index()
+            if key not in self._lru:
+                return None
+            self._lru.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path, None)
+            return value
+        except FileNotFoundError:      # 被其它进程淘汰
+            with self._lock:
+                self._total -= self._lru.pop(key, 0)
+            return None
+        except Exception as e:
+            logger.warning("[extract_cache] read %s failed: %s", key, e)
+            with self._lock:
+                self._stats["errors"] += 1
+            return None
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False, default=str)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning("[extract_cache] write %s failed: %s", key, e)
+            with self._lock:
+                self._stats["errors"] += 1
+            return
+        with self._lock:
+            self._load_index()
+            self._total += size - self._lru.pop(key, 0)
+            self._lru[key] = size
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._total > self.max_bytes and len(self._lru) > 1:
+            old, size = self._lru.popitem(last=False)
+            self._total -= size
+            self._stats["evicted"] += 1
+            try:
+                os.remove(self._path(old))
+            except OSError:
+                pass
+
+    def get_or_extract(self, data: bytes, kind: str, extract: Callable[[bytes], Dict[str, Any]]) -> Dict[str, Any]:
+        """命中直接返回；未命中则抽取并写入。同一 key 并发请求只抽取一次"""
+        key = content_key(data, kind)
+        hit = self.get(key)
+        if hit is not None:
+            with self._lock:
+                self._stats["hits"] += 1
+            return hit
+        with self._lock:
+            gate = self._inflight.setdefault(key, threading.Lock())
+        with gate:
+            hit = self.get(key)
+            if hit is not None:
+                with self._lock:
+                    self._stats["hits"] += 1
+                return hit
+            try:
+                with self._lock:
+                    self._stats["misses"] += 1
+                value = extract(data)
+                self.put(key, value)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._load_index()
+            return {**self._stats, "entries": len(self._lru), "bytes": self._total,
+                    "max_bytes": self.max_bytes, "dir": self.root}
+
+
+EXTRACT_CACHE = ExtractCache()
+
+
+def run_concurrently(jobs: Sequence[Callable[[], T]], workers: int = EXTRACT_WORKERS) -> List[T]:
+    """并发执行无参任务，结果按输入顺序返回（单个任务就地执行）；任务异常会上抛，需要逐项容错的调用方在任务内自行捕获"""
+    if len(jobs) <= 1 or workers <= 1:
+        return [job() for job in jobs]
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as ex:
+        return list(ex.map(lambda job: job(), jobs))
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+PDF 字体注册表（进程级）
+- 首次使用时扫描一次字体目录（.ttf/.ttc），按文件名建立索引；不再每次导出都逐个探测系统路径
+- 家族名 → 文件：内置常见中文字体别名（Microsoft YaHei/SimHei/SimSun/DengXian/Noto/DejaVu），
+  其余按“去空格小写的文件名前缀”匹配，且只接受含中文字形的字体（避免 Inter/Arial 等拉丁字体抢先、中文成方框）；粗体按 <stem>bd / <stem>b / <stem>-bold 等约定配对
+- reportlab 注册（pdfmetrics.registerFont）按文件只做一次；resolve() 结果按偏好列表记忆化
+  → 重复导出 PDF 时字体解析为 O(1)，大体积 CJK TTF 只解析一次
+- describe()：供 /beautify/fonts 查看扫描目录、索引与已注册字体
+
+环境变量：
+  FONT_DIRS=/path/a:/path/b     # 额外字体目录（优先于系统目录）
+"""
+from __future__ import annotations
+import os, re, time, threading, logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.pdfbase.ttfonts import TTFont
+
+logger = logging.getLogger("font_registry")
+
+SYSTEM_FONT_DIRS = [
+    "C:/Windows/Fonts",
+    "/usr/share/fonts", "/usr/local/share/fonts",
+    os.path.expanduser("~/.fonts"), os.path.expanduser("~/.local/share/fonts"),
+    "/Library/Fonts", "/System/Library/Fonts",
+]
+
+# 家族别名 → (正文文件名 stem, 粗体 stem)；按顺序尝试
+FAMILY_ALIASES: Dict[str, List[Tuple[str, Optional[str]]]] = {
+    "microsoftyahei": [("msyh", "msyhbd")],
+    "yahei":          [("msyh", "msyhbd")],
+    "simhei":         [("simhei", None)],
+    "simsun":         [("simsun", None)],
+    "dengxian":       [("deng", "dengb")],
+    "deng":           [("deng", "dengb")],
+    "notosanssc":     [("notosanssc-regular", "notosanssc-bold"), ("notosanscjk-regular", "notosanscjk-bold")],
+    "notosanscjk":    [("notosanscjk-regular", "notosanscjk-bold"), ("notosanssc-regular", "notosanssc-bold")],
+    "notosanscjksc":  [("notosanscjk-regular", "notosanscjk-bold"), ("notosanssc-regular", "notosanssc-bold")],
+    "noto":           [("notosanscjk-regular", "notosanscjk-bold"), ("notosanssc-regular", "notosanssc-bold")],
+    "dejavusans":     [("dejavusans", "dejavusans-bold")],
+    "dejavu":         [("dejavusans", "dejavusans-bold")],
+}
+FALLBACK_FAMILIES = ["Microsoft YaHei", "Noto Sans SC", "SimHei", "DejaVu Sans"]
+_BOLD_SUFFIXES = ("bd", "b", "-bold", "bold", "_bold")
+_CJK_PROBE = ord("中")
+
+
+def _norm(name: str) -> str:
+    return re.sub(r"[\s_\-]+", "", (name or "").strip().strip("'\"").lower())
+
+
+class FontRegistry:
+    def __init__(self, dirs: Optional[Sequence[str]] = None) -> None:
+        extra = [d for d in (os.getenv("FONT_DIRS") or "").split(os.pathsep) if d]
+        self.dirs = list(dirs) if dirs is not None else extra + SYSTEM_FONT_DIRS
+        self._lock = threading.RLock()
+        self._files: Optional[Dict[str, str]] = None      # stem(lower) -> path
+        self._scan_ms = 0.0
+        self._registered: Dict[str, str] = {}              # path -> reportlab 字体名
+        self._failed: Dict[str, str] = {}                  # path -> 错误
+        self._resolved: Dict[Tuple[str, ...], Tuple[str, str]] = {}
+
+    # ---- 扫描（惰性，只做一次） ----
+    def _index(self) -> Dict[str, str]:
+        with self._lock:
+            if self._files is None:
+                t0 = time.perf_counter()
+                files: Dict[str, str] = {}
+                for d in self.dirs:
+                    if not os.path.isdir(d):
+                        continue
+                    for root, _dirs, names in os.walk(d):
+                        for fn in names:
+                            stem, ext = os.path.splitext(fn)
+                            if ext.lower() in (".ttf", ".ttc"):
+                                files.setdefault(stem.lower(), os.path.join(root, fn))   # 靠前目录优先
+                self._files = files
+                self._scan_ms = (time.perf_counter() - t0) * 1000
+                logger.info("[fonts] indexed %d font files in %.1f ms", len(files), self._scan_ms)
+            return self._files
+
+    def rescan(self) -> None:
+        with self._lock:
+            self._files = None
+            self._resolved.clear()
+        self._index()
+
+    # ---- 注册（每个文件只注册一次） ----
+    def _register(self, stem: Optional[str]) -> Optional[str]:
+        if not stem:
+            return None
+        path = self._index().get(stem.lower())
+        if not path:
+            return None
+        with self._lock:
+            if path in self._registered:
+                return self._registered[path]
+            if path in self._failed:
+                return None
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                pdfmetrics.registerFont(TTFont(name, path))
+                self._registered[path] = name
+                return name
+            except Exception as e:
+                self._failed[path] = str(e)
+                logger.warning("[fonts] register %s failed: %s", path, e)
+                return None
+
+    def _has_cjk(self, stem: str) -> bool:
+        """已注册字体是否含中文字形（按 cmap 探测“中”）"""
+        name = self._register(stem)
+        if not name:
+            return False
+        try:
+            return _CJK_PROBE in pdfmetrics.getFont(name).face.charToGlyph
+        except Exception:
+            return False
+
+    def _bold_stem(self, stem: str) -> Optional[str]:
+        files = self._index()
+        for suf in _BOLD_SUFFIXES:
+            if (stem + suf) in files:
+                return stem + suf
+        base = re.sub(r"[-_]?regular$", "", stem)
+        for suf in ("-bold", "bold", "_bold"):
+            if base != stem and (base + suf) in files:
+                return base + suf
+        return None
+
+    def _candidates(self, family: str) -> List[Tuple[str, Optional[str]]]:
+        key = _norm(family)
+        if not key:
+            return []
+        if key in FAMILY_ALIASES:
+            return FAMILY_ALIASES[key]
+        for alias, pairs in FAMILY_ALIASES.items():
+            if alias in key:
+                return pairs
+        # 未知家族：文件名（去分隔符）以家族名开头且含中文字形的，正文优先 regular；
+        # 都不含中文时返回空，由 resolve() 继续尝试下一个家族 / FALLBACK_FAMILIES
+        hits = sorted((s for s in self._index() if _norm(s).startswith(key)),
+                      key=lambda s: (0 if s.endswith("regular") or _norm(s) == key else 1, len(s)))
+        for s in hits:
+            if self._has_cjk(s):
+                return [(s, self._bold_stem(s))]
+        return []
+
+    def register_family(self, family: str) -> Tuple[Optional[str], Optional[str]]:
+        """注册某个家族的 Regular/Bold；返回 (regular, bold)，失败 (None, None)"""
+        for reg, bold in self._candidates(family):
+            r = self._register(reg)
+            if r:
+                b = self._register(bold) if bold else None
+                return r, (b or r)
+        return None, None
+
+    def resolve(self, families: Sequence[str]) -> Tuple[str, str]:
+        """
+        按偏好顺序解析 PDF 正文/粗体字体（记忆化）；都不可用时回退常见中文字体 → CID 字体 STSong-Light
+        """
+        key = tuple(families)
+        with self._lock:
+            hit = self._resolved.get(key)
+        if hit:
+            return hit
+        out: Optional[Tuple[str, str]] = None
+        for fam in list(families) + FALLBACK_FAMILIES:
+            r, b = self.register_family(fam)
+            if r:
+                out = (r, b or r)
+                break
+        if out is None:
+            try:
+                pdfmetrics.registerFont(UnicodeCIDFont("STSong-Light"))
+                out = ("STSong-Light", "STSong-Light")
+            except Exception:
+                out = ("Helvetica", "Helvetica-Bold")
+        with self._lock:
+            self._resolved[key] = out
+        return out
+
+    def describe(self) -> Dict[str, Any]:
+        files = self._index()
+        with self._lock:
+            return {
+                "dirs": [d for d in self.dirs if os.path.isdir(d)],
+                "scan_ms": round(self._scan_ms, 1),
+                "files": len(files),
+                "aliases": {a: [p[0] for p in pairs if p[0] in files] for a, pairs in FAMILY_ALIASES.items()},
+                "registered": sorted(self._registered.values()),
+                "failed": dict(self._failed),
+                "resolved": {", ".join(k) or "(default)": list(v) for k, v in self._resolved.items()},
+                "available": sorted(files)[:500],
+            }
+
+
+FONTS = FontRegistry()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+ARIMA 基线预测（simulation_v2）
+- 单次拟合：一次 fit 同时得到点预测与 95% 区间（get_forecast），不再 forecast + get_forecast 各拟合一遍
+- 拟合缓存：key = sha256(输入序列) + order；缓存拟合参数与各 horizon 的预测结果
+  同一历史序列（仅冲击/情景变化）重复 run 时完全跳过拟合；horizon 变化时用已缓存参数 filter，无需再优化
+- 多个 Y 指标的拟合分发到进程池并行（statsmodels 拟合是 CPU 密集且持有 GIL）
+
+环境变量：
+  ARIMA_WORKERS=4          # 进程池大小；<=1 则在当前进程串行拟合
+  ARIMA_CACHE_MAX=256      # 缓存的 (序列, order) 条目数
+"""
+from __future__ import annotations
+import os, hashlib, threading, logging, warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from statsmodels.tsa.arima.model import ARIMA
+
+logger = logging.getLogger("forecasting")
+
+ARIMA_WORKERS = int(os.getenv("ARIMA_WORKERS") or min(4, os.cpu_count() or 1))
+ARIMA_CACHE_MAX = int(os.getenv("ARIMA_CACHE_MAX") or 256)
+
+Order = Tuple[int, int, int]
+
+_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()   # key -> {"params": [...], "fc": {periods: result}}
+_CACHE_LOCK = threading.Lock()
+_STATS = {"hits": 0, "param_hits": 0, "fits": 0, "fallbacks": 0}
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_LOCK = threading.Lock()
+
+
+def series_key(series: Sequence[float], order: Order) -> str:
+    arr = np.asarray(series, dtype=np.float64)
+    h = hashlib.sha256(arr.tobytes())
+    h.update(repr(tuple(int(x) for x in order)).encode())
+    return h.hexdigest()
+
+
+def _flat(series: Sequence[float], periods: int) -> Dict[str, Any]:
+    """拟合失败时的平滑外推（与原实现一致）"""
+    last = float(series[-1]) if len(series) else 0.0
+    return {"pred": [last] * periods, "lower95": [last] * periods, "upper95": [last] * periods,
+            "fallback": True}
+
+
+def _fit_job(series: List[float], order: Order, periods: int,
+             params: Optional[List[float]] = None) -> Dict[str, Any]:
+    """
+    进程池 worker：params 为空时拟合一次；否则用已知参数 filter（不做优化）。
+    返回 {"pred","lower95","upper95","params"}；失败返回平滑外推。
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            model = ARIMA(np.asarray(series, dtype=np.float64), order=tuple(order))
+            res = model.filter(np.asarray(params)) if params is not None else model.fit()
+            fc = res.get_forecast(steps=periods)
+            pred = np.asarray(fc.predicted_mean, dtype=float).tolist()
+            ci = np.asarray(fc.conf_int(alpha=0.05), dtype=float)
+        return {
+            "pred": pred,
+            "lower95": ci[:, 0].tolist(),
+            "upper95": ci[:, 1].tolist(),
+            "params": np.asarray(res.params, dtype=float).tolist(),
+        }
+    except Exception:
+        return _flat(series, periods)
+
+
+def _cache_get(key: str, periods: int) -> Tuple[Optional[Dict[str, Any]], Optional[List[float]]]:
+    with _CACHE_LOCK:
+        ent = _CACHE.get(key)
+        if ent is None:
+            return None, None
+        _CACHE.move_to_end(key)
+        hit = ent["fc"].get(periods)
+        if hit is not None:
+            _STATS["hits"] += 1
+            return hit, ent["params"]
+        return None, ent["params"]
+
+
+def _cache_put(key: str, periods: int, result: Dict[str, Any]) -> None:
+    if result.get("fallback") or not result.get("params"):
+        return
+    with _CACHE_LOCK:
+        ent = _CACHE.setdefault(key, {"params": result["params"], "fc": {}})
+        ent["fc"][periods] = result
+        _CACHE.move_to_end(key)
+        while len(_CACHE) > ARIMA_CACHE_MAX:
+            _CACHE.popitem(last=False)
+
+
+def _public(result: Dict[str, Any]) -> Dict[str, Any]:
+    out = {"pred": list(result["pred"]), "lower95": list(result["lower95"]), "upper95": list(result["upper95"])}
+    out["cached"] = bool(result.get("_cached"))
+    return out
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _POOL
+    if ARIMA_WORKERS <= 1:
+        return None
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=ARIMA_WORKERS)
+        return _POOL
+
+
+def _reset_pool() -> None:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+
+def forecast_many(series_map: Dict[str, Sequence[float]], order: Order, periods: int) -> Dict[str, Dict[str, Any]]:
+    """
+    批量基线预测：{name: series} → {name: {"pred","lower95","upper95","cached"}}
+    缓存命中直接返回；其余在进程池中并行拟合（单个任务时就地计算，避免进程开销）。
+    """
+    order = tuple(int(x) for x in order)  # type: ignore[assignment]
+    out: Dict[str, Dict[str, Any]] = {}
+    todo: List[Tuple[str, str, List[float], Optional[List[float]]]] = []
+    for name, seq in series_map.items():
+        seq = [float(x) for x in (seq or [])]
+        if not seq:
+            out[name] = _public(_flat(seq, periods))
+            continue
+        key = series_key(seq, order)
+        hit, params = _cache_get(key, periods)
+        if hit is not None:
+            out[name] = _public({**hit, "_cached": True})
+            continue
+        todo.append((name, key, seq, params))
+
+    if not todo:
+        return out
+
+    results: Dict[str, Dict[str, Any]] = {}
+    pool = _get_pool() if len(todo) > 1 else None
+    if pool is not None:
+        try:
+            futs = {name: pool.submit(_fit_job, seq, order, periods, params) for name, _k, seq, params in todo}
+            for name, f in futs.items():
+                results[name] = f.result()
+        except Exception as e:   # 进程池异常（如 BrokenProcessPool）→ 重建并串行兜底
+            logger.warning("[forecasting] process pool failed, fallback to inline: %s", e)
+            _reset_pool()
+            results = {}
+    for name, _k, seq, params in todo:
+        if name not in results:
+            results[name] = _fit_job(seq, order, periods, params)
+
+    for name, key, seq, params in todo:
+        r = results[name]
+        with _CACHE_LOCK:
+            if r.get("fallback"):
+                _STATS["fallbacks"] += 1
+            elif params is not None:
+                _STATS["param_hits"] += 1
+            else:
+                _STATS["fits"] += 1
+        _cache_put(key, periods, r)
+        out[name] = _public(r)
+    return out
+
+
+def forecast_one(series: Sequence[float], order: Order, periods: int) -> Dict[str, Any]:
+    return forecast_many({"_": series}, order, periods)["_"]
+
+
+def forecast_stats() -> Dict[str, Any]:
+    with _CACHE_LOCK:
+        return {**_STATS, "entries": len(_CACHE), "workers": ARIMA_WORKERS}
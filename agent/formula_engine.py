@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+公式引擎（metric_formulas.compute 的安全求值，dataquery / deepanalysis 共用）
+- 每个表达式只解析一次：ast.parse → 白名单校验 → 编译为嵌套闭包，按表达式文本 LRU 缓存
+- 白名单：数字常量、变量名、+ - * / // % **、一元 +/-、abs/min/max/round/sqrt 调用（仅位置参数，参数个数编译期校验，min/max 至少 2 个）；
+  其它任何语法（属性访问、下标、lambda、推导式、关键字参数……）在编译期拒绝，不再走 eval
+- 标量求值与 Python 原语义一致（除零抛 ZeroDivisionError，调用方按异常处理）
+- 批量求值：变量传入等长数组（跨期/跨公司/情景），一次向量化计算（numpy；未安装时逐行退化）
+
+用法：
+    f = compile_formula("net_profit / equity")
+    f({"net_profit": 12.0, "equity": 100.0})                 # -> 0.12
+    f.eval_batch({"net_profit": [12, 15], "equity": [100, 120]})   # -> array([0.12, 0.125])
+"""
+from __future__ import annotations
+import ast, math, operator
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:   # 无 numpy：eval_batch 逐行计算
+    np = None
+
+FORMULA_CACHE_MAX = 2048
+MAX_POW_EXPONENT = 64          # 防止 10 ** 10**9 之类的超大幂运算
+
+
+class FormulaError(ValueError):
+    """公式不合法（语法/非白名单节点/未知函数）或缺少变量"""
+
+
+def _is_arr(x: Any) -> bool:
+    return np is not None and isinstance(x, np.ndarray)
+
+
+def _pow(a, b):
+    if not _is_arr(b) and abs(b) > MAX_POW_EXPONENT:
+        raise FormulaError(f"指数过大: {b}")
+    if _is_arr(b) and b.size and float(np.nanmax(np.abs(b))) > MAX_POW_EXPONENT:
+        raise FormulaError("指数过大")
+    return a ** b
+
+
+def _vmin(*xs):
+    if any(_is_arr(x) for x in xs):
+        return np.minimum.reduce([np.asarray(x, dtype=float) for x in xs])
+    return min(*xs)
+
+
+def _vmax(*xs):
+    if any(_is_arr(x) for x in xs):
+        return np.maximum.reduce([np.asarray(x, dtype=float) for x in xs])
+    return max(*xs)
+
+
+FUNCS: Dict[str, Callable[..., Any]] = {
+    "abs":   lambda x: np.abs(x) if _is_arr(x) else abs(x),
+    "min":   _vmin,
+    "max":   _vmax,
+    "round": lambda x, n=0: np.round(x, int(n)) if _is_arr(x) else round(x, int(n)),
+    "sqrt":  lambda x: np.sqrt(x) if _is_arr(x) else math.sqrt(x),
+}
+
+# 参数个数 (最少, 最多)；min/max 至少 2 个：单参数在批量求值时会沿批次轴归约，跨期/跨情景混算
+_ARITY: Dict[str, Tuple[int, Optional[int]]] = {
+    "abs": (1, 1), "min": (2, None), "max": (2, None), "round": (1, 2), "sqrt": (1, 1),
+}
+
+_BINOPS: Dict[type, Callable[[Any, Any], Any]] = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+    ast.Pow: _pow,
+}
+_UNARY: Dict[type, Callable[[Any], Any]] = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+Env = Mapping[str, Any]
+
+
+def _compile(node: ast.AST, names: List[str]) -> Callable[[Env], Any]:
+    if isinstance(node, ast.Expression):
+        return _compile(node.body, names)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        val = node.value
+        return lambda env: val
+    if isinstance(node, ast.Name):
+        name = node.id
+        if name in FUNCS:
+            raise FormulaError(f"函数 {name} 不能作为变量使用")
+        if name not in names:
+            names.append(name)
+
+        def _var(env: Env, name=name):
+            try:
+                return env[name]
+            except KeyError:
+                raise FormulaError(f"未知变量: {name}") from None
+        return _var
+    if isinstance(node, ast.BinOp) and type(node.op) in _BINOPS:
+        op = _BINOPS[type(node.op)]
+        left, right = _compile(node.left, names), _compile(node.right, names)
+        return lambda env: op(left(env), right(env))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY:
+        op1 = _UNARY[type(node.op)]
+        operand = _compile(node.operand, names)
+        return lambda env: op1(operand(env))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        fn = FUNCS.get(node.func.id)
+        if fn is None:
+            raise FormulaError(f"不允许的函数: {node.func.id}")
+        lo, hi = _ARITY[node.func.id]
+        if len(node.args) < lo or (hi is not None and len(node.args) > hi) \
+                or any(isinstance(a, ast.Starred) for a in node.args):
+            want = f"{lo}" if lo == hi else (f"{lo}~{hi}" if hi else f"至少{lo}")
+            raise FormulaError(f"{node.func.id} 需要{want}个参数（不支持 *args），实际 {len(node.args)} 个")
+        args = [_compile(a, names) for a in node.args]
+        return lambda env: fn(*[a(env) for a in args])
+    raise FormulaError(f"不允许的表达式: {type(node).__name__}")
+
+
+class Formula:
+    __slots__ = ("expr", "names", "_fn")
+
+    def __init__(self, expr: str, names: Tuple[str, ...], fn: Callable[[Env], Any]) -> None:
+        self.expr, self.names, self._fn = expr, names, fn
+
+    def __call__(self, env: Env) -> float:
+        """标量求值：除零等按 Python 语义抛异常"""
+        return float(self._fn(env))
+
+    def eval_batch(self, columns: Mapping[str, Sequence[float]]) -> Any:
+        """
+        向量化求值：columns = {变量: 等长序列}；返回等长 float 数组（numpy）或 list。
+        除零/非法值得到 inf/nan（不抛异常），便于整批计算后再筛选。
+        """
+        if np is None:
+            n = len(next(iter(columns.values()))) if columns else 1
+            out = []
+            for i in range(n):
+                try:
+                    out.append(self({k: float(v[i]) for k, v in columns.items()}))
+                except (ArithmeticError, ValueError):
+                    out.append(float("nan"))
+            return out
+        env = {k: np.asarray(v, dtype=float) for k, v in columns.items()}
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            res = self._fn(env)
+        n = max((a.shape[0] for a in env.values() if a.ndim), default=1)
+        return np.broadcast_to(np.asarray(res, dtype=float), (n,)).copy()
+
+    def __repr__(self) -> str:
+        return f"Formula({self.expr!r}, names={self.names})"
+
+
+@lru_cache(maxsize=FORMULA_CACHE_MAX)
+def compile_formula(expr: str) -> Formula:
+    text = (expr or "").strip()
+    if not text:
+        raise FormulaError("公式为空")
+    try:
+        tree = ast.parse(text, mode="eval")
+    except SyntaxError as e:
+        raise FormulaError(f"公式语法错误: {e.msg}") from None
+    names: List[str] = []
+    fn = _compile(tree, names)
+    return Formula(text, tuple(names), fn)
+
+
+def evaluate(expr: str, env: Env) -> float:
+    """一次性标量求值（编译结果已缓存）"""
+    return compile_formula(expr)(env)
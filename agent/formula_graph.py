@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+指标公式依赖图（metric_formulas → DAG）
+- 全部启用公式一次加载（由 CatalogCache 定期刷新），每个指标一个节点：variables 的取值（基础指标名）即依赖边
+- 构建时：每条公式的 compute 按变量引用做拓扑排序并预编译（formula_engine），不再逐轮“试算直到不动点”；
+  指标间依赖用 DFS 做环检测，环与不合法公式记录在 describe() 中
+- closure(target)：目标指标的传递依赖集合（含中间派生指标）→ 调用方一次 in.() 批量取数
+- resolve(targets, known)：已取到值的指标视为叶子（与“先直取、再公式”一致），其余按依赖拓扑序逐个求值；
+  因此任意深度的派生指标只需一次 financial_metrics 往返
+
+用法：
+    g = FormulaGraph(rows)                    # rows: metric_formulas 行（同名按 is_standard.desc,id.desc 取第一条）
+    need = g.closure("净资产收益率")           # {"净资产收益率", "净利润", "净资产", ...}
+    vals = g.resolve(["净资产收益率"], known)   # known: {指标名: 直取值}
+"""
+from __future__ import annotations
+import json
+from typing import Any, Dict, FrozenSet, Iterable, List, Mapping, Optional, Tuple
+
+try:
+    from agent.formula_engine import FormulaError, compile_formula
+except ImportError:
+    from formula_engine import FormulaError, compile_formula
+
+
+def formula_parts(row: Mapping[str, Any]) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """metric_formulas 行 → (variables, compute)；兼容 JSON 字符串列"""
+    variables = row.get("variables") or {}
+    compute = row.get("compute") or {}
+    if isinstance(variables, str):
+        try: variables = json.loads(variables)
+        except Exception: variables = {}
+    if isinstance(compute, str):
+        try: compute = json.loads(compute)
+        except Exception: compute = {}
+    return (variables if isinstance(variables, dict) else {}), (compute if isinstance(compute, dict) else {})
+
+
+def compute_order(compute: Mapping[str, str], inputs: Iterable[str]) -> List[str]:
+    """
+    compute 各步按引用关系拓扑排序（同层保持原书写顺序）。
+    表达式引用了既非输入变量、也非其它 compute 键的名字，或 compute 之间成环 → FormulaError
+    """
+    inputs = set(inputs)
+    keys = list(compute.keys())
+    deps: Dict[str, set] = {}
+    for k in keys:
+        names = compile_formula(str(compute[k])).names
+        d = set()
+        for n in names:
+            if n in compute and n != k:
+                d.add(n)
+            elif n not in inputs:
+                raise FormulaError(f"{k} 引用了未定义的变量: {n}")
+        deps[k] = d
+    order: List[str] = []
+    done: set = set()
+    while len(order) < len(keys):
+        ready = [k for k in keys if k not in done and deps[k] <= done]
+        if not ready:
+            raise FormulaError(f"compute 存在循环引用: {[k for k in keys if k not in done]}")
+        order.extend(ready)
+        done.update(ready)
+    return order
+
+
+class FormulaNode:
+    __slots__ = ("metric", "row", "variables", "compute", "order", "result_var", "deps", "error")
+
+    def __init__(self, metric: str, row: Dict[str, Any]) -> None:
+        self.metric, self.row = metric, row
+        self.variables, self.compute = formula_parts(row)
+        self.deps: Tuple[str, ...] = tuple(dict.fromkeys(str(v) for v in self.variables.values() if v))
+        # 结果变量沿用约定：compute 的最后一个键
+        self.result_var: Optional[str] = list(self.compute.keys())[-1] if self.compute else None
+        self.order: List[str] = []
+        self.error: Optional[str] = None
+        try:
+            if not self.result_var:
+                raise FormulaError("公式未提供结果变量")
+            self.order = compute_order(self.compute, self.variables.keys())
+        except FormulaError as e:
+            self.error = str(e)
+
+    def evaluate(self, values: Mapping[str, float]) -> Optional[float]:
+        """values: {基础指标名: 值}；缺依赖 / 公式不合法 / 除零等返回 None"""
+        if self.error:
+            return None
+        env: Dict[str, float] = {}
+        for var_key, base_cn in self.variables.items():
+            v = values.get(str(base_cn))
+            if v is None:
+                return None
+            env[var_key] = v
+        try:
+            for k in self.order:
+                env[k] = compile_formula(str(self.compute[k]))(env)
+            return float(env[self.result_var])
+        except (ArithmeticError, ValueError, TypeError):
+            return None
+
+
+class FormulaGraph:
+    def __init__(self, rows: Iterable[Mapping[str, Any]] = ()) -> None:
+        self.nodes: Dict[str, FormulaNode] = {}
+        for r in rows or []:
+            name = str(r.get("metric_name") or "").strip()
+            if name and name not in self.nodes:          # 行已按 is_standard.desc,id.desc 排好
+                self.nodes[name] = FormulaNode(name, dict(r))
+        self._closure: Dict[str, FrozenSet[str]] = {}
+        self.cycles: List[List[str]] = self._find_cycles()
+
+    # ---- 构建期：环检测 ----
+    def _find_cycles(self) -> List[List[str]]:
+        WHITE, GRAY, BLACK = 0, 1, 2
+        color = {m: WHITE for m in self.nodes}
+        cycles: List[List[str]] = []
+        for root in self.nodes:
+            if color[root] != WHITE:
+                continue
+            stack: List[Tuple[str, int]] = [(root, 0)]
+            path: List[str] = [root]
+            color[root] = GRAY
+            while stack:
+                m, i = stack[-1]
+                deps = self.nodes[m].deps
+                if i < len(deps):
+                    stack[-1] = (m, i + 1)
+                    d = deps[i]
+                    if d not in self.nodes:
+                        continue
+                    if color[d] == GRAY:
+                        cycles.append(path[path.index(d):] + [d])
+                    elif color[d] == WHITE:
+                        color[d] = GRAY
+                        stack.append((d, 0))
+                        path.append(d)
+                else:
+                    color[m] = BLACK
+                    stack.pop()
+                    path.pop()
+        return cycles
+
+    # ---- 查询期 ----
+    def get(self, metric: str) -> Optional[FormulaNode]:
+        return self.nodes.get(metric)
+
+    def closure(self, metric: str) -> FrozenSet[str]:
+        """目标指标及其全部传递依赖（快照不可变，结果按指标缓存）"""
+        hit = self._closure.get(metric)
+        if hit is not None:
+            return hit
+        seen = {metric}
+        todo = [metric]
+        while todo:
+            node = self.nodes.get(todo.pop())
+            for d in (node.deps if node else ()):
+                if d not in seen:
+                    seen.add(d)
+                    todo.append(d)
+        out = frozenset(seen)
+        self._closure[metric] = out
+        return out
+
+    def plan(self, targets: Iterable[str], known: Mapping[str, Any] = {}) -> List[str]:
+        """
+        需要用公式求值的指标，按依赖拓扑序（依赖在前）。已知值的指标是叶子、不展开；
+        在剩余子图上成环的指标不进入计划（无法求值）
+        """
+        order: List[str] = []
+        state: Dict[str, int] = {}      # 1=访问中 2=完成 3=环上/不可求
+
+        def expandable(m: str) -> bool:
+            return not state.get(m) and m not in known and m in self.nodes
+
+        for t in targets:
+            if not expandable(t):
+                continue
+            state[t] = 1
+            stack: List[Tuple[str, int]] = [(t, 0)]
+            while stack:
+                m, i = stack[-1]
+                deps = self.nodes[m].deps
+                if i < len(deps):
+                    stack[-1] = (m, i + 1)
+                    d = deps[i]
+                    if state.get(d) == 1:          # 回边：环上的指标全部放弃
+                        names = [s[0] for s in stack]
+                        for sm in names[names.index(d):]:
+                            state[sm] = 3
+                    elif expandable(d):
+                        state[d] = 1
+                        stack.append((d, 0))
+                    continue
+                stack.pop()
+                if state[m] == 1:
+                    state[m] = 2
+                    order.append(m)
+        return [m for m in order if state.get(m) == 2]
+
+    def resolve(self, targets: Iterable[str], known: Mapping[str, Any]) -> Dict[str, float]:
+        """known 之外的目标/中间指标按拓扑序求值；返回 known ∪ 可求出的派生值"""
+        values: Dict[str, float] = {}
+        for k, v in known.items():
+            if v is not None:
+                try:
+                    values[k] = float(v)
+                except (TypeError, ValueError):
+                    pass
+        for m in self.plan(list(targets), values):
+            v = self.nodes[m].evaluate(values)
+            if v is not None:
+                values[m] = v
+        return values
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "nodes": len(self.nodes),
+            "cycles": [" → ".join(c) for c in self.cycles],
+            "invalid": {m: n.error for m, n in self.nodes.items() if n.error},
+        }
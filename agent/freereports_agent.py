@@ -24,6 +24,7 @@ from typing import Optional, List, Dict, Any, Tuple
 
 from fastapi import FastAPI, HTTPException, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from supabase import create_client, Client
 
@@ -56,6 +57,15 @@ def dbg(msg: str, *args):
             print("DBG " + msg, flush=True)
 
 
+try:
+    from agent.extract_cache import EXTRACT_CACHE, run_concurrently
+except ImportError:
+    from extract_cache import EXTRACT_CACHE, run_concurrently
+try:
+    from agent.ts_analytics import prepare_metrics_frame, summarize_timeseries   # 与 report_agent 同口径
+except ImportError:
+    from ts_analytics import prepare_metrics_frame, summarize_timeseries
+
 # ===== 环境变量 =====
 SUPABASE_URL = os.getenv("SUPABASE_URL") or os.getenv("VITE_SUPABASE_URL", "")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("VITE_SUPABASE_SERVICE_ROLE_KEY", "")
@@ -141,10 +151,6 @@ def _norm_quarter(v) -> str:
         n = 1
     return f"Q{n}"
 
-def _period_key(y: int, q: str) -> int:
-    mp = {"Q1":1, "Q2":2, "Q3":3, "Q4":4}
-    return int(y) * 10 + mp.get(q.upper(), 1)
-
 def _parse_meta_period(meta: dict):
     """接受多种写法:
        meta = { company_name, period: {start:{year,quarter}, end:{year,quarter}} }
@@ -180,14 +186,7 @@ def fetch_financial_metrics_all(company: str, start: tuple, end: tuple) -> pd.Da
     df = pd.DataFrame(getattr(res, "data", []) or [])
     if df.empty:
         return df
-    df["year"] = df["year"].astype(int)
-    df["quarter"] = df["quarter"].apply(_norm_quarter)
-    df["pkey"] = df.apply(lambda r: _period_key(int(r["year"]), r["quarter"]), axis=1)
-    p_start = _period_key(start[0], start[1])
-    p_end   = _period_key(end[0],   end[1])
-    df = df[(df["pkey"] >= p_start) & (df["pkey"] <= p_end)].copy()
-    df.sort_values(["metric_name", "year", "quarter"], inplace=True)
-    return df
+    return prepare_metrics_frame(df, start, end)
 
 FOCUS_MARKERS = re.compile(r"(特别关注|重点关注|重点|尤其|着重|优先)", re.I)
 DEFAULT_KPIS = ["营业收入", "归母净利润", "毛利率", "净利率", "ROE", "资产负债率", "经营活动现金流净额"]
@@ -211,32 +210,6 @@ def _extract_focus_metrics(text: str, limit: int = 8) -> List[str]:
                 focused.append(c)
     return focused[:limit]
 
-def summarize_timeseries(df: pd.DataFrame) -> dict:
-    """与 report_agent 同口径：输出每个指标的时序 + 最新值/环比/同比"""
-    out = {}
-    if df.empty:
-        return out
-    for name, grp in df.groupby("metric_name"):
-        grp = grp.sort_values(["year", "pkey"])
-        series = [
-            {
-                "period": f"{int(r.year)}{r.quarter}",
-                "year": int(r.year),
-                "quarter": r.quarter,
-                "value": r.metric_value,
-            }
-            for r in grp.itertuples(index=False)
-        ]
-        last = series[-1]["value"] if series else None
-        prev = series[-2]["value"] if len(series) > 1 else None
-        yoy = None
-        if len(series) >= 5:
-            base = series[-5]["value"]
-            yoy = None if base in (None, 0) else (last - base) / base
-        qoq = None if prev in (None, 0) else (last - prev) / prev
-        out[name] = {"series": series, "latest": last, "qoq": qoq, "yoy": yoy}
-    return out
-
 def _safe_text(s: str, max_len: int = 12000) -> str:
     if not s: return ""
     s = re.sub(r"\s+", " ", s).strip()
@@ -323,14 +296,58 @@ def _dq_call_one(task):
         return {"need_clarification": True, "ask": f"dataquery异常: {e}"}
 
 
+def _dq_batch_item(task: Dict[str,Any]) -> Optional[Dict[str,Any]]:
+    """显式 (公司/指标/年/季) 任务 → /metrics/query_batch 的 item；参数缺失或年份非数字返回 None（走逐条）"""
+    if not (task.get("company") and task.get("metric") and task.get("year") and task.get("quarter")):
+        return None
+    try:
+        year = int(task.get("year"))
+    except (TypeError, ValueError):
+        return None
+    return {
+        "company": task.get("company"),
+        "metric": task.get("metric"),
+        "year": year,
+        "quarter": (f"Q{task['quarter']}" if isinstance(task.get("quarter"), int) else str(task.get("quarter"))),
+    }
+
+
+def _dq_call_query_batch(items: List[Dict[str,Any]]) -> Optional[List[Dict[str,Any]]]:
+    """_dq_batch_item 组好的 items 走 /metrics/query_batch，一次请求；失败返回 None 由调用方回退逐条"""
+    url = f"{DATAQUERY_BASE_URL}/metrics/query_batch"
+    try:
+        r = requests.post(url, headers=_dq_headers(), json={"items": items}, timeout=60)
+        print(f"[freereports] DQ_BATCH ← {r.status_code} n={len(items)}", flush=True)
+        if not r.ok:
+            return None
+        results = (r.json() or {}).get("results") or []
+        return results if len(results) == len(items) else None
+    except Exception as e:
+        print(f"DBG DQ_BATCH_ERR {e}", flush=True)
+        return None
+
+
 def _dq_call_batch(tasks: List[Dict[str,Any]], max_workers: int = 8) -> List[Dict[str,Any]]:
     from concurrent.futures import ThreadPoolExecutor, as_completed
     if not tasks: return []
     out = [None]*len(tasks)
-    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as ex:
-        futs = {ex.submit(_dq_call_one, t): i for i, t in enumerate(tasks)}
-        for f in as_completed(futs):
-            out[futs[f]] = f.result()
+
+    # 1) 参数齐全且合法的任务合并成一次批量请求；个别不合法的不影响其余任务
+    items = [_dq_batch_item(t) for t in tasks]
+    explicit = [i for i, it in enumerate(items) if it is not None]
+    if explicit:
+        batch = _dq_call_query_batch([items[i] for i in explicit])
+        if batch is not None:
+            for i, res in zip(explicit, batch):
+                out[i] = res
+
+    # 2) 其余（需 LLM 解析 question 的、参数不合法的）及批量失败的，逐条并发
+    rest = [i for i in range(len(tasks)) if out[i] is None]
+    if rest:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(rest))) as ex:
+            futs = {ex.submit(_dq_call_one, tasks[i]): i for i in rest}
+            for f in as_completed(futs):
+                out[futs[f]] = f.result()
     return out
 
 def _build_db_metrics_from_dq(dq_results: List[Dict[str,Any]]) -> Dict[str, Any]:
@@ -828,6 +845,45 @@ def build_messages(payload: NLGeneratePayload,
 
 
 
+# 抽取口径版本：修改 _extract_by_type 的输出时递增，使旧缓存自然失效
+EXTRACT_KIND = "freereport.v1"
+
+def _extract_by_type(b: bytes, name: str, mime: str) -> Dict[str, str]:
+    text, tables_md = "", ""
+    ext = _guess_ext(name)
+    if "pdf" in mime or ext == ".pdf":
+        text = _extract_pdf(b)
+    elif "word" in mime or ext == ".docx":
+        text = _extract_docx(b)
+    elif "excel" in mime or ext in (".xlsx", ".xls"):
+        text, tables_md = _extract_xlsx(b)
+    elif "csv" in mime or ext == ".csv":
+        text, tables_md = _extract_csv(b)
+    elif "html" in mime or ext == ".html":
+        text = _extract_html(b)
+    else:
+        text = _extract_txt(b)
+    return {"text": text, "tables_md": tables_md}
+
+def _read_upload_row(r: Dict[str, Any]) -> Dict[str, Any]:
+    """下载 + 按内容哈希缓存的抽取（同一文件字节只解析一次）"""
+    bucket = r.get("bucket") or "uploads"
+    path   = r.get("path") or ""
+    name   = r.get("file_name") or path.split("/")[-1]
+    mime   = (r.get("mime_type") or "").lower()
+    b = _download_object(bucket, path)
+    ext = _guess_ext(name)
+    # 抽取方式由 mime/扩展名决定，一并计入 key
+    kind = f"{EXTRACT_KIND}.{re.sub(r'[^a-z0-9]+', '_', mime or ext or 'bin')}"
+    got = EXTRACT_CACHE.get_or_extract(b, kind, lambda data: _extract_by_type(data, name, mime)) if b else {}
+    return {
+        "file_name": name,
+        "mime_type": mime or ext,
+        "size_kb": round(len(b)/1024),
+        "text": got.get("text") or "",
+        "tables_md": got.get("tables_md") or ""
+    }
+
 def _read_attachments(file_ids: List[str]) -> List[Dict[str, Any]]:
     if not file_ids: return []
     try:
@@ -836,41 +892,18 @@ def _read_attachments(file_ids: List[str]) -> List[Dict[str, Any]]:
     except Exception as e:
         raise HTTPException(400, f"读取上传清单失败: {e}")
 
-    out = []
-    for r in rows:
-        bucket = r.get("bucket") or "uploads"
-        path   = r.get("path") or ""
-        name   = r.get("file_name") or path.split("/")[-1]
-        mime   = (r.get("mime_type") or "").lower()
-        b = _download_object(bucket, path)
-        text, tables_md = "", ""
-
-        ext = _guess_ext(name)
-        if "pdf" in mime or ext == ".pdf":
-            text = _extract_pdf(b)
-        elif "word" in mime or ext == ".docx":
-            text = _extract_docx(b)
-        elif "excel" in mime or ext in (".xlsx",".xls"):
-            csv_text, md_head = _extract_xlsx(b)
-            text = csv_text
-            tables_md = md_head
-        elif "csv" in mime or ext == ".csv":
-            csv_text, md_head = _extract_csv(b)
-            text = csv_text
-            tables_md = md_head
-        elif "html" in mime or ext == ".html":
-            text = _extract_html(b)
-        else:
-            text = _extract_txt(b)
-
-        out.append({
-            "file_name": name,
-            "mime_type": mime or ext,
-            "size_kb": round(len(b)/1024),
-            "text": text,
-            "tables_md": tables_md
-        })
-    return out
+    # 多个附件并发 下载+抽取，结果保持清单顺序；单个附件失败不影响其它附件
+    def _one(r: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return _read_upload_row(r)
+        except Exception as e:
+            name = r.get("file_name") or (r.get("path") or "").split("/")[-1]
+            logger.warning("read attachment %s failed: %s", name, e)
+            return {"file_name": name, "mime_type": (r.get("mime_type") or "").lower(), "size_kb": 0,
+                    "text": "", "tables_md": "", "error": str(e)}
+
+    return run_concurrently([(lambda r=r: _one(r)) for r in rows])
+
 def _read_single_upload_text(file_id: str) -> Tuple[str, str, str]:
     """
     返回: (text, tables_md, file_name)
@@ -882,149 +915,159 @@ def _read_single_upload_text(file_id: str) -> Tuple[str, str, str]:
         rows = getattr(res, "data", []) or []
         if not rows:
             return "", "", ""
-        r = rows[0]
-        bucket = r.get("bucket") or "uploads"
-        path   = r.get("path") or ""
-        name   = r.get("file_name") or path.split("/")[-1]
-        mime   = (r.get("mime_type") or "").lower()
-        b = _download_object(bucket, path)
-
-        text, tables_md = "", ""
-        ext = _guess_ext(name)
-        if "pdf" in mime or ext == ".pdf":
-            text = _extract_pdf(b)
-        elif "word" in mime or ext == ".docx":
-            text = _extract_docx(b)
-        elif "excel" in mime or ext in (".xlsx", ".xls"):
-            csv_text, md_head = _extract_xlsx(b); text = csv_text; tables_md = md_head
-        elif "csv" in mime or ext == ".csv":
-            csv_text, md_head = _extract_csv(b); text = csv_text; tables_md = md_head
-        elif "html" in mime or ext == ".html":
-            text = _extract_html(b)
-        else:
-            text = _extract_txt(b)
-        return text, tables_md, name
+        got = _read_upload_row(rows[0])
+        return got["text"], got["tables_md"], got["file_name"]
     except Exception:
         return "", "", ""
 
 @app.get("/health")
 def health():
-    return {"ok": True, "time": dt.datetime.utcnow().isoformat()}
+    return {"ok": True, "time": dt.datetime.utcnow().isoformat(), "extract_cache": EXTRACT_CACHE.stats()}
 
-@app.post("/freereport/generate")
-def freereport_generate(payload: NLGeneratePayload, _=Depends(auth_check)):
+# ===== 生成流水线（/freereport/generate 与 /freereport/stream 共用） =====
+def _fetch_db_metrics(meta: dict) -> dict:
+    company, start, end = _parse_meta_period(meta)
+    if not (company and start and end):
+        return {}
     try:
-        # 1) 附件
-        attachments = _read_attachments(payload.selected_file_ids or [])
-
-        # 2) 可选外部检索
-        web_snippets = []
-        if payload.allow_web_search and (GOOGLE_API_KEY and GOOGLE_CSE_ID):
-            q = re.sub(r"\s+"," ", payload.prompt)[:100]
-            web_snippets = google_cse_search(q, count=5)
-
-        # 3) 组装消息并调用 LLM
-        # 2.5) 解析模板：优先用 payload.template_text；否则按 template_file_id 读取
-        template_text = (payload.template_text or "").strip()
-        if (not template_text) and payload.template_file_id:
-            t_text, _, _ = _read_single_upload_text(payload.template_file_id)
-            template_text = t_text or ""
-
-        # meta 透传（可空）
-        # 解析 meta（company + 起止年季）；拉财务指标
-        meta = payload.meta or {}
-        company, start, end = _parse_meta_period(meta)
+        df = fetch_financial_metrics_all(company, start, end)
+        db_metrics = summarize_timeseries(df)
+        logger.info("metrics rows=%s, metrics_found=%s",
+                    (0 if df is None else df.shape[0]), len(db_metrics))
+        return db_metrics
+    except Exception as e:
+        logger.warning("fetch metrics failed: %s", e)
+        return {}
 
-        db_metrics = {}
-        if company and start and end:
-            try:
-                df = fetch_financial_metrics_all(company, start, end)
-                db_metrics = summarize_timeseries(df)
-                logger.info("metrics rows=%s, metrics_found=%s", 
-                            (0 if df is None else df.shape[0]), len(db_metrics))
-            except Exception as e:
-                logger.warning("fetch metrics failed: %s", e)
-                db_metrics = {}
-
-        # —— NEW：先用 LLM 生成“结构化计划”（公司 / 年季列表 / 指标列表）
-        plan = _llm_plan_from_query(payload.prompt or "", attachments, meta, max_metrics=12)
-        print(f"[freereports] plan_company={plan.get('company')} "
-            f"periods={[(p['year'],p['quarter']) for p in plan.get('periods',[])]} "
-            f"metrics={plan.get('metrics')}", flush=True)
-
-        # 若 periods 为空（如“行业现状”这种），允许回退到 meta.period.end 的单期；仍然不读附件里的旧期
-        periods = plan.get("periods") or []
-        if (not periods) and meta:
-            _, _, end = _parse_meta_period(meta)
-            if end:
-                periods = [{"year": int(end[0]), "quarter": int(end[1][-1])}]
-
-        # 组装任务（period × metric）—— 显式给 company/year/quarter；同时携带原问题作为上下文提示
-        tasks = []
-        for p in periods or []:
-            for m in (plan.get("metrics") or []):
-                tasks.append({
-                    "metric": m,
-                    "company": plan.get("company"),
-                    "year": p["year"],
-                    "quarter": p["quarter"],
-                    "question": payload.prompt or ""
-                })
-
-        # 如果还是空（极端情况），至少给每个指标一条“让 dataquery 自解”的任务
-        if not tasks:
-            for m in (plan.get("metrics") or []):
-                tasks.append({"metric": m, "question": payload.prompt or ""})
-
-        print("[freereports] tasks=", json.dumps(tasks, ensure_ascii=False)[:400], flush=True)
-
-
-
-
-        dbg("TASKS %d → %s", len(tasks), ", ".join([f"{t.get('metric')}@{t.get('company')}:{t.get('year')}Q{t.get('quarter')}" for t in tasks]))
-        print("[freereports] tasks=", json.dumps(tasks, ensure_ascii=False)[:400], flush=True)  # <== 新增
-        dq_results = _dq_call_batch(tasks, max_workers=8)
-        dq_db_metrics = _build_db_metrics_from_dq(dq_results)
-
-        print(f"[freereports] dq_results_count={len([r for r in dq_results if r])} "
-      f"dq_hits={list((dq_db_metrics or {}).keys())[:8]}", flush=True)  # <== 新增
-
-        # 合并：dataquery 优先；没有再用直接查表的汇总
-        merged_db_metrics = dict(db_metrics or {})
-        merged_db_metrics.update(dq_db_metrics or {})
-
-        # 命中统计 + 可读的“数据要点表”
-        try:
-            ok_cnt = sum(1 for r in (dq_results or []) if r and (r.get("value") or r.get("formula") or (r.get("indicator_card") or {}).get("current") is not None))
-            keys = ", ".join(list((dq_db_metrics or {}).keys())[:20])
-            logger.info("dataquery url=%s tasks=%d ok=%d keys=[%s]", DATAQUERY_BASE_URL, len(tasks), ok_cnt, keys)
-        except Exception:
-            pass
+def _submit_input_stages(pool: ThreadPoolExecutor, payload: NLGeneratePayload) -> Dict[Any, str]:
+    """互不依赖的输入阶段并行提交：附件抽取 / 外部检索 / 模板读取 / 财务指标；返回 {future: stage}"""
+    meta = payload.meta or {}
+    futs = {pool.submit(_read_attachments, payload.selected_file_ids or []): "attachments"}
+    if payload.allow_web_search and (GOOGLE_API_KEY and GOOGLE_CSE_ID):
+        q = re.sub(r"\s+"," ", payload.prompt)[:100]
+        futs[pool.submit(google_cse_search, q, 5)] = "web"
+    # 解析模板：优先用 payload.template_text；否则按 template_file_id 读取
+    if not (payload.template_text or "").strip() and payload.template_file_id:
+        futs[pool.submit(_read_single_upload_text, payload.template_file_id)] = "template"
+    futs[pool.submit(_fetch_db_metrics, meta)] = "metrics"
+    return futs
+
+def _collect_inputs(done: Dict[str, Any], payload: NLGeneratePayload) -> Dict[str, Any]:
+    t = done.get("template")
+    return {
+        "attachments": done.get("attachments") or [],
+        "web_snippets": done.get("web") or [],
+        "template_text": (payload.template_text or "").strip() or ((t[0] if t else "") or ""),
+        "db_metrics": done.get("metrics") or {},
+    }
 
-        metrics_table_md = _db_metrics_to_markdown(merged_db_metrics)
-        series_md = _db_metrics_to_series_markdown(merged_db_metrics)
-        periods_covered = _collect_period_labels(merged_db_metrics)
+def _plan_tasks(payload: NLGeneratePayload, attachments: List[Dict[str, Any]], meta: dict) -> Tuple[dict, list, list]:
+    # —— 先用 LLM 生成“结构化计划”（公司 / 年季列表 / 指标列表）
+    plan = _llm_plan_from_query(payload.prompt or "", attachments, meta, max_metrics=12)
+    print(f"[freereports] plan_company={plan.get('company')} "
+        f"periods={[(p['year'],p['quarter']) for p in plan.get('periods',[])]} "
+        f"metrics={plan.get('metrics')}", flush=True)
+
+    # 若 periods 为空（如“行业现状”这种），允许回退到 meta.period.end 的单期；仍然不读附件里的旧期
+    periods = plan.get("periods") or []
+    if (not periods) and meta:
+        _, _, end = _parse_meta_period(meta)
+        if end:
+            periods = [{"year": int(end[0]), "quarter": int(end[1][-1])}]
+
+    # 组装任务（period × metric）—— 显式给 company/year/quarter；同时携带原问题作为上下文提示
+    tasks = []
+    for p in periods or []:
+        for m in (plan.get("metrics") or []):
+            tasks.append({
+                "metric": m,
+                "company": plan.get("company"),
+                "year": p["year"],
+                "quarter": p["quarter"],
+                "question": payload.prompt or ""
+            })
+
+    # 如果还是空（极端情况），至少给每个指标一条“让 dataquery 自解”的任务
+    if not tasks:
+        for m in (plan.get("metrics") or []):
+            tasks.append({"metric": m, "question": payload.prompt or ""})
+
+    dbg("TASKS %d → %s", len(tasks), ", ".join([f"{t.get('metric')}@{t.get('company')}:{t.get('year')}Q{t.get('quarter')}" for t in tasks]))
+    print("[freereports] tasks=", json.dumps(tasks, ensure_ascii=False)[:400], flush=True)
+    return plan, periods, tasks
+
+def _query_and_merge(tasks: list, db_metrics: dict) -> Tuple[list, dict, dict]:
+    dq_results = _dq_call_batch(tasks, max_workers=8)
+    dq_db_metrics = _build_db_metrics_from_dq(dq_results)
+
+    print(f"[freereports] dq_results_count={len([r for r in dq_results if r])} "
+      f"dq_hits={list((dq_db_metrics or {}).keys())[:8]}", flush=True)
+
+    # 合并：dataquery 优先；没有再用直接查表的汇总
+    merged_db_metrics = dict(db_metrics or {})
+    merged_db_metrics.update(dq_db_metrics or {})
+
+    # 命中统计
+    try:
+        ok_cnt = sum(1 for r in (dq_results or []) if r and (r.get("value") or r.get("formula") or (r.get("indicator_card") or {}).get("current") is not None))
+        keys = ", ".join(list((dq_db_metrics or {}).keys())[:20])
+        logger.info("dataquery url=%s tasks=%d ok=%d keys=[%s]", DATAQUERY_BASE_URL, len(tasks), ok_cnt, keys)
+    except Exception:
+        pass
+    return dq_results, dq_db_metrics, merged_db_metrics
+
+def _final_messages(payload: NLGeneratePayload, inputs: Dict[str, Any], meta: dict,
+                    periods: list, merged_db_metrics: dict) -> Tuple[List[Dict[str, str]], str]:
+    metrics_table_md = _db_metrics_to_markdown(merged_db_metrics)
+    series_md = _db_metrics_to_series_markdown(merged_db_metrics)
+    periods_covered = _collect_period_labels(merged_db_metrics)
+
+    print("DBG METRICS_TABLE_BEGIN", flush=True)
+    print(metrics_table_md or "(empty)", flush=True)
+    if DEBUG and metrics_table_md:
+        dbg("METRICS_TABLE\n%s", metrics_table_md)
+    print("DBG METRICS_TABLE_END", flush=True)
+
+    # 只用合并后的指标（含 dataquery 返回）；planned_periods 为 plan/展开得到的 periods（可能为空）
+    messages = build_messages(
+        payload, inputs["attachments"], inputs["web_snippets"], inputs["template_text"], meta,
+        db_metrics=merged_db_metrics,
+        series_markdown=series_md,
+        planned_periods=periods or [],
+        periods_covered=periods_covered
+    )
+    return messages, metrics_table_md
 
-        # planned_periods 就是我们前面 plan/展开得到的 periods（可能为空）
-        planned = periods or []
+def _result_payload(content: str, inputs: Dict[str, Any], tasks: list, dq_db_metrics: dict, metrics_table_md: str) -> Dict[str, Any]:
+    return {
+        "job_id": str(uuid.uuid4()),
+        "generated_at": dt.datetime.utcnow().isoformat(),
+        "content_md": content,
+        "attachments_used": [a["file_name"] for a in inputs["attachments"]],
+        "web_refs": inputs["web_snippets"],
+        "debug": {
+            "dq_tasks": tasks,
+            "dq_hits": list((dq_db_metrics or {}).keys()),
+            "metrics_table": metrics_table_md[:4000]  # 防止过长
+        }
+    }
 
-        print("DBG METRICS_TABLE_BEGIN", flush=True)             # <== 新增
-        print(metrics_table_md or "(empty)", flush=True)         # <== 新增
-        if DEBUG and metrics_table_md:
-            dbg("METRICS_TABLE\n%s", metrics_table_md)
-        print("DBG METRICS_TABLE_END", flush=True)    
+@app.post("/freereport/generate")
+def freereport_generate(payload: NLGeneratePayload, _=Depends(auth_check)):
+    try:
+        meta = payload.meta or {}
 
+        # 1) 附件 / 外部检索 / 模板 / 财务指标 并行
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            futs = _submit_input_stages(pool, payload)
+            inputs = _collect_inputs({stage: f.result() for f, stage in futs.items()}, payload)
 
-        # 组装消息并调用 LLM（把 merged_db_metrics 传进去）
-        # 只用合并后的指标（含 dataquery 返回）
-        messages = build_messages(
-            payload, attachments, web_snippets, template_text, meta,
-            db_metrics=merged_db_metrics,
-            series_markdown=series_md,
-            planned_periods=planned,
-            periods_covered=periods_covered
-                )   
+        # 2) 结构化计划 → dataquery 批量取数 → 合并
+        plan, periods, tasks = _plan_tasks(payload, inputs["attachments"], meta)
+        dq_results, dq_db_metrics, merged_db_metrics = _query_and_merge(tasks, inputs["db_metrics"])
 
+        # 3) 组装消息并调用 LLM（把 merged_db_metrics 传进去）
+        messages, metrics_table_md = _final_messages(payload, inputs, meta, periods, merged_db_metrics)
         resp = llm.chat.completions.create(
             model=OPENAI_MODEL,
             messages=messages,
@@ -1033,22 +1076,98 @@ def freereport_generate(payload: NLGeneratePayload, _=Depends(auth_check)):
 
         content = resp.choices[0].message.content or ""
         content = normalize_echarts_blocks(content)
-
-        return {
-            "job_id": str(uuid.uuid4()),
-            "generated_at": dt.datetime.utcnow().isoformat(),
-            "content_md": content,
-            "attachments_used": [a["file_name"] for a in attachments],
-            "web_refs": web_snippets,
-            "debug": {
-                "dq_tasks": tasks,
-                "dq_hits": list((dq_db_metrics or {}).keys()),
-                "metrics_table": metrics_table_md[:4000]  # 防止过长
-            }
-        }
+        return _result_payload(content, inputs, tasks, dq_db_metrics, metrics_table_md)
 
     except HTTPException:
         raise
     except Exception as e:
         logger.error("freereport failed: %s\n%s", e, traceback.format_exc())
         raise HTTPException(500, f"freereport_failed: {e}")
+
+@app.post("/freereport/stream")
+def freereport_stream(payload: NLGeneratePayload, _=Depends(auth_check)):
+    """
+    SSE 版 /freereport/generate：event: progress|chunk|result|error|done
+    - 附件抽取 / 外部检索 / 模板 / 财务指标 并行执行，哪个先完成先推送 progress
+    - 最终 LLM 以 stream=True 调用，token 到达即推送 chunk；结束时推送与 generate 相同结构的 result
+    """
+    def _sse(event_type: str, data: dict | str) -> str:
+        payload_ = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+        return f"event: {event_type}\n" + f"data: {payload_}\n\n"
+
+    def _gen():
+        meta = payload.meta or {}
+        t0 = dt.datetime.utcnow()
+        elapsed = lambda: int((dt.datetime.utcnow() - t0).total_seconds() * 1000)
+        try:
+            # 1) 并行输入阶段
+            yield _sse("progress", {"stage": "inputs", "status": "start"})
+            done: Dict[str, Any] = {}
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                futs = _submit_input_stages(pool, payload)
+                for f in as_completed(futs):
+                    stage = futs[f]
+                    try:
+                        done[stage] = f.result()
+                        info: Dict[str, Any] = {"stage": stage, "status": "done", "elapsed_ms": elapsed()}
+                        if stage in ("attachments", "web", "metrics"):
+                            info["count"] = len(done[stage] or [])
+                    except HTTPException as e:
+                        if stage == "attachments":
+                            raise
+                        info = {"stage": stage, "status": "error", "error": str(e.detail)}
+                    except Exception as e:
+                        if stage == "attachments":
+                            raise
+                        info = {"stage": stage, "status": "error", "error": str(e)}
+                    yield _sse("progress", info)
+            inputs = _collect_inputs(done, payload)
+
+            # 2) 计划 + dataquery
+            yield _sse("progress", {"stage": "plan", "status": "start"})
+            plan, periods, tasks = _plan_tasks(payload, inputs["attachments"], meta)
+            yield _sse("progress", {"stage": "plan", "status": "done", "elapsed_ms": elapsed(),
+                                    "company": plan.get("company"), "metrics": plan.get("metrics") or [],
+                                    "tasks": len(tasks)})
+            dq_results, dq_db_metrics, merged_db_metrics = _query_and_merge(tasks, inputs["db_metrics"])
+            yield _sse("progress", {"stage": "dataquery", "status": "done", "elapsed_ms": elapsed(),
+                                    "hits": list((dq_db_metrics or {}).keys())[:20]})
+
+            # 3) 流式生成
+            messages, metrics_table_md = _final_messages(payload, inputs, meta, periods, merged_db_metrics)
+            yield _sse("progress", {"stage": "llm", "status": "start", "elapsed_ms": elapsed()})
+            parts: List[str] = []
+            first_token_ms = None
+            stream = llm.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                temperature=0.2,
+                stream=True,
+            )
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta and getattr(delta, "content", None):
+                    if first_token_ms is None:
+                        first_token_ms = elapsed()
+                    parts.append(delta.content)
+                    yield _sse("chunk", {"text": delta.content})
+
+            content = normalize_echarts_blocks("".join(parts))
+            result = _result_payload(content, inputs, tasks, dq_db_metrics, metrics_table_md)
+            result["timing"] = {"first_token_ms": first_token_ms, "total_ms": elapsed()}
+            yield _sse("result", result)
+        except HTTPException as e:
+            yield _sse("error", {"message": str(e.detail)})
+        except Exception as e:
+            logger.error("freereport stream failed: %s\n%s", e, traceback.format_exc())
+            yield _sse("error", {"message": f"freereport_failed: {e}"})
+        finally:
+            yield _sse("done", {})
+
+    return StreamingResponse(
+        _gen(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+    )
@@ -38,6 +38,21 @@ from datetime import datetime
 p = find_dotenv(".env.backend", raise_error_if_not_found=False)
 if p: load_dotenv(p, override=True)
 
+# 确定性提示词的 LLM 响应缓存（兼容 `uvicorn agent.intent_agent:app` 与 agent/ 目录内启动）
+try:
+    from agent.llm_cache import LLM_CACHE
+except ImportError:
+    from llm_cache import LLM_CACHE
+
+try:
+    from agent.task_dag import TaskDAG
+except ImportError:
+    from task_dag import TaskDAG
+try:
+    from agent.llm_gateway import get_gateway
+except ImportError:
+    from llm_gateway import get_gateway
+
 # 开发期直通（前端传不传 token 都能用）
 DEV_BYPASS_AUTH = (os.getenv("DEV_BYPASS_AUTH") or "true").lower() == "true"
 
@@ -56,6 +71,7 @@ LLM_BASE  = _get_env(
 )
 LLM_KEY   = _get_env(["OPENAI_API_KEY","OPEN_API_KEY","LLM_API_KEY"])
 LLM_MODEL = _get_env(["OPENAI_MODEL","LLM_MODEL"], "gpt-4o")
+_LLM = get_gateway(LLM_BASE, LLM_KEY or "")
 
 # 下游服务地址/令牌（给 auto_execute 用）
 DATA_AGENT_BASE_URL = _get_env(["DATA_AGENT_BASE_URL","DATA_API"], "http://127.0.0.1:18010")
@@ -65,6 +81,8 @@ DEEP_AGENT_TOKEN    = _get_env(["DEEP_AGENT_TOKEN","ROE_AGENT_TOKEN"], "")
 
 DOWNSTREAM_TIMEOUT  = int(_get_env(["DEEP_AGENT_TIMEOUT","DOWNSTREAM_TIMEOUT","INTENT_DOWNSTREAM_TIMEOUT"], "180"))
 THOUGHT_DELAY_MS = int(_get_env(["THOUGHT_DELAY_MS"], "600"))
+# route/stream 任务 DAG 的并发上限（下钻/取数/政策/行业检索节点）
+INTENT_DAG_CONCURRENCY = int(_get_env(["INTENT_DAG_CONCURRENCY"], "4"))
 GOOGLE_API_KEY = _get_env(["GOOGLE_API_KEY", "CSE_API_KEY"])
 GOOGLE_CSE_ID  = _get_env(["GOOGLE_CSE_ID",  "CSE_ID"])
 # 对话上下文轮数（默认3，可通过环境变量 DIALOG_CONTEXT_ROUNDS 调整）
@@ -309,7 +327,7 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
 
         # 1) 起手：意图识别（统一走 send_progress，保证 seq 递增）
         yield send_progress("意图识别中", "start", group="意图")
-        thought = await asyncio.to_thread(gen_stream_thought, "意图识别", req.question, None, None)
+        thought = await agen_stream_thought("意图识别", req.question, None, None)
         yield send_progress("思考·意图识别", "doing", group="意图", detail=thought)
 
         intent = None
@@ -323,9 +341,7 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
             intent = "deep"
             modes = req.selected_modes or req.modes or ["dimension"]
         else:
-            llm_intent_obj = await asyncio.to_thread(
-                llm_classify_intent, req.question, (req.dialog_context or {}).get("turns")
-            )
+            llm_intent_obj = await allm_classify_intent(req.question, (req.dialog_context or {}).get("turns"))
 
             if llm_intent_obj:
                 intent = (llm_intent_obj.get("intent") or "other").lower()
@@ -334,7 +350,7 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
                 intent = "dataquery"; modes = []
 
         # —— 新增：基于已识别的意图再给一次明确话术
-        thought2 = await asyncio.to_thread(gen_stream_thought, "意图识别", req.question, intent, modes)
+        thought2 = await agen_stream_thought("意图识别", req.question, intent, modes)
         yield send_progress("思考·意图识别", "doing", group="意图", detail=thought2)
 
         tag = to_cn_modes(modes) if (intent == "deep") else to_cn_intent(intent)
@@ -376,7 +392,7 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
         quarter = _norm_quarter(quarter)
 
         # 阶段话术 & 编排开始
-        plan_thought = await asyncio.to_thread(gen_stream_thought, "计划", req.question, intent, modes)
+        plan_thought = await agen_stream_thought("计划", req.question, intent, modes)
         yield send_progress("编排中", "start", group="编排")
         # 在编排组内记录思考文本
         yield send_progress("思考·执行计划", "doing", group="编排", detail=plan_thought)
@@ -442,8 +458,23 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
 
             yield send_progress("编排完成", "done", group="编排", detail=f"{len(tasks)} 个取数子任务")
 
-            # ===== ③ 执行 dataquery，带超时/失败收尾，不让前端一直转圈 =====
+            # ===== ③ 执行 dataquery（各期并发），带超时/失败收尾，不让前端一直转圈 =====
             cards, period_labels = [], []
+            dag = TaskDAG(max_concurrency=INTENT_DAG_CONCURRENCY)
+            dq_nodes: List[Tuple[str, str, str, Any, str]] = []   # (node, comp, metr, label, step_tip)
+
+            def _dq_node(step_tip: str, payload: Dict[str, Any]):
+                async def run(emit, _deps):
+                    emit(send_progress(step_tip, "start", group="执行"))
+                    try:
+                        data = await asyncio.to_thread(call_dataquery, payload)
+                    except Exception:
+                        emit(send_progress(step_tip, "done", group="执行", detail="失败/超时"))
+                        raise
+                    emit(send_progress(step_tip, "done",  group="执行"))
+                    return data
+                return run
+
             for i, t in enumerate(tasks, 1):
                 p = t.get("params") or {}
                 comp = p.get("company") or company
@@ -455,14 +486,16 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
                     period_labels.append(label)
 
                 step_tip = f"正在读取 {comp or '-'} {y or '-'}{q or ''} 的 {metr or '-'} 数据"
-                yield send_progress(step_tip, "start", group="执行")
-
                 payload = {"question": req.question, "company": comp, "metric": metr, "year": y, "quarter": q, "scenario": "actual"}
-                try:
-                    data = await asyncio.to_thread(call_dataquery, payload)
-                except Exception as e:
+                dq_nodes.append((dag.add(f"dq:{i}", _dq_node(step_tip, payload)), comp, metr, label, step_tip))
+
+            async for ev in dag.stream():
+                yield ev
+
+            for (n, comp, metr, label, _tip) in dq_nodes:
+                e = dag.errors.get(n)
+                if e is not None:
                     # 超时/网络/下游异常：立刻收尾并给出可执行提示
-                    yield send_progress(step_tip, "done", group="执行", detail="失败/超时")
                     final_merged = {
                         "need_clarification": True,
                         "ask": "查询超时或数据源无响应。请确认：公司、指标、时间（如 2025 年 Q1），或稍后重试。",
@@ -473,9 +506,8 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
                     yield f"event: done\ndata:{json.dumps(final_merged, ensure_ascii=False)}\n\n"
                     return
 
-                card = (data or {}).get("indicator_card")
+                card = (dag.results.get(n) or {}).get("indicator_card")
                 if card: cards.append(card)
-                yield send_progress(step_tip, "done",  group="执行")
 
             # ===== ④ 聚合与总结 =====
             summary = ""
@@ -501,8 +533,8 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
             final_merged = {
                 "indicator_card": None,
                 "resolved": {
-                    "company": (plan.get("context") or {}).get("company") or company,
-                    "metric":  (plan.get("context") or {}).get("metric")  or metric,
+                    "company": company,
+                    "metric":  metric,
                     "multi_tasks": True,
                     "periods": [p for p in period_labels if p],
                     "modes": [],
@@ -659,7 +691,12 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
                 period_to_mode_summaries: Dict[str, List[Tuple[str, str]]] = {}
                 added_card_labels: set = set()
 
-                for i, t in enumerate(tasks, 1):
+                # === 任务 DAG：各 (期次×模式) 下钻并发执行；政策/行业检索只依赖起始期的下钻结果；
+                #     “合并与总结”话术预先生成。事件按产生顺序交错推送，结果按声明顺序合并 ===
+                dag = TaskDAG(max_concurrency=INTENT_DAG_CONCURRENCY)
+                deep_nodes: List[Tuple[str, str]] = []   # (node_name, period_label)
+
+                def _deep_node(t: Dict[str, Any]):
                     params = t.get("params") or {}
                     y = params.get("year") or year
                     q = _norm_quarter(params.get("quarter") or quarter)
@@ -670,31 +707,97 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
                     mode_list = params.get("modes") or (req.selected_modes or req.modes) or ["dimension"]
                     mode_one = (mode_list[0] if isinstance(mode_list, list) and mode_list else "dimension")
                     mode_cn  = MODE_CN.get(mode_one, mode_one)
-
                     label = f"{y}{q}" if y and q else ""
-                    if label:
-                        period_labels.append(label)
 
-                    step_tip = f"子任务执行·下钻（{mode_cn}）：{comp or '-'} {y or '-'}{q or ''} 的 {metr or '-'}"
-                    # 第一人称小字（传入当前模式，便于话术贴合）
-                    sub_thought = await asyncio.to_thread(gen_stream_thought, "下钻执行", req.question, intent, [mode_one])
-                    yield send_progress(step_tip, "start", group="执行", detail=sub_thought)
+                    async def run(emit, _deps):
+                        step_tip = f"子任务执行·下钻（{mode_cn}）：{comp or '-'} {y or '-'}{q or ''} 的 {metr or '-'}"
+                        # 第一人称小字（传入当前模式，便于话术贴合）
+                        sub_thought = await agen_stream_thought("下钻执行", req.question, intent, [mode_one])
+                        emit(send_progress(step_tip, "start", group="执行", detail=sub_thought))
+
+                        final_one = None
+                        payload = {
+                            "question": req.question,
+                            "company": comp, "metric": metr, "year": y, "quarter": q,
+                            "modes":   [mode_one],           # ← 每次只跑一种模式
+                            "skip_policy": True
+                        }
+                        try:
+                            async for ev, data in _proxy_deep_stream(client, deep_url, headers, payload):
+                                if ev == "progress":
+                                    # 仍透传子层进度（与上层 start/done 互补）
+                                    emit(f"event: progress\ndata:{data}\n\n")
+                                elif ev == "done":
+                                    final_one = json.loads(data)
+                        finally:
+                            emit(f"event: progress\ndata:{json.dumps({'step':step_tip,'status':'done'})}\n\n")
+                        return {"label": label, "mode_cn": mode_cn, "final": final_one}
+
+                    return label, run
 
-                    final_one = None
-                    payload = {
-                        "question": req.question,
-                        "company": comp, "metric": metr, "year": y, "quarter": q,
-                        "modes":   [mode_one],           # ← 每次只跑一种模式
-                        "skip_policy": True
-                    }
+                for i, t in enumerate(tasks, 1):
+                    label, fn = _deep_node(t)
+                    if label:
+                        period_labels.append(label)
+                    deep_nodes.append((dag.add(f"deep:{i}", fn), label))
 
-                    async for ev, data in _proxy_deep_stream(client, deep_url, headers, payload):
-                        if ev == "progress":
-                            # 仍透传子层进度（与上层 start/done 互补）
-                            yield f"event: progress\ndata:{data}\n\n"
-                        elif ev == "done":
-                            final_one = json.loads(data)
+                # 单次政策检索 / 行业宏观增强（仅一次，取时间范围的起始期）
+                def _parse(p):
+                    m = re.match(r"^(\d{4})(Q[1-4])$", str(p))
+                    if not m: return None, None
+                    return int(m.group(1)), m.group(2)
 
+                base_ctx = (plan.get("context") or {})
+                comp0 = base_ctx.get("company") or company
+                metr0 = base_ctx.get("metric")  or metric
+                start_label = sorted(period_labels)[0] if period_labels else ""
+                # 政策/行业检索需要下钻文本猜行业：只等待起始期的下钻节点
+                enrich_deps = [n for (n, lbl) in deep_nodes if lbl == start_label] if start_label else [n for (n, _l) in deep_nodes]
+
+                def _sections_of(dep_results: Dict[str, Any]) -> List[Dict[str, Any]]:
+                    secs = []
+                    for n in enrich_deps:
+                        fo = ((dep_results.get(n) or {}).get("final"))
+                        if isinstance(fo, dict):
+                            secs.extend(fo.get("sections") or [])
+                    return secs
+
+                def _sync_progress(*a, **k):
+                    # 工作线程内的进度：交给事件循环线程生成（seq 单调）并入队
+                    dag.emit_from_thread(lambda: send_progress(*a, **k))
+
+                async def _policy(emit, deps):
+                    if not period_labels:
+                        return []
+                    start_y, start_q = _parse(start_label)
+                    # 你也可以只跑起始期；如需扩大召回，可把 end 也跑一遍
+                    if not (start_y and start_q):
+                        return []
+                    secs = _sections_of(deps); n0 = len(secs)
+                    await asyncio.to_thread(run_policy_once_at_intent, _sync_progress, secs, comp0, metr0, start_y, start_q)
+                    return secs[n0:]
+
+                async def _enrich(emit, deps):
+                    # 用起始期作为检索标签；如需放大召回也可用最后一期
+                    yy, qq = _parse(start_label) if period_labels else (year, quarter)
+                    secs = _sections_of(deps); n0 = len(secs)
+                    await asyncio.to_thread(run_industry_or_macro_enrichment_at_intent, _sync_progress, secs, comp0, metr0, yy, qq)
+                    return secs[n0:]
+
+                async def _merge_thought(emit, _deps):
+                    return await agen_stream_thought("合并与总结", req.question, intent, modes)
+
+                dag.add("policy", _policy, deps=enrich_deps)
+                dag.add("enrich", _enrich, deps=enrich_deps)
+                dag.add("merge_thought", _merge_thought)
+
+                async for ev in dag.stream():
+                    yield ev
+
+                # 按声明顺序合并（与并发完成顺序无关，输出稳定）
+                for (n, _lbl) in deep_nodes:
+                    r = dag.results.get(n) or {}
+                    final_one, label, mode_cn = r.get("final"), r.get("label") or "", r.get("mode_cn") or ""
                     if isinstance(final_one, dict):
                         # 每个期次只保存一次指标卡（避免同一期多模式重复）
                         if label and (label not in added_card_labels) and final_one.get("indicator_card"):
@@ -715,50 +818,9 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
                                 s2["title"] = f"[{mode_cn}] {ttitle}"
                             flat_sections.append(s2)
 
-                    yield f"event: progress\ndata:{json.dumps({'step':step_tip,'status':'done'})}\n\n"
-
-            # 单次政策检索（仅一次，取时间范围的起止期）
-            
-            try:
-                if period_labels:
-                    # 解析起止期
-                    def _parse(p):
-                        import re
-                        m = re.match(r"^(\d{4})(Q[1-4])$", str(p))
-                        if not m: return None, None
-                        return int(m.group(1)), m.group(2)
-
-                    start_y, start_q = _parse(sorted(period_labels)[0])
-                    # 你也可以只跑起始期；如需扩大召回，可把 end 也跑一遍
-                    # end_y,   end_q   = _parse(sorted(period_labels)[-1])
-
-                    base_ctx = (plan.get("context") or {})
-                    comp = base_ctx.get("company") or company
-                    metr = base_ctx.get("metric")  or metric
-
-                    if start_y and start_q:
-                        run_policy_once_at_intent(send_progress, flat_sections, comp, metr, start_y, start_q)
-            except Exception:
-                # 政策检索的异常不阻断整体流程
-                pass
-            # —— 新增：行业/宏观增强（根据维度结果做一次新闻检索）
-            try:
-                base_ctx = (plan.get("context") or {})
-                comp = base_ctx.get("company") or company
-                metr = base_ctx.get("metric")  or metric
-                # 用起始期作为检索标签；如需放大召回也可用最后一期
-                def _parse(p):
-                    import re
-                    m = re.match(r"^(\d{4})(Q[1-4])$", str(p))
-                    if not m: return None, None
-                    return int(m.group(1)), m.group(2)
-                if period_labels:
-                    yy, qq = _parse(sorted(period_labels)[0])
-                else:
-                    yy, qq = (year, quarter)
-                run_industry_or_macro_enrichment_at_intent(send_progress, flat_sections, comp, metr, yy, qq)
-            except Exception:
-                pass
+            # 政策检索 / 行业增强的异常不阻断整体流程
+            flat_sections.extend(dag.results.get("policy") or [])
+            flat_sections.extend(dag.results.get("enrich") or [])
 
 
             # ④ 聚合与总结
@@ -772,7 +834,7 @@ async def route_stream(req: RouteReq, _=Depends(require_token), authorization: O
                 if parts:
                     items.append({"label": lbl, "summary": "\n\n".join(parts)})
 
-            merge_thought = await asyncio.to_thread(gen_stream_thought, "合并与总结", req.question, intent, modes)
+            merge_thought = dag.results.get("merge_thought") or await agen_stream_thought("合并与总结", req.question, intent, modes)
             yield send_progress("合并与总结", "start", group="合并", detail=merge_thought)
 
             period_summaries = [f"[{it.get('label','')}] {it.get('summary','')}".strip()
@@ -1120,73 +1182,91 @@ def llm_suggest_followups(question: str,
     except Exception:
         return []
 
+_THOUGHT_FALLBACK = {
+    "意图识别": "我先判断你是在要一个数，还是要做下钻分析。",
+    "计划":     "我会先把口径说清楚，再去取需要的数据，然后给出结果。",
+    "取数准备": "我先按公司/指标/期间把口径定好，再开始取数。",
+    "分析准备": "我会先把分析维度定下来，再去抓基础数据和政策口径。",
+}
+
+def _thought_prompt(phase: str, question: str, intent: Optional[str], modes: Optional[List[str]]) -> str:
+    modes_str = ", ".join(modes or []) if modes else ""
+    user = f"阶段：{phase}\n用户问题：{question}\n若已有意图：{intent or '未知'}；下钻模式：{modes_str or '无'}。"
+    return f"{PROMPT_THOUGHT}\n\n{user}"
+
 def gen_stream_thought(phase: str, question: str, intent: Optional[str] = None, modes: Optional[List[str]] = None) -> str:
     try:
-        modes_str = ", ".join(modes or []) if modes else ""
-        user = f"阶段：{phase}\n用户问题：{question}\n若已有意图：{intent or '未知'}；下钻模式：{modes_str or '无'}。"
-        return call_llm_chat(system="阶段话术", user=f"{PROMPT_THOUGHT}\n\n{user}", temperature=0.4, timeout=20).strip()
+        return call_llm_chat(system="阶段话术", user=_thought_prompt(phase, question, intent, modes), temperature=0.4, timeout=20).strip()
     except Exception:
         # LLM 不可用时，给一个温和的退路
-        fallback = {
-            "意图识别": "我先判断你是在要一个数，还是要做下钻分析。",
-            "计划":     "我会先把口径说清楚，再去取需要的数据，然后给出结果。",
-            "取数准备": "我先按公司/指标/期间把口径定好，再开始取数。",
-            "分析准备": "我会先把分析维度定下来，再去抓基础数据和政策口径。",
-        }
-        return fallback.get(phase, "我先把步骤梳理一下，再继续。")
+        return _THOUGHT_FALLBACK.get(phase, "我先把步骤梳理一下，再继续。")
+
+async def agen_stream_thought(phase: str, question: str, intent: Optional[str] = None, modes: Optional[List[str]] = None) -> str:
+    """协程版：直接 await LLM 网关，不占用线程池"""
+    try:
+        return (await acall_llm_chat(system="阶段话术", user=_thought_prompt(phase, question, intent, modes), temperature=0.4, timeout=20)).strip()
+    except Exception:
+        return _THOUGHT_FALLBACK.get(phase, "我先把步骤梳理一下，再继续。")
+
+def _intent_prompt(question: str, history: Optional[List[Dict[str, str]]]) -> str:
+    hist_txt = ""
+    if history:
+        N = max(1, DIALOG_CONTEXT_MAX_ROUNDS)
+        turns = history[-(N*2):]
+        lines = []
+        for t in turns:
+            role = "用户" if (t.get("role") == "user") else "助手"
+            cont = (t.get("content") or "").strip()
+            if cont:
+                lines.append(f"{role}：{cont}")
+        if lines:
+            hist_txt = "历史对话：\n" + "\n".join(lines) + "\n\n"
+    return f"{PROMPT_INTENT}\n\n{hist_txt}当前问题：{question}"
+
+def _heuristic_intent_obj(question: str) -> Dict[str, Any]:
+    hit_intent, conf, why = heuristic_intent(question)
+    return {
+        "intent": hit_intent.value,
+        "modes": guess_deep_modes(question) if hit_intent.value == "deep" else [],
+        "confidence": conf,
+        "reason": f"启发式：{why}"
+    }
+
+def _parse_intent(raw: Any, question: str) -> Dict[str, Any]:
+    # —— 容错提取 JSON：去反引号、去 'json' 前缀、从代码块抽取
+    s = str(raw or "").strip()
+    s = s.strip("`")  # 去成对反引号的粗处理
+    if s.lower().startswith("json"):
+        s = s[4:].strip()
+    try:
+        data = json.loads(s)
+    except Exception:
+        data = _extract_json_block(s) or {}
+
+    if isinstance(data, dict) and data.get("intent"):
+        return data
+    # 兜底（极少走到）：返回一个最小结构，至少不至于 None
+    return _heuristic_intent_obj(question)
 
 def llm_classify_intent(question: str, history: Optional[List[Dict[str, str]]] = None) -> Optional[Dict[str, Any]]:
     if not (LLM_BASE and LLM_KEY and LLM_MODEL):
         return None
     try:
-        hist_txt = ""
-        if history:
-            N = max(1, DIALOG_CONTEXT_MAX_ROUNDS)
-            turns = history[-(N*2):]
-            lines = []
-            for t in turns:
-                role = "用户" if (t.get("role") == "user") else "助手"
-                cont = (t.get("content") or "").strip()
-                if cont:
-                    lines.append(f"{role}：{cont}")
-            if lines:
-                hist_txt = "历史对话：\n" + "\n".join(lines) + "\n\n"
-
-        raw = call_llm_chat(system="意图识别",
-                            user=f"{PROMPT_INTENT}\n\n{hist_txt}当前问题：{question}",
-                            temperature=0.1)
-
-        # —— 容错提取 JSON：去反引号、去 'json' 前缀、从代码块抽取
-        s = str(raw or "").strip()
-        s = s.strip("`")  # 去成对反引号的粗处理
-        if s.lower().startswith("json"):
-            s = s[4:].strip()
-        try:
-            data = json.loads(s)
-        except Exception:
-            data = _extract_json_block(s) or {}
-
-        if isinstance(data, dict) and data.get("intent"):
-            return data
-
-        # 兜底（极少走到）：返回一个最小结构，至少不至于 None
-        from typing import cast
-        hit_intent, conf, why = heuristic_intent(question)
-        return {
-            "intent": cast(str, hit_intent.value),
-            "modes": guess_deep_modes(question) if hit_intent.value == "deep" else [],
-            "confidence": conf,
-            "reason": f"启发式：{why}"
-        }
+        raw = call_llm_chat(system="意图识别", user=_intent_prompt(question, history), temperature=0.1, cache=True)
+        return _parse_intent(raw, question)
     except Exception:
         # 出错也给一个兜底，不让上游拿到 None
-        hit_intent, conf, why = heuristic_intent(question)
-        return {
-            "intent": hit_intent.value,
-            "modes": guess_deep_modes(question) if hit_intent.value == "deep" else [],
-            "confidence": conf,
-            "reason": f"启发式：{why}"
-        }
+        return _heuristic_intent_obj(question)
+
+async def allm_classify_intent(question: str, history: Optional[List[Dict[str, str]]] = None) -> Optional[Dict[str, Any]]:
+    """协程版 llm_classify_intent（route_stream 使用）"""
+    if not (LLM_BASE and LLM_KEY and LLM_MODEL):
+        return None
+    try:
+        raw = await acall_llm_chat(system="意图识别", user=_intent_prompt(question, history), temperature=0.1, cache=True)
+        return _parse_intent(raw, question)
+    except Exception:
+        return _heuristic_intent_obj(question)
 
 
 def llm_structured_parse_slots(question: str,
@@ -1238,7 +1318,7 @@ def llm_structured_parse_slots(question: str,
     }
     # 直接请求 JSON；不做本地兜底
     out = call_llm_chat(system="槽位抽取", user=f"{sys_prompt}\n\n{json.dumps(user_payload, ensure_ascii=False)}",
-                        temperature=0.0, want_json=True)
+                        temperature=0.0, want_json=True, cache=True)
     return out or {}
 
 def _norm_quarter(q: Optional[str]) -> Optional[str]:
@@ -1318,71 +1398,44 @@ def _extract_json_block(s: str) -> dict | None:
     except Exception:
         return None
 # ====== LLM（可选：用于政策分析 & 低置信分类，保持最简实现） ======
-def call_llm_chat(system: str, user: str, temperature: float = 0.2, timeout: int = 45, want_json: bool = False):
+def _llm_messages(system: str, user: str) -> List[Dict[str, str]]:
+    return [{"role": "system", "content": system}, {"role": "user", "content": user}]
+
+def _llm_cache_lookup(system: str, user: str, temperature: float, want_json: bool, cache: bool):
     if not (LLM_BASE and LLM_KEY and LLM_MODEL):
         raise RuntimeError("LLM 未配置")
-
-    # 1) 模型决定端点
-    endpoint = "/responses" if str(LLM_MODEL).startswith(("gpt-5", "o4", "o3")) else "/chat/completions"
-    url = f"{LLM_BASE.rstrip('/')}{endpoint}"
-
-    # 2) 组装 payload
-    if endpoint == "/responses":
-        payload = {
-            "model": LLM_MODEL,
-            "input": [
-                {"role": "system", "content": [{"type": "input_text", "text": system}]},
-                {"role": "user",   "content": [{"type": "input_text", "text": user}]}
-            ]
-        }
-    else:
-        payload = {
-            "model": LLM_MODEL,
-            "messages": [
-                {"role": "system", "content": system},
-                {"role": "user",   "content": user}
-            ],
-            "temperature": temperature
-        }
-
-    r = requests.post(url,
-        headers={"Authorization": f"Bearer {LLM_KEY}", "Content-Type": "application/json"},
-        json=payload, timeout=timeout
-    )
-    r.raise_for_status()
-    data = r.json()
-
-    # 统一抽取
-    if endpoint == "/responses":
-        if isinstance(data, dict) and "output_text" in data:
-            return data["output_text"]
-        out = (data.get("output") or [])
-        if out and isinstance(out[0], dict):
-            parts = out[0].get("content", [])
-            texts = [p.get("text") for p in parts if isinstance(p, dict) and p.get("text")]
-            if texts:
-                return "\n".join(texts)
-        # 回退：如果 responses 仍然空，尝试一次 chat/completions
-        url2 = f"{LLM_BASE.rstrip('/')}/chat/completions"
-        r2 = requests.post(url2,
-            headers={"Authorization": f"Bearer {LLM_KEY}", "Content-Type": "application/json"},
-            json={
-                "model": LLM_MODEL,
-                "messages": [
-                    {"role":"system","content": system},
-                    {"role":"user","content": user}
-                ],
-                "temperature": temperature
-            }, timeout=timeout
-        )
-        r2.raise_for_status()
-        d2 = r2.json()
-        out_text = d2["choices"][0]["message"]["content"]
-    else:
-        out_text = data["choices"][0]["message"]["content"]
-    if want_json:
-        return _extract_json_block(out_text) or {}
-    return out_text
+    if not cache:
+        return None, None
+    cache_key = LLM_CACHE.key(LLM_MODEL, _llm_messages(system, user), temperature, want_json=want_json)
+    hit = LLM_CACHE.get(cache_key)
+    if hit is not None:
+        hit = json.loads(json.dumps(hit)) if isinstance(hit, (dict, list)) else hit
+    return cache_key, hit
+
+def _llm_result(out_text: str, want_json: bool, cache_key):
+    result = (_extract_json_block(out_text) or {}) if want_json else out_text
+    if cache_key and result:
+        LLM_CACHE.set(cache_key, result)
+    return result
+
+def call_llm_chat(system: str, user: str, temperature: float = 0.2, timeout: int = 45, want_json: bool = False,
+                  cache: bool = False):
+    """cache=True：按 (model, messages, temperature) 内容寻址缓存，仅用于确定性的解析/分类提示词"""
+    cache_key, hit = _llm_cache_lookup(system, user, temperature, want_json, cache)
+    if hit is not None:
+        return hit
+    # 端点选择（/responses → /chat/completions 回退）、连接复用与限流统一由 LLM 网关处理
+    out_text = _LLM.chat(_llm_messages(system, user), model=LLM_MODEL, temperature=temperature, timeout=timeout)
+    return _llm_result(out_text, want_json, cache_key)
+
+async def acall_llm_chat(system: str, user: str, temperature: float = 0.2, timeout: int = 45, want_json: bool = False,
+                         cache: bool = False):
+    """协程版 call_llm_chat：await 网关（请求在网关事件循环里执行），调用方事件循环不阻塞、不占线程"""
+    cache_key, hit = _llm_cache_lookup(system, user, temperature, want_json, cache)
+    if hit is not None:
+        return hit
+    out_text = await _LLM.achat(_llm_messages(system, user), model=LLM_MODEL, temperature=temperature, timeout=timeout)
+    return _llm_result(out_text, want_json, cache_key)
 
 
 
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+LLM 响应缓存（内容寻址）
+- key = sha256(model + 规范化后的 messages + temperature + 其它影响输出的参数)
+- 内存 LRU（进程内）+ 可选 SQLite 落盘（多进程/重启后共享）
+- TTL 过期；hit/miss 计数，供 /healthz 或调试接口查看
+- 只适合确定性提示词（temperature=0 的解析/分类/参数推断）；调用方自行决定哪些调用走缓存
+
+环境变量：
+  LLM_CACHE_ENABLED=1
+  LLM_CACHE_MAX_ITEMS=512       # 内存 LRU 容量
+  LLM_CACHE_TTL_S=21600         # 过期时间（秒），默认 6 小时
+  LLM_CACHE_SQLITE=             # 可选：SQLite 文件路径；为空则只用内存
+"""
+from __future__ import annotations
+import os, json, time, hashlib, sqlite3, threading, logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger("llm_cache")
+
+LLM_CACHE_ENABLED = (os.getenv("LLM_CACHE_ENABLED") or "1") not in ("0", "false", "False")
+LLM_CACHE_MAX_ITEMS = int(os.getenv("LLM_CACHE_MAX_ITEMS") or 512)
+LLM_CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S") or 6 * 3600)
+LLM_CACHE_SQLITE = (os.getenv("LLM_CACHE_SQLITE") or "").strip()
+
+_MISS = object()
+
+
+def _norm_content(c: Any) -> Any:
+    if isinstance(c, str):
+        return "\n".join(line.rstrip() for line in c.replace("\r\n", "\n").strip().split("\n"))
+    if isinstance(c, list):
+        return [_norm_content(x) for x in c]
+    if isinstance(c, dict):
+        return {k: _norm_content(v) for k, v in sorted(c.items())}
+    return c
+
+
+def normalize_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """统一换行/行尾空白，保证语义相同的提示词得到相同 key"""
+    return [{"role": m.get("role"), "content": _norm_content(m.get("content"))} for m in (messages or [])]
+
+
+class _SqliteStore:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (k TEXT PRIMARY KEY, v TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn().commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            c.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = c
+        return c
+
+    def get(self, k: str) -> Any:
+        row = self._conn().execute("SELECT v, expires_at FROM llm_cache WHERE k=?", (k,)).fetchone()
+        if not row:
+            return _MISS
+        if row[1] < time.time():
+            self._conn().execute("DELETE FROM llm_cache WHERE k=?", (k,))
+            self._conn().commit()
+            return _MISS
+        return json.loads(row[0])
+
+    def set(self, k: str, v: Any, expires_at: float) -> None:
+        self._conn().execute(
+            "INSERT OR REPLACE INTO llm_cache (k, v, expires_at) VALUES (?, ?, ?)",
+            (k, json.dumps(v, ensure_ascii=False), expires_at),
+        )
+        self._conn().commit()
+
+    def clear(self) -> None:
+        self._conn().execute("DELETE FROM llm_cache")
+        self._conn().commit()
+
+
+class LLMCache:
+    def __init__(self, *, max_items: int = LLM_CACHE_MAX_ITEMS, ttl_s: float = LLM_CACHE_TTL_S,
+                 sqlite_path: Optional[str] = LLM_CACHE_SQLITE or None, enabled: bool = LLM_CACHE_ENABLED) -> None:
+        self.enabled = enabled
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self._mem: "OrderedDict[str, tuple]" = OrderedDict()   # k -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "sets": 0, "disk_hits": 0}
+        self._disk: Optional[_SqliteStore] = None
+        if sqlite_path:
+            try:
+                self._disk = _SqliteStore(sqlite_path)
+            except Exception as e:
+                logger.warning("[llm_cache] sqlite disabled (%s): %s", sqlite_path, e)
+
+    @staticmethod
+    def key(model: str, messages: List[Dict[str, Any]], temperature: Optional[float] = None, **extra: Any) -> str:
+        blob = json.dumps({
+            "model": model or "",
+            "messages": normalize_messages(messages),
+            "temperature": temperature,
+            "extra": extra or None,
+        }, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, k: str) -> Any:
+        """命中返回值；未命中返回 None"""
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            item = self._mem.get(k)
+            if item is not None:
+                if item[0] >= now:
+                    self._mem.move_to_end(k)
+                    self._stats["hits"] += 1
+                    return item[1]
+                self._mem.pop(k, None)
+        if self._disk is not None:
+            try:
+                v = self._disk.get(k)
+            except Exception as e:
+                logger.warning("[llm_cache] sqlite get failed: %s", e)
+                v = _MISS
+            if v is not _MISS:
+                self._put_mem(k, v, now + self.ttl_s)
+                with self._lock:
+                    self._stats["hits"] += 1
+                    self._stats["disk_hits"] += 1
+                return v
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def _put_mem(self, k: str, v: Any, expires_at: float) -> None:
+        with self._lock:
+            self._mem[k] = (expires_at, v)
+            self._mem.move_to_end(k)
+            while len(self._mem) > self.max_items:
+                self._mem.popitem(last=False)
+
+    def set(self, k: str, v: Any) -> None:
+        if not self.enabled or v is None:
+            return
+        expires_at = time.time() + self.ttl_s
+        self._put_mem(k, v, expires_at)
+        with self._lock:
+            self._stats["sets"] += 1
+        if self._disk is not None:
+            try:
+                self._disk.set(k, v, expires_at)
+            except Exception as e:
+                logger.warning("[llm_cache] sqlite set failed: %s", e)
+
+    def cached(self, model: str, messages: List[Dict[str, Any]], temperature: Optional[float],
+               fn: Callable[[], Any], *, accept: Optional[Callable[[Any], bool]] = None, **extra: Any) -> Any:
+        """未命中时调用 fn()；仅当 accept(result) 为真（默认：非空）才写入缓存"""
+        k = self.key(model, messages, temperature, **extra)
+        hit = self.get(k)
+        if hit is not None:
+            return hit
+        out = fn()
+        if (accept(out) if accept else bool(out)):
+            self.set(k, out)
+        return out
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+        if self._disk is not None:
+            self._disk.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+            s["size"] = len(self._mem)
+        total = s["hits"] + s["misses"]
+        s["hit_rate"] = round(s["hits"] / total, 4) if total else None
+        s.update({"enabled": self.enabled, "ttl_s": self.ttl_s, "max_items": self.max_items,
+                  "sqlite": bool(self._disk)})
+        return s
+
+
+# 进程级默认实例
+LLM_CACHE = LLMCache()
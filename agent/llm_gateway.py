@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+共享 LLM 网关（OpenAI 兼容接口，async 原生）
+- 每个 (base_url, api_key) 一个网关；进程内只有一个后台事件循环线程 + 一个 httpx.AsyncClient（HTTP/2 连接池，可复用）
+- 每个 model 一个 Semaphore 限流；排队时间与请求耗时分别记录（结构化日志 + stats()）
+- 端点选择与回退只实现一次：gpt-5/o4/o3 走 /responses（不带 temperature），失败或无文本时回退 /chat/completions
+- 两种调用方式：
+    await gw.achat(...)   # 协程：请求在后台事件循环执行，调用方事件循环只 await，不占线程
+    gw.chat(...)          # 同步：给现有同步函数用（阻塞调用线程，但共享连接池与限流）
+
+环境变量：
+  LLM_MAX_CONCURRENCY=8      # 每个 model 同时在途请求数
+  LLM_POOL_MAX=64            # 连接池上限
+  LLM_HTTP2=1                # 需安装 h2；缺失时自动退回 HTTP/1.1 keep-alive
+  LLM_CONNECT_TIMEOUT=30 / LLM_READ_TIMEOUT=90
+"""
+from __future__ import annotations
+import os, time, json, asyncio, threading, logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger("llm_gateway")
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY") or 8)
+LLM_POOL_MAX = int(os.getenv("LLM_POOL_MAX") or 64)
+LLM_HTTP2 = (os.getenv("LLM_HTTP2") or "1") not in ("0", "false", "False")
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT") or 30)
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT") or 90)
+
+_RESPONSES_PREFIXES = ("gpt-5", "o4", "o3")
+
+
+class LLMError(RuntimeError):
+    def __init__(self, message: str, status: Optional[int] = None, body: str = "") -> None:
+        super().__init__(message)
+        self.status = status
+        self.body = body
+
+
+def uses_responses_api(model: str) -> bool:
+    return str(model or "").lower().startswith(_RESPONSES_PREFIXES)
+
+
+def extract_text(data: Any) -> Optional[str]:
+    """兼容 /responses（output_text / output[].content[].text）与 /chat/completions（choices[0]）"""
+    if not isinstance(data, dict):
+        return None
+    text = data.get("output_text")
+    if text is None and data.get("choices"):
+        ch0 = data["choices"][0] or {}
+        text = (ch0.get("message") or {}).get("content") or ch0.get("text")
+    if text is None and data.get("output"):
+        texts: List[str] = []
+        for item in data["output"]:
+            for p in (item or {}).get("content") or []:
+                if isinstance(p, dict) and p.get("text"):
+                    texts.append(p["text"])
+        text = "\n".join(texts) if texts else None
+    return text
+
+
+# ---------------- 后台事件循环 ---------------- #
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _bg_loop() -> asyncio.AbstractEventLoop:
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-gateway", daemon=True).start()
+            _LOOP = loop
+        return _LOOP
+
+
+class LLMGateway:
+    def __init__(self, base_url: str, api_key: str, *,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 connect_timeout: float = LLM_CONNECT_TIMEOUT,
+                 read_timeout: float = LLM_READ_TIMEOUT) -> None:
+        self.base_url = (base_url or "").rstrip("/")
+        self.api_key = api_key or ""
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sems: Dict[str, asyncio.Semaphore] = {}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._stats_lock = threading.Lock()
+
+    # 以下 _xxx 方法只在后台事件循环中执行
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            limits = httpx.Limits(max_connections=LLM_POOL_MAX, max_keepalive_connections=LLM_POOL_MAX)
+            headers = {"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"}
+            try:
+                self._client = httpx.AsyncClient(http2=LLM_HTTP2, limits=limits, timeout=self.timeout, headers=headers)
+            except ImportError:   # 未安装 h2
+                self._client = httpx.AsyncClient(limits=limits, timeout=self.timeout, headers=headers)
+        return self._client
+
+    def _sem(self, model: str) -> asyncio.Semaphore:
+        s = self._sems.get(model)
+        if s is None:
+            s = self._sems[model] = asyncio.Semaphore(self.max_concurrency)
+        return s
+
+    async def _post(self, endpoint: str, payload: Dict[str, Any], timeout: Optional[float]) -> Dict[str, Any]:
+        kw = {"timeout": httpx.Timeout(timeout, connect=self.timeout.connect)} if timeout else {}
+        r = await self._get_client().post(f"{self.base_url}{endpoint}", json=payload, **kw)
+        if r.status_code >= 400:
+            raise LLMError(f"LLM {endpoint} HTTP {r.status_code}", r.status_code, r.text[:2000])
+        return r.json()
+
+    async def _chat(self, messages: List[Dict[str, Any]], model: str, temperature: Optional[float],
+                    timeout: Optional[float], responses: Optional[bool], extra: Dict[str, Any]) -> str:
+        use_responses = uses_responses_api(model) if responses is None else responses
+        t0 = time.perf_counter()
+        async with self._sem(model):
+            t1 = time.perf_counter()
+            endpoint, fallback, text, ok = "/chat/completions", False, None, False
+            try:
+                if use_responses:
+                    endpoint = "/responses"
+                    try:
+                        text = extract_text(await self._post("/responses", {"model": model, "input": messages, **extra}, timeout))
+                    except LLMError as e:
+                        logger.warning("[llm] /responses failed (%s), fallback to /chat/completions", e)
+                    if not text:
+                        endpoint, fallback = "/chat/completions", True
+                if not text:
+                    payload: Dict[str, Any] = {"model": model, "messages": messages, **extra}
+                    if temperature is not None:
+                        payload["temperature"] = temperature
+                    text = extract_text(await self._post("/chat/completions", payload, timeout))
+                ok = True
+                return text or ""
+            finally:
+                t2 = time.perf_counter()
+                self._record(model, endpoint, ok, fallback, (t1 - t0) * 1000, (t2 - t1) * 1000)
+
+    def _record(self, model: str, endpoint: str, ok: bool, fallback: bool, queue_ms: float, call_ms: float) -> None:
+        logger.info("llm_call %s", json.dumps({
+            "model": model, "endpoint": endpoint, "ok": ok, "fallback": fallback,
+            "queue_ms": round(queue_ms, 1), "call_ms": round(call_ms, 1),
+        }))
+        with self._stats_lock:
+            s = self._stats.setdefault(model, {"calls": 0, "errors": 0, "fallbacks": 0,
+                                               "call_ms_total": 0.0, "queue_ms_max": 0.0})
+            s["calls"] += 1
+            s["errors"] += 0 if ok else 1
+            s["fallbacks"] += 1 if fallback else 0
+            s["call_ms_total"] += call_ms
+            s["queue_ms_max"] = max(s["queue_ms_max"], queue_ms)
+
+    # ---- public ----
+    def _submit(self, messages, model, temperature, timeout, responses, extra):
+        return asyncio.run_coroutine_threadsafe(
+            self._chat(messages, model, temperature, timeout, responses, extra), _bg_loop())
+
+    async def achat(self, messages: List[Dict[str, Any]], *, model: str, temperature: Optional[float] = None,
+                    timeout: Optional[float] = None, responses: Optional[bool] = None, **extra: Any) -> str:
+        """协程版：返回文本；HTTP 错误抛 LLMError。responses=None 按 model 自动选择端点"""
+        return await asyncio.wrap_future(self._submit(messages, model, temperature, timeout, responses, extra))
+
+    def chat(self, messages: List[Dict[str, Any]], *, model: str, temperature: Optional[float] = None,
+             timeout: Optional[float] = None, responses: Optional[bool] = None, **extra: Any) -> str:
+        """同步版（在工作线程中调用）；不要在事件循环线程里直接调用"""
+        return self._submit(messages, model, temperature, timeout, responses, extra).result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            out = {}
+            for m, s in self._stats.items():
+                out[m] = {**s, "avg_ms": round(s["call_ms_total"] / s["calls"], 1) if s["calls"] else None}
+            return {"base_url": self.base_url, "max_concurrency": self.max_concurrency, "models": out}
+
+
+_GATEWAYS: Dict[Tuple[str, str], LLMGateway] = {}
+_GW_LOCK = threading.Lock()
+
+
+def get_gateway(base_url: str, api_key: str) -> LLMGateway:
+    """同一 (base_url, api_key) 在进程内共享一个网关（连接池 + 限流）"""
+    key = ((base_url or "").rstrip("/"), api_key or "")
+    with _GW_LOCK:
+        gw = _GATEWAYS.get(key)
+        if gw is None:
+            gw = _GATEWAYS[key] = LLMGateway(*key)
+        return gw
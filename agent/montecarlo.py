@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+向量化 Monte Carlo 情景引擎（simulation_v2）
+
+模型与原 monte_carlo_paths 一致（乘法合成）：
+    Y_t = Y_hat_t * Π_k (1 + β̃_k · ΔX_k(scenario))，t < lag_k 时该项为 1
+    β̃_k ~ N(β_k, max(σ_floor, σ_rel·|β_k|))，每条路径每个驱动抽一次（跨期不变）
+
+实现：
+- 一次性抽取 (samples × drivers) 的 β 样本；所有情景共用同一批随机数（common random numbers），
+  情景之间的差异只来自 ΔX，便于对比
+- 按 lag 升序做累计乘积，避免显式展开 (scenarios × samples × periods × drivers) 张量：
+  复杂度 O(S·N·(K + T))，10 万条路径在 CPU 上为百毫秒级
+- 支持固定 seed（numpy Generator）复现；输出任意分位数 + mean/std
+"""
+from __future__ import annotations
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+
+DEFAULT_QUANTILES = (0.1, 0.5, 0.9)
+
+
+def quantile_name(q: float) -> str:
+    """0.1 → 'p10'；0.025 → 'p2.5'"""
+    return "p" + format(round(float(q) * 100, 6), "g")
+
+
+def simulate_paths(baseline: Sequence[float],
+                   betas: Sequence[float],
+                   lags: Sequence[int],
+                   scenario_dx: Dict[str, Sequence[float]],
+                   samples: int,
+                   *,
+                   seed: Optional[int] = None,
+                   sigma_rel: float = 0.2,
+                   sigma_floor: float = 1e-4,
+                   dtype=np.float64) -> Dict[str, np.ndarray]:
+    """
+    baseline    : (T,) 基线预测
+    betas/lags  : (K,) 每个驱动的弹性与滞后期
+    scenario_dx : {label: (K,) 该情景下每个驱动的 ΔX}
+    返回 {label: (samples, T) 路径矩阵}
+    """
+    base = np.asarray(baseline, dtype=dtype)
+    T = base.shape[0]
+    N = max(1, int(samples))
+    labels = list(scenario_dx.keys())
+    beta = np.asarray(betas, dtype=dtype).reshape(-1)
+    lag = np.clip(np.asarray(lags, dtype=int).reshape(-1), 0, T)
+    K = beta.shape[0]
+
+    if K == 0 or T == 0:
+        return {lb: np.broadcast_to(base, (N, T)).copy() for lb in labels}
+
+    rng = np.random.default_rng(seed)
+    sigma = np.maximum(sigma_floor, sigma_rel * np.abs(beta))
+    beta_draw = rng.normal(beta, sigma, size=(N, K)).astype(dtype, copy=False)   # (N, K)
+
+    dx = np.stack([np.asarray(scenario_dx[lb], dtype=dtype).reshape(-1) for lb in labels])  # (S, K)
+    factors = 1.0 + beta_draw[None, :, :] * dx[:, None, :]                              # (S, N, K)
+
+    # 按 lag 分组：t ≥ lag 的期才乘上该组因子；升序累计乘积后按区间广播
+    order = np.argsort(lag, kind="stable")
+    mult = np.ones((len(labels), N, T), dtype=dtype)
+    cum = np.ones((len(labels), N), dtype=dtype)
+    i = 0
+    while i < K:
+        L = lag[order[i]]
+        j = i
+        while j < K and lag[order[j]] == L:
+            j += 1
+        cum = cum * np.prod(factors[:, :, order[i:j]], axis=2)
+        nxt = lag[order[j]] if j < K else T
+        if nxt > L:
+            mult[:, :, L:nxt] = cum[:, :, None]
+        i = j
+    # 最后一组之后的所有期都已覆盖到 T；首个 lag 之前保持 1
+
+    paths = mult * base[None, None, :]
+    return {lb: paths[s] for s, lb in enumerate(labels)}
+
+
+def summarize_paths(paths: np.ndarray, quantiles: Sequence[float] = DEFAULT_QUANTILES) -> Dict[str, Any]:
+    """(samples, T) → {pXX: [...], mean: [...], std: [...]}（均为按期列表）"""
+    qs = [float(q) for q in (quantiles or DEFAULT_QUANTILES)]
+    out: Dict[str, Any] = {}
+    qv = np.quantile(paths, qs, axis=0)          # (Q, T)
+    for q, row in zip(qs, qv):
+        out[quantile_name(q)] = row.tolist()
+    out["mean"] = paths.mean(axis=0).tolist()
+    out["std"] = paths.std(axis=0).tolist()
+    return out
+
+
+def run_scenarios(baseline: Sequence[float],
+                  betas: Sequence[float],
+                  lags: Sequence[int],
+                  scenario_dx: Dict[str, Sequence[float]],
+                  samples: int,
+                  *,
+                  quantiles: Sequence[float] = DEFAULT_QUANTILES,
+                  seed: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+    """一次抽样 → 每个情景的分位数/均值/标准差"""
+    paths = simulate_paths(baseline, betas, lags, scenario_dx, samples, seed=seed)
+    return {lb: summarize_paths(p, quantiles) for lb, p in paths.items()}
@@ -28,7 +28,7 @@ Report Agent (LOCKED PROMPT VERSION)
 """
 
 import os, io, uuid, json, datetime as dt
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 import requests
 import pandas as pd
 
@@ -61,6 +61,22 @@ EXPORT_ENABLED = os.getenv("EXPORT_ENABLED", "1") == "1"
 # LLM（OpenAI 兼容）
 from openai import OpenAI
 import httpx
+try:
+    from agent.llm_gateway import get_gateway
+except ImportError:
+    from llm_gateway import get_gateway
+try:
+    from agent.export_jobs import EXPORT_JOBS, job_urls
+except ImportError:
+    from export_jobs import EXPORT_JOBS, job_urls
+try:
+    from agent.ts_analytics import prepare_metrics_frame, summarize_timeseries
+except ImportError:
+    from ts_analytics import prepare_metrics_frame, summarize_timeseries
+try:
+    from agent.token_budget import Unit, count_messages, count_tokens, is_exact, pack_by_priority
+except ImportError:
+    from token_budget import Unit, count_messages, count_tokens, is_exact, pack_by_priority
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
@@ -84,18 +100,8 @@ def guess_context_limit(model: str) -> int:
     return int(os.getenv("OPENAI_CONTEXT_LIMIT", "8192"))
 
 def est_tokens_from_messages(msgs: list[dict]) -> int:
-    # 粗估：字符数 / 3.6 ≈ tokens
-    s = "".join((m.get("content") or "") for m in msgs)
-    return max(1, int(len(s) / 3.6))
-
-def shrink_metrics(metric_summary: dict, keep_points: int) -> dict:
-    out = {}
-    for k, v in (metric_summary or {}).items():
-        series = list(v.get("series") or [])
-        if len(series) > keep_points:
-            series = series[-keep_points:]
-        out[k] = {**v, "series": series}
-    return out
+    # tiktoken 精确计数（逐字符串记忆化）；不可用时退回 CJK 感知估算
+    return count_messages(msgs, OPENAI_MODEL)
 
 def shrink_policy(policy_ctx: list, limit: int, max_chars: int = 240) -> list:
     out = []
@@ -103,6 +109,72 @@ def shrink_policy(policy_ctx: list, limit: int, max_chars: int = 240) -> list:
         s = (it.get("summary") or "")[:max_chars]
         out.append({**it, "summary": s})
     return out
+# === 续写：尾窗 + 已输出大纲 + 重叠去重（避免每轮重发全文） ===
+CONT_TAIL_CHARS = int(os.getenv("REPORT_CONT_TAIL_CHARS", "1500"))   # 续写时回传的已输出末尾字符数
+CONT_DEDUP_PROBE = 400                                               # 续写开头缓冲多少字符用于去重
+_HEADING_RE = re.compile(r"^(#{1,4})\s+(.+?)\s*$", re.M)
+
+def outline_of(md_text: str, max_items: int = 60) -> str:
+    """已输出内容的结构大纲（仅标题行），供续写时告知模型“写到哪了”"""
+    heads = [f"{h} {t}" for h, t in _HEADING_RE.findall(md_text or "")]
+    if len(heads) > max_items:
+        heads = heads[:max_items // 2] + ["…"] + heads[-max_items // 2:]
+    return "\n".join(heads) or "（尚无标题）"
+
+def tail_window(md_text: str, max_chars: int = CONT_TAIL_CHARS) -> str:
+    """末尾窗口：从行首截断；若截断点落在未闭合的代码块（如 ```echarts）内，则回退到该代码块起点"""
+    text = md_text or ""
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind("\n", 0, len(text) - max_chars) + 1
+    if text[:cut].count("```") % 2 == 1:
+        cut = text.rfind("```", 0, cut)
+    return text[cut:]
+
+def strip_overlap(prev: str, new: str, min_len: int = 4, max_len: int = 800) -> str:
+    """
+    拼接去重：
+    1) 新文本开头与已输出末尾的最长重叠（后缀 == 前缀）
+    2) 新文本开头若整行重复了末尾若干非空行，也一并去掉
+    """
+    if not prev or not new:
+        return new
+    for L in range(min(len(prev), len(new), max_len), min_len - 1, -1):
+        if prev.endswith(new[:L]):
+            new = new[L:]
+            break
+    recent = {ln.strip() for ln in prev.splitlines()[-12:] if ln.strip() and not ln.strip().startswith("```")}
+    lines = new.split("\n")
+    i = 0
+    while i < len(lines) - 1 and (not lines[i].strip() or lines[i].strip() in recent):
+        i += 1
+    return "\n".join(lines[i:]) if i else new
+
+def build_continuation_messages(messages: list[dict], content_md: str, missing: list[str],
+                                tail_chars: int = CONT_TAIL_CHARS) -> list[dict]:
+    """原始提示（口径/数据）+ 已输出末尾窗口 + 大纲；不再回传全部已生成内容"""
+    hint = "、".join(missing) if missing else "剩余章节"
+    return messages + [
+        {"role": "assistant", "content": tail_window(content_md, tail_chars)},
+        {"role": "user", "content":
+            "上一条 assistant 消息是你已输出报告的【末尾片段】，完整结构大纲如下（这些内容已输出，不要重复）：\n"
+            f"{outline_of(content_md)}\n\n"
+            f"请紧接末尾片段最后一个字继续写作，补齐未完成章节（{hint}）。"
+            "不要重复已写内容，延续编号与格式，直到所有章节输出完毕。"}
+    ]
+
+def continuation_budget(ctx_limit: int, prompt_tokens: int, content_md: str,
+                        sections_done: int, sections_missing: int, reserve: int = 512) -> int:
+    """按已写章节的平均长度估算剩余所需 tokens，并受上下文余量约束；余量不足（<=0）返回 0，调用方跳过续写"""
+    room = ctx_limit - prompt_tokens - reserve
+    if room <= 0:
+        return 0
+    written = est_tokens_from_messages([{"content": content_md}])
+    per_sec = (written / sections_done) if sections_done else 700
+    need = int(per_sec * max(1, sections_missing) * 1.2) + 128
+    # 下限 256 只在余量允许时生效，绝不超过 room
+    return min(room, max(256, min(3072, need)))
+
 if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
     raise RuntimeError("缺少 SUPABASE_URL 或 SUPABASE_SERVICE_ROLE_KEY")
 
@@ -232,69 +304,9 @@ def fetch_financial_metrics(company: str, start: Quarter, end: Quarter, metrics:
     if df.empty:
         return df
 
-    # 统一类型/格式
-    df["year"] = df["year"].astype(int)
-
-    def _norm_quarter(v) -> str:
-        s = str(v).strip().upper()
-        if s.startswith("Q"):
-            try:
-                return f"Q{int(s[1:])}"
-            except Exception:
-                return "Q1"
-        try:
-            n = int(float(s))
-        except Exception:
-            n = 1
-        if n < 1 or n > 4:
-            n = 1
-        return f"Q{n}"
-
-    df["quarter"] = df["quarter"].apply(_norm_quarter)
-
-    def period_key(y: int, q: str) -> int:
-        mp = {"Q1": 1, "Q2": 2, "Q3": 3, "Q4": 4}
-        return int(y) * 10 + mp.get(q.upper(), 1)
-
-    df["pkey"] = df.apply(lambda r: period_key(int(r["year"]), r["quarter"]), axis=1)
-
-    p_start = period_key(start.year, start.quarter)
-    p_end   = period_key(end.year, end.quarter)
-    df = df[(df["pkey"] >= p_start) & (df["pkey"] <= p_end)].copy()
-
-    df.sort_values(by=["metric_name", "year", "quarter"], inplace=True)
-    return df
-
+    # 统一类型/格式 + pkey + 区间过滤（向量化）
+    return prepare_metrics_frame(df, (start.year, start.quarter), (end.year, end.quarter))
 
-def summarize_timeseries(df: pd.DataFrame) -> Dict[str, Any]:
-    """
-    输入：company_name, year, quarter, metric_name, metric_value, pkey
-    输出：按 metric_name 的时序与基础统计
-    """
-    out: Dict[str, Any] = {}
-    if df.empty:
-        return out
-
-    for name, grp in df.groupby("metric_name"):
-        grp = grp.sort_values(["year", "pkey"])
-        series = [
-            {
-                "period": f"{int(r.year)}{r.quarter}",
-                "year": int(r.year),
-                "quarter": r.quarter,
-                "value": r.metric_value,
-            }
-            for r in grp.itertuples(index=False)
-        ]
-        last = series[-1]["value"] if series else None
-        prev = series[-2]["value"] if len(series) > 1 else None
-        yoy  = None
-        if len(series) >= 5:
-            base = series[-5]["value"]
-            yoy = None if base in (None, 0) else (last - base) / base
-        qoq = None if prev in (None, 0) else (last - prev) / prev
-        out[name] = {"series": series, "latest": last, "qoq": qoq, "yoy": yoy}
-    return out
 
 # -------------------- 政策上下文 --------------------
 def fetch_policy_from_table(limit: int = 8) -> List[Dict[str, Any]]:
@@ -466,6 +478,21 @@ def upload_bytes_to_storage(path: str, content: bytes, content_type="application
     )
     return sb.storage.from_(REPORTS_BUCKET).get_public_url(path)
 
+# -------------------- 后台导出任务 --------------------
+def submit_report_exports(job_id: str, content_md: str, file_name: str) -> str:
+    """DOCX/PDF 并行渲染 + 上传（不阻塞请求）；链接经 /report/jobs/{job_id} 或 SSE export 事件获取"""
+    day = dt.datetime.utcnow().strftime("%Y%m%d")
+    content_types = {
+        "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        "pdf":  "application/pdf",
+    }
+    def _up(fmt: str, data: bytes) -> Dict[str, Any]:
+        return {"url": upload_bytes_to_storage(f"{day}/{job_id}/report.{fmt}", data, content_types[fmt])}
+    return EXPORT_JOBS.submit(
+        {"docx": (export_docx, (content_md,)), "pdf": (export_pdf, (content_md,))},
+        _up, job_id=job_id, meta={"kind": "report", "file_name": file_name},
+    )
+
 # -------------------- 锁定提示词（前端无法覆盖） --------------------
 STRICT_SYSTEM_PROMPT = (
     "你是资深企业财务分析师与报告撰写专家。你的任务：基于给定的‘时间范围、公司、模板结构、"
@@ -504,14 +531,10 @@ ACCURACY_RULES = (
 )
 
 # -------------------- 构建 LLM 消息（锁定） --------------------
-def build_locked_messages(template: Dict[str, Any], company: str, start: Quarter, end: Quarter,
-                          metric_summary: Dict[str, Any], policy_ctx: List[Dict[str,str]],
-                          language: str, special: Optional[str],
-                          keep_points: int = 24, policy_limit: int = 8) -> List[Dict[str,str]]:
-    # 压缩时序 & 政策
-    compact_metrics = shrink_metrics(metric_summary, keep_points=keep_points)
+def build_locked_messages_from(template: Dict[str, Any], company: str, start: Quarter, end: Quarter,
+                               compact_metrics: Dict[str, Any], policy_slice: List[Dict[str,str]],
+                               language: str, special: Optional[str]) -> List[Dict[str,str]]:
     framework = {"name": template.get("name","报告"), "sections": template.get("sections", [])}
-    policy_slice = shrink_policy(policy_ctx, limit=policy_limit)
 
     locked_instruction = STRICT_SYSTEM_PROMPT + "\n" + STYLE_GUIDE + "\n" + ACCURACY_RULES
     user_payload = {
@@ -528,6 +551,73 @@ def build_locked_messages(template: Dict[str, Any], company: str, start: Quarter
         {"role": "user", "content": json.dumps(user_payload, ensure_ascii=False)}
     ]
 
+def budget_locked_messages(template: Dict[str, Any], company: str, start: Quarter, end: Quarter,
+                           metric_summary: Dict[str, Any], policy_ctx: List[Dict[str,str]],
+                           language: str, special: Optional[str], *,
+                           model: str, ctx_limit: int,
+                           min_output: int = 900, max_output: int = 3072,
+                           safety: int = 64) -> Tuple[List[Dict[str,str]], int, int, Dict[str, Any]]:
+    """
+    精确 token 预算下组装消息：固定部分（系统提示 + 框架）→ 输出预留 → 剩余预算按优先级装入数据：
+      指标摘要（latest/qoq/yoy）> 模板所需指标的最近数据点 > 其它指标的较早数据点（越早分越低）> 政策条目（按排序递减）
+    装入后再精确计数整份消息，超出则逐个剔除最低分单元，保证永不超出上下文。
+    返回 (messages, prompt_tokens, max_tokens, stats)
+    """
+    required = set(infer_required_metrics(template))
+    policy_items = shrink_policy(policy_ctx, limit=len(policy_ctx or []))
+
+    base_msgs = build_locked_messages_from(template, company, start, end, {}, [], language, special)
+    fixed = count_messages(base_msgs, model)
+    out_reserve = max(min_output, min(max_output, ctx_limit - fixed - safety - min_output))
+    data_budget = max(0, ctx_limit - fixed - out_reserve - safety)
+
+    units: List[Unit] = []
+    for name, v in (metric_summary or {}).items():
+        boost = 2.0 if name in required else 1.0
+        head = {k: v.get(k) for k in ("latest", "qoq", "yoy", "cagr") if k in v}
+        units.append(Unit(f"m:{name}", ("head", head), 100.0 * boost, count_tokens({name: {**head, "series": []}}, model)))
+        series = list(v.get("series") or [])
+        for age, pt in enumerate(reversed(series)):
+            units.append(Unit(f"m:{name}", ("pt", pt), boost * 10.0 / (1 + age), count_tokens(pt, model) + 1))
+    for i, it in enumerate(policy_items):
+        units.append(Unit("policy", it, 8.0 / (1 + i), count_tokens(it, model) + 1))
+
+    kept, _ = pack_by_priority(units, data_budget)
+
+    def _assemble(kept_units: List[Unit]):
+        metrics: Dict[str, Any] = {}
+        for u in kept_units:
+            if not u.group.startswith("m:"):
+                continue
+            name = u.group[2:]
+            m = metrics.setdefault(name, {"series": []})
+            kind, val = u.item
+            if kind == "head":
+                m.update(val)
+            else:
+                m["series"].append(val)
+        for m in metrics.values():
+            m["series"].sort(key=lambda pt: (pt.get("year") or 0, str(pt.get("quarter") or "")))
+        policy = [u.item for u in sorted((u for u in kept_units if u.group == "policy"), key=lambda u: -u.score)]
+        return build_locked_messages_from(template, company, start, end, metrics, policy, language, special)
+
+    msgs = _assemble(kept)
+    prompt_tokens = count_messages(msgs, model)
+    kept.sort(key=lambda u: -u.score)
+    while kept and prompt_tokens + out_reserve + safety > ctx_limit:
+        kept.pop()                                   # 剔除最低分单元
+        msgs = _assemble(kept)
+        prompt_tokens = count_messages(msgs, model)
+
+    max_out = max(256, min(max_output, ctx_limit - prompt_tokens - safety))
+    stats = {
+        "exact": is_exact(), "fixed_tokens": fixed, "data_budget": data_budget,
+        "units_total": len(units), "units_kept": len(kept),
+        "points_kept": sum(1 for u in kept if u.group.startswith("m:") and u.item[0] == "pt"),
+        "policy_kept": sum(1 for u in kept if u.group == "policy"),
+    }
+    return msgs, prompt_tokens, max_out, stats
+
 def call_llm(messages):
     """
     只走 OpenAI 兼容接口：/v1/chat/completions
@@ -546,13 +636,8 @@ def call_llm(messages):
     logger.info("LLM base=%s model=%s", base, model)
 
     try:
-        client = OpenAI(base_url=base, api_key=key, timeout=60)
-        resp = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.2
-        )
-        return resp.choices[0].message.content or ""
+        # 共享网关：连接池复用 + 按 model 限流（不再每次新建 OpenAI 客户端）
+        return get_gateway(base, key).chat(messages, model=model, temperature=0.2, timeout=60, responses=False)
     except Exception as e:
         logger.error("LLM request failed. base=%s model=%s err=%s", base, model, e)
         # 让上层 generate() 的兜底捕到并返回 detail
@@ -563,6 +648,13 @@ def call_llm(messages):
 def health():
     return {"ok": True, "time": dt.datetime.utcnow().isoformat(), "use_llm": USE_LLM}
 
+@app.get("/report/jobs/{job_id}")
+def report_job(job_id: str, _=Depends(auth_check)):
+    job = EXPORT_JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(404, "job not found")
+    return {**job, **job_urls(job)}
+
 @app.post("/report/generate")
 def generate(payload: GeneratePayload, _=Depends(auth_check)):
     now = dt.datetime.utcnow().isoformat()
@@ -591,9 +683,10 @@ def generate(payload: GeneratePayload, _=Depends(auth_check)):
                 or "https://api.openai.com/v1"
             )
             llm_model = os.getenv("OPENAI_MODEL") or os.getenv("AZURE_OPENAI_DEPLOYMENT") or "(unset)"
-            messages = build_locked_messages(
+            messages, prompt_tokens, _max_out, budget_stats = budget_locked_messages(
                 template, p.company_name, p.start, p.end,
-                metric_summary, policy_ctx, payload.language, payload.specialRequirements
+                metric_summary, policy_ctx, payload.language, payload.specialRequirements,
+                model=llm_model, ctx_limit=guess_context_limit(llm_model)
             )
             content_md = call_llm(messages)
             content_md = normalize_echarts_blocks(content_md)
@@ -620,33 +713,21 @@ def generate(payload: GeneratePayload, _=Depends(auth_check)):
             "logs": [
                 {"step":"template_loaded","name": template.get("name")},
                 {"step":"metrics_required","count": len(need_metrics)},
+                {"step":"prompt_budget","prompt_tokens": prompt_tokens, **budget_stats},
                 {"step":"financial_rows","rows": int(df.shape[0]) if isinstance(df, pd.DataFrame) else 0},
                 {"step":"policy_collected","count": len(policy_ctx)},
                 {"step":"llm_done","chars": len(content_md)}
             ]
         }
 
-        # 6) 导出（你已关闭就不动）
+        # 6) 导出：DOCX/PDF 交给后台任务并行渲染上传，立即返回；状态与链接见 /report/jobs/{job_id}
         if EXPORT_ENABLED:
-            try:
-                day = dt.datetime.utcnow().strftime("%Y%m%d")
-                base = f"{day}/{job_id}"
-                docx_bytes = export_docx(content_md)
-                pdf_bytes  = export_pdf(content_md)
-                docx_url = upload_bytes_to_storage(
-                    f"{base}/report.docx", docx_bytes,
-                    "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                )
-                pdf_url  = upload_bytes_to_storage(f"{base}/report.pdf",  pdf_bytes, "application/pdf")
-                result.update({
-                    "docx_url": docx_url,
-                    "pdf_url": pdf_url,
-                    "file_name": f"{p.company_name}_报告_{p.start.year}{p.start.quarter}-{p.end.year}{p.end.quarter}.pdf"
-                })
-                result["logs"].append({"step":"files_uploaded"})
-            except Exception as e:
-                logger.error("export failed: %s\n%s", e, traceback.format_exc())
-                result["logs"].append({"step":"export_failed","error": str(e)})
+            submit_report_exports(
+                job_id, content_md,
+                f"{p.company_name}_报告_{p.start.year}{p.start.quarter}-{p.end.year}{p.end.quarter}.pdf"
+            )
+            result.update({"export_job_id": job_id, "export_status_url": f"/report/jobs/{job_id}"})
+            result["logs"].append({"step":"export_queued"})
 
         return result
 
@@ -732,32 +813,17 @@ def report_stream(payload: GeneratePayload, _=Depends(auth_check)):
             model = os.getenv("OPENAI_MODEL") or "gpt-4"
             ctx_limit = guess_context_limit(model)
 
-            keep_points = 24
-            policy_limit = 8
-
-            def build_and_budget():
-                msgs = build_locked_messages(
-                    template, p.company_name, p.start, p.end,
-                    metric_summary, policy_ctx, payload.language, payload.specialRequirements,
-                    keep_points=keep_points, policy_limit=policy_limit
-                )
-                prompt_tokens = est_tokens_from_messages(msgs)
-                reserve = 512
-                max_out = max(512, min(3072, ctx_limit - prompt_tokens - reserve))
-                return msgs, prompt_tokens, max_out
-
-            messages, prompt_tokens, max_out = build_and_budget()
-            tighten_round = 0
-            while max_out < 900 and tighten_round < 2:
-                tighten_round += 1
-                keep_points = 12 if keep_points > 12 else 8
-                policy_limit = 4 if policy_limit > 4 else 2
-                messages, prompt_tokens, max_out = build_and_budget()
+            # 精确计数 + 按优先级装入数据（替代 keep_points/policy_limit 两轮粗放收紧）
+            messages, prompt_tokens, max_out, budget_stats = budget_locked_messages(
+                template, p.company_name, p.start, p.end,
+                metric_summary, policy_ctx, payload.language, payload.specialRequirements,
+                model=model, ctx_limit=ctx_limit
+            )
 
             yield _sse("progress", {
                 "stage": "调用模型（流式）",
                 "ctx_limit": ctx_limit, "prompt_tokens": prompt_tokens, "max_tokens": max_out,
-                "keep_points": keep_points, "policy_limit": policy_limit
+                "budget": budget_stats
             })
         except Exception as e:
             yield _sse("error", {"message": f"消息构建失败: {e}"})
@@ -777,6 +843,8 @@ def report_stream(payload: GeneratePayload, _=Depends(auth_check)):
             def stream_once(msgs, round_no: int, max_tokens: int):
                 nonlocal content_md
                 finish_reason = None
+                # 续写轮：先缓冲开头一小段，与已输出末尾去重后再下发
+                pending = "" if round_no > 1 else None
                 stream = client.chat.completions.create(
                     model=model,
                     messages=msgs,
@@ -793,9 +861,20 @@ def report_stream(payload: GeneratePayload, _=Depends(auth_check)):
                         finish_reason = choice.finish_reason
                     if delta and getattr(delta, "content", None):
                         txt = delta.content
+                        if pending is not None:
+                            pending += txt
+                            if len(pending) < CONT_DEDUP_PROBE:
+                                continue
+                            txt, pending = strip_overlap(content_md, pending), None
+                        if txt:
+                            content_md += txt
+                            yield _sse("chunk", {"text": txt})
+                    yield _sse("heartbeat", "1")
+                if pending:
+                    txt = strip_overlap(content_md, pending)
+                    if txt:
                         content_md += txt
                         yield _sse("chunk", {"text": txt})
-                    yield _sse("heartbeat", "1")
                 content_md = normalize_echarts_blocks(content_md)
                 return finish_reason
 
@@ -812,16 +891,19 @@ def report_stream(payload: GeneratePayload, _=Depends(auth_check)):
             while need_continue and rounds < 3:
                 rounds += 1
                 missing = [t for t in section_titles if t and (f"## {t}" not in content_md)]
-                hint = "、".join(missing) if missing else "剩余章节"
-                yield _sse("progress", {"stage": f"继续生成（第{rounds}轮）", "missing": missing})
-
-                continue_messages = messages + [
-                    {"role": "assistant", "content": content_md},
-                    {"role": "user", "content":
-                        f"请从上次中断处继续写作，补齐未完成章节（{hint}）。"
-                        "不要重复已写内容，延续编号与格式，直到所有章节输出完毕。"}
-                ]
-                fr = yield from stream_once(continue_messages, rounds + 1, max_out)
+                # 只回传尾窗 + 大纲：每轮输入 ≈ 原始提示 + 常数，不随已写长度增长
+                continue_messages = build_continuation_messages(messages, content_md, missing)
+                cont_prompt = est_tokens_from_messages(continue_messages)
+                cont_max = continuation_budget(ctx_limit, cont_prompt, content_md, done, len(missing))
+                if cont_max <= 0:
+                    logger.warning("continuation skipped: no context room (prompt=%s, limit=%s)", cont_prompt, ctx_limit)
+                    yield _sse("progress", {"stage": "上下文余量不足，停止续写", "missing": missing,
+                                            "prompt_tokens": cont_prompt})
+                    break
+                yield _sse("progress", {"stage": f"继续生成（第{rounds}轮）", "missing": missing,
+                                        "prompt_tokens": cont_prompt, "max_tokens": cont_max})
+
+                fr = yield from stream_once(continue_messages, rounds + 1, cont_max)
                 done = count_done_sections(content_md)
                 need_continue = (fr == "length") or (done < len(section_titles))
 
@@ -849,26 +931,23 @@ def report_stream(payload: GeneratePayload, _=Depends(auth_check)):
                 }
             }
 
-            if EXPORT_ENABLED and content_md.strip():
-                try:
-                    day = dt.datetime.utcnow().strftime("%Y%m%d")
-                    base_path = f"{day}/{job_id}"
-                    docx_bytes = export_docx(content_md)
-                    pdf_bytes  = export_pdf(content_md)
-                    docx_url = upload_bytes_to_storage(
-                        f"{base_path}/report.docx", docx_bytes,
-                        "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                    )
-                    pdf_url  = upload_bytes_to_storage(f"{base_path}/report.pdf", pdf_bytes, "application/pdf")
-                    result.update({
-                        "docx_url": docx_url,
-                        "pdf_url": pdf_url,
-                        "file_name": f"{p.company_name}_报告_{p.start.year}{p.start.quarter}-{p.end.year}{p.end.quarter}.pdf"
-                    })
-                except Exception as e:
-                    result["export_error"] = str(e)
+            export_queued = bool(EXPORT_ENABLED and content_md.strip())
+            if export_queued:
+                submit_report_exports(
+                    job_id, content_md,
+                    f"{p.company_name}_报告_{p.start.year}{p.start.quarter}-{p.end.year}{p.end.quarter}.pdf"
+                )
+                result.update({"export_job_id": job_id, "export_status_url": f"/report/jobs/{job_id}"})
 
             yield _sse("result", result)
+
+            # 正文先到；导出在后台并行渲染，完成后同一连接补发 export 事件
+            if export_queued:
+                job = EXPORT_JOBS.get(job_id)
+                while job and job["status"] == "running":
+                    job = EXPORT_JOBS.wait(job_id, timeout=5)
+                    yield _sse("heartbeat", "1")
+                yield _sse("export", {**(job or {}), **job_urls(job)})
         except Exception as e:
             yield _sse("error", {"message": f"result_failed: {e}"})
         finally:
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+PostgREST 连接池
+- 进程内共享一个 requests.Session：按 host 复用 keep-alive 连接，避免每次查询重新握手 TCP/TLS
+- 连接池大小、超时、重试均可通过环境变量配置
+- 记录请求级统计（次数/错误/耗时分位），供各 agent 的 /healthz 暴露
+
+环境变量：
+  SB_POOL_CONNECTIONS=8     # 缓存的 host 连接池个数
+  SB_POOL_MAXSIZE=32        # 每个 host 最多保持的连接数（≈ 并发上限）
+  SB_CONNECT_TIMEOUT=5      # 建连超时（秒）
+  SB_READ_TIMEOUT=20        # 读超时（秒）
+  SB_RETRIES=1              # 连接类错误的重试次数（仅 GET）
+"""
+from __future__ import annotations
+import os, time, threading
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib3.util.retry import Retry
+except Exception:  # pragma: no cover
+    Retry = None
+
+SB_POOL_CONNECTIONS = int(os.getenv("SB_POOL_CONNECTIONS") or 8)
+SB_POOL_MAXSIZE     = int(os.getenv("SB_POOL_MAXSIZE") or 32)
+SB_CONNECT_TIMEOUT  = float(os.getenv("SB_CONNECT_TIMEOUT") or 5)
+SB_READ_TIMEOUT     = float(os.getenv("SB_READ_TIMEOUT") or 20)
+SB_RETRIES          = int(os.getenv("SB_RETRIES") or 1)
+
+_SESSION: Optional[requests.Session] = None
+_SESSION_LOCK = threading.Lock()
+
+# ---------------- stats ---------------- #
+_STATS_LOCK = threading.Lock()
+_LAT_WINDOW = deque(maxlen=1024)   # 最近 N 次请求耗时（ms），用于分位数
+_STATS: Dict[str, Any] = {
+    "requests": 0,
+    "errors": 0,        # 网络/超时异常
+    "http_errors": 0,   # status >= 400
+    "in_flight": 0,
+    "total_ms": 0.0,
+    "max_ms": 0.0,
+    "started_at": time.time(),
+}
+
+
+def get_session() -> requests.Session:
+    """懒加载的全局 Session（线程安全创建）。"""
+    global _SESSION
+    if _SESSION is not None:
+        return _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            s = requests.Session()
+            retry = None
+            if Retry is not None and SB_RETRIES > 0:
+                retry = Retry(
+                    total=SB_RETRIES, connect=SB_RETRIES, read=0, status=0,
+                    backoff_factor=0.1, allowed_methods=frozenset({"GET", "HEAD"}),
+                )
+            adapter = HTTPAdapter(
+                pool_connections=SB_POOL_CONNECTIONS,
+                pool_maxsize=SB_POOL_MAXSIZE,
+                max_retries=retry or 0,
+                pool_block=False,
+            )
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            s.headers.update({"Connection": "keep-alive", "Accept": "application/json"})
+            _SESSION = s
+    return _SESSION
+
+
+def _timeout(timeout: Optional[float]) -> Tuple[float, float]:
+    return (SB_CONNECT_TIMEOUT, float(timeout) if timeout else SB_READ_TIMEOUT)
+
+
+def _record(ms: float, *, error: bool = False, http_error: bool = False) -> None:
+    with _STATS_LOCK:
+        _STATS["requests"] += 1
+        _STATS["in_flight"] -= 1
+        _STATS["total_ms"] += ms
+        if ms > _STATS["max_ms"]:
+            _STATS["max_ms"] = ms
+        if error:
+            _STATS["errors"] += 1
+        if http_error:
+            _STATS["http_errors"] += 1
+        _LAT_WINDOW.append(ms)
+
+
+def sb_request(method: str, base_url: str, key: str, path: str, *,
+               params: Optional[Dict[str, Any]] = None,
+               json_body: Any = None,
+               headers: Optional[Dict[str, str]] = None,
+               timeout: Optional[float] = None) -> requests.Response:
+    """
+    通过共享连接池访问 {base_url}/rest/v1/{path}；返回原始 Response（不判断状态码），
+    由调用方沿用各自的错误处理方式（HTTPException / raise_for_status）。
+    """
+    url = f"{base_url.rstrip('/')}/rest/v1/{path.lstrip('/')}"
+    h = {"apikey": key, "Authorization": f"Bearer {key}"}
+    if headers:
+        h.update(headers)
+    with _STATS_LOCK:
+        _STATS["in_flight"] += 1
+    t0 = time.perf_counter()
+    try:
+        r = get_session().request(method, url, params=params, json=json_body,
+                                  headers=h, timeout=_timeout(timeout))
+    except Exception:
+        _record((time.perf_counter() - t0) * 1000, error=True)
+        raise
+    _record((time.perf_counter() - t0) * 1000, http_error=r.status_code >= 400)
+    return r
+
+
+def sb_get(base_url: str, key: str, path: str, params: Optional[Dict[str, Any]] = None,
+           timeout: Optional[float] = None) -> requests.Response:
+    return sb_request("GET", base_url, key, path, params=params, timeout=timeout)
+
+
+def _pct(sorted_vals, q: float) -> Optional[float]:
+    if not sorted_vals:
+        return None
+    idx = min(len(sorted_vals) - 1, max(0, int(round(q * (len(sorted_vals) - 1)))))
+    return round(sorted_vals[idx], 2)
+
+
+def pool_stats() -> Dict[str, Any]:
+    """连接池配置 + 请求统计快照（/healthz 用）。"""
+    with _STATS_LOCK:
+        snap = dict(_STATS)
+        lat = sorted(_LAT_WINDOW)
+    n = snap["requests"]
+    return {
+        "pool": {
+            "connections": SB_POOL_CONNECTIONS,
+            "maxsize": SB_POOL_MAXSIZE,
+            "connect_timeout_s": SB_CONNECT_TIMEOUT,
+            "read_timeout_s": SB_READ_TIMEOUT,
+            "retries": SB_RETRIES,
+        },
+        "requests": n,
+        "errors": snap["errors"],
+        "http_errors": snap["http_errors"],
+        "in_flight": snap["in_flight"],
+        "avg_ms": round(snap["total_ms"] / n, 2) if n else None,
+        "p50_ms": _pct(lat, 0.50),
+        "p95_ms": _pct(lat, 0.95),
+        "max_ms": round(snap["max_ms"], 2),
+        "uptime_s": round(time.time() - snap["started_at"], 1),
+    }
+
+
+def reset_stats() -> None:
+    with _STATS_LOCK:
+        in_flight = _STATS["in_flight"]
+        _STATS.update({"requests": 0, "errors": 0, "http_errors": 0, "total_ms": 0.0,
+                       "max_ms": 0.0, "started_at": time.time(), "in_flight": in_flight})
+        _LAT_WINDOW.clear()
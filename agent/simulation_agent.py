@@ -1,6 +1,7 @@
 # simulation_agent.py
 import os, io, csv, json, hashlib, datetime as dt, re
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable
+from contextvars import ContextVar
 from uuid import uuid4
 
 from fastapi import FastAPI, UploadFile, File, Form, Body, HTTPException
@@ -10,8 +11,6 @@ from pydantic import BaseModel
 from supabase import create_client, Client
 import numpy as np
 
-# ARIMA
-from statsmodels.tsa.arima.model import ARIMA
 
 # 新增：导出 XLSX（带公式与加粗分隔）
 from openpyxl import Workbook
@@ -26,11 +25,35 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 
 sb: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
-# （可选）OpenAI，用于 LLM 提示
-import openai
+# 共享 catalog 快照缓存（兼容 `uvicorn agent.simulation_agent:app` 与 agent/ 目录内启动）
+try:
+    from agent.catalog_cache import CatalogCache, postgrest_probe
+except ImportError:
+    from catalog_cache import CatalogCache, postgrest_probe
+try:
+    from agent.llm_cache import LLM_CACHE
+except ImportError:
+    from llm_cache import LLM_CACHE
+try:
+    from agent.montecarlo import run_scenarios
+except ImportError:
+    from montecarlo import run_scenarios
+try:
+    from agent.forecasting import forecast_many, forecast_one
+except ImportError:
+    from forecasting import forecast_many, forecast_one
+
+# （可选）OpenAI 兼容接口，用于 LLM 提示；经共享网关调用（连接池 + 限流）
+try:
+    from agent.llm_gateway import get_gateway
+except ImportError:
+    from llm_gateway import get_gateway
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if OPENAI_API_KEY:
-    openai.api_key = OPENAI_API_KEY
+OPENAI_BASE_URL = (os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1").strip().rstrip("/")
+_LLM = get_gateway(OPENAI_BASE_URL, OPENAI_API_KEY or "")
+
+# Monte Carlo 单次路径数上限（向量化引擎 10 万级路径为亚秒级）
+MC_MAX_SAMPLES = int(os.getenv("MC_MAX_SAMPLES") or 200000)
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID")
@@ -154,20 +177,9 @@ def now_iso() -> str:
     return dt.datetime.now(dt.timezone.utc).isoformat()
 
 def arima_baseline(series: List[float], p: int, d: int, q: int, periods: int) -> Dict[str, Any]:
-    # 简易 ARIMA；失败则平滑外推
-    try:
-        model = ARIMA(series, order=(p, d, q))
-        res = model.fit()
-        forecast = list(res.forecast(steps=periods))
-        conf_int = res.get_forecast(steps=periods).conf_int(alpha=0.05).tolist()
-        lower95 = [float(x[0]) for x in conf_int]
-        upper95 = [float(x[1]) for x in conf_int]
-        return {"pred": forecast, "lower95": lower95, "upper95": upper95}
-    except Exception:
-        if not series:
-            return {"pred": [0.0]*periods, "lower95": [0.0]*periods, "upper95": [0.0]*periods}
-        last = series[-1]
-        return {"pred": [last for _ in range(periods)], "lower95": [last for _ in range(periods)], "upper95": [last for _ in range(periods)]}
+    # 简易 ARIMA（单次拟合 + 按序列哈希缓存）；失败则平滑外推
+    r = forecast_one(series, (p, d, q), periods)
+    return {"pred": r["pred"], "lower95": r["lower95"], "upper95": r["upper95"]}
 def google_search_snippets(query: str, topk: int = 3) -> List[Dict[str, str]]:
     if not GOOGLE_API_KEY or not GOOGLE_CSE_ID:
         return []
@@ -189,9 +201,66 @@ def google_search_snippets(query: str, topk: int = 3) -> List[Dict[str, str]]:
         return out
     except Exception:
         return []
+# ---------------- 序列取数（run 级缓存） ---------------- #
+_SERIES_COLS = "company_name, metric_name, year, quarter, metric_value"
+_SERIES_PAGE = 1000
+
+def _fetch_series(companies: List[str], metrics: List[str]) -> List[Dict[str, Any]]:
+    """按 (company in, metric in) 取全部历史，按 year/quarter 升序；分页绕开 PostgREST 单次行数上限"""
+    out: List[Dict[str, Any]] = []
+    off = 0
+    while True:
+        page = (sb.table("financial_metrics")
+                .select(_SERIES_COLS)
+                .in_("company_name", companies)
+                .in_("metric_name", metrics)
+                .order("year", desc=False)
+                .order("quarter", desc=False)
+                .range(off, off + _SERIES_PAGE - 1)
+                .execute().data or [])
+        out.extend(page)
+        if len(page) < _SERIES_PAGE:
+            return out
+        off += _SERIES_PAGE
+
+class SeriesStore:
+    """
+    单次 /simulation_v2/run 内的 financial_metrics 序列缓存：
+    开局用一次 in_() 批量预取所有 (company, metric) 历史，之后基线/季调/加法偏移/锚点等读取都走内存。
+    未预取的组合首次访问时单独取一次并记住。
+    """
+    def __init__(self) -> None:
+        self._rows: Dict[tuple, List[Dict[str, Any]]] = {}
+        self.queries = 0
+
+    def preload(self, companies: Iterable[str], metrics: Iterable[str]) -> None:
+        cs = sorted({c for c in companies if c})
+        ms = sorted({m for m in metrics if m})
+        ms = [m for m in ms if any((c, m) not in self._rows for c in cs)]
+        if not cs or not ms:
+            return
+        rows = _fetch_series(cs, ms)
+        self.queries += 1
+        for c in cs:
+            for m in ms:
+                self._rows.setdefault((c, m), [])
+        for r in rows:
+            self._rows.setdefault((r.get("company_name"), r.get("metric_name")), []).append(r)
+
+    def rows(self, company: str, metric: str, max_points: int = 40) -> List[Dict[str, Any]]:
+        key = (company, metric)
+        if key not in self._rows:
+            self.preload([company], [metric])
+        return list(self._rows.get(key, [])[:max_points])
+
+_RUN_SERIES: ContextVar[Optional[SeriesStore]] = ContextVar("sim_run_series", default=None)
+
 def load_series_rows(company: str, metric: str, max_points: int = 40) -> List[Dict[str, Any]]:
+    store = _RUN_SERIES.get()
+    if store is not None:
+        return store.rows(company, metric, max_points)
     rows = (sb.table("financial_metrics")
-            .select("company_name, metric_name, year, quarter, metric_value")
+            .select(_SERIES_COLS)
             .eq("company_name", company)
             .eq("metric_name", metric)
             .order("year", desc=False)
@@ -223,11 +292,28 @@ def q_forward(y: int, q: int, steps: int, mark_est: bool = True) -> List[str]:
             lab += "(e)"
         out.append(lab)
     return out
-def llm_infer_sensitivity(company: str, y_metric: str, x_metric: str, run_id: Optional[str] = None) -> Dict[str, Any]:
-    """
-    数据→(QoQ/YoY)→最小二乘 OLS 给出“统计参考β”，然后把该统计结果 + 附件摘要交给 LLM，请其在统计值附近做口径校准。
-    返回：{"beta": float or None, "rationale": str, "method": "qoq|yoy|expert"}
-    """
+def _run_attachment_snips(run_id: Optional[str]) -> List[Dict[str, str]]:
+    """run 附件（CSV）前 5 行摘要；同一次请求内只取一次"""
+    attach_snips = []
+    if run_id:
+        try:
+            atts = sb.table("run_attachments").select("*").eq("run_id", run_id).order("id", desc=True).limit(5).execute().data or []
+            for a in atts:
+                url = a.get("storage_url"); fname = a.get("filename")
+                if url and fname and fname.lower().endswith(".csv"):
+                    try:
+                        import httpx
+                        with httpx.Client(timeout=15) as cli:
+                            t = cli.get(url).text.splitlines()[:5]
+                        attach_snips.append({"filename": fname, "preview": "\n".join(t)})
+                    except Exception:
+                        attach_snips.append({"filename": fname, "preview": "(读取失败，忽略)"})
+        except Exception:
+            pass
+    return attach_snips
+
+def _sensitivity_stats(company: str, y_metric: str, x_metric: str) -> Dict[str, Any]:
+    """X/Y 的 QoQ/YoY 百分比变化序列 → 过原点最小二乘 β 与相关系数"""
     # 1) 原始行
     y_rows = load_series_rows(company, y_metric, max_points=24)
     x_rows = load_series_rows(company, x_metric, max_points=24)
@@ -278,30 +364,38 @@ def llm_infer_sensitivity(company: str, y_metric: str, x_metric: str, run_id: Op
 
     beta_qoq, corr_qoq = ols_beta(qoq_X, qoq_Y)
     beta_yoy, corr_yoy = ols_beta(yoy_X, yoy_Y)
+    return {
+        "beta_qoq": beta_qoq, "corr_qoq": corr_qoq,
+        "beta_yoy": beta_yoy, "corr_yoy": corr_yoy,
+        "n_qoq": len(qoq_X), "n_yoy": len(yoy_X)
+    }
+
+def _ols_fallback(stats: Dict[str, Any], rationale: str) -> Dict[str, Any]:
+    # 优先 YoY，再 QoQ
+    beta_yoy, beta_qoq = stats.get("beta_yoy"), stats.get("beta_qoq")
+    beta = beta_yoy if beta_yoy is not None else beta_qoq
+    return {"beta": beta, "rationale": rationale, "method": "yoy" if beta==beta_yoy else "qoq"}
+
+def _merge_llm_beta(d: Dict[str, Any], stats: Dict[str, Any]) -> Dict[str, Any]:
+    beta_yoy, beta_qoq = stats.get("beta_yoy"), stats.get("beta_qoq")
+    beta = d.get("beta")
+    method = d.get("method") or ("yoy" if beta_yoy is not None else "qoq")
+    beta = float(beta) if beta is not None else (beta_yoy if beta_yoy is not None else beta_qoq)
+    return {"beta": beta, "rationale": d.get("rationale",""), "method": method}
+
+def llm_infer_sensitivity(company: str, y_metric: str, x_metric: str, run_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    数据→(QoQ/YoY)→最小二乘 OLS 给出“统计参考β”，然后把该统计结果 + 附件摘要交给 LLM，请其在统计值附近做口径校准。
+    返回：{"beta": float or None, "rationale": str, "method": "qoq|yoy|expert"}
+    """
+    stats = _sensitivity_stats(company, y_metric, x_metric)
 
     # 3) 附件（CSV）摘要（与原逻辑相同）
-    attach_snips = []
-    if run_id:
-        try:
-            atts = sb.table("run_attachments").select("*").eq("run_id", run_id).order("id", desc=True).limit(5).execute().data or []
-            for a in atts:
-                url = a.get("storage_url"); fname = a.get("filename")
-                if url and fname and fname.lower().endswith(".csv"):
-                    try:
-                        import httpx
-                        with httpx.Client(timeout=15) as cli:
-                            t = cli.get(url).text.splitlines()[:5]
-                        attach_snips.append({"filename": fname, "preview": "\n".join(t)})
-                    except Exception:
-                        attach_snips.append({"filename": fname, "preview": "(读取失败，忽略)"})
-        except Exception:
-            pass
+    attach_snips = _run_attachment_snips(run_id)
 
     # 4) 无 Key：直接返回 OLS 结果（或 None）
     if not OPENAI_API_KEY:
-        # 优先 YoY，再 QoQ
-        beta = beta_yoy if beta_yoy is not None else beta_qoq
-        return {"beta": beta, "rationale": "LLM disabled. Returned OLS estimate.", "method": "yoy" if beta==beta_yoy else "qoq"}
+        return _ols_fallback(stats, "LLM disabled. Returned OLS estimate.")
 
     # 5) 让 LLM 在统计值基础上校准（优先改提示词）
     sys_prompt = """你是财务灵敏度估计助手。
@@ -313,26 +407,103 @@ def llm_infer_sensitivity(company: str, y_metric: str, x_metric: str, run_id: Op
     payload = {
         "company": company,
         "Y_metric": y_metric, "X_metric": x_metric,
-        "stats": {
-            "beta_qoq": beta_qoq, "corr_qoq": corr_qoq,
-            "beta_yoy": beta_yoy, "corr_yoy": corr_yoy,
-            "n_qoq": len(qoq_X), "n_yoy": len(yoy_X)
-        },
+        "stats": stats,
         "attachments_preview": attach_snips
     }
 
     try:
-        txt = call_llm(sys_prompt, json.dumps(payload, ensure_ascii=False))
-        data = json.loads(txt)
-        beta = data.get("beta")
-        method = data.get("method") or ("yoy" if beta_yoy is not None else "qoq")
-        beta = float(beta) if beta is not None else (beta_yoy if beta_yoy is not None else beta_qoq)
-        return {"beta": beta, "rationale": data.get("rationale",""), "method": method}
+        txt = call_llm(sys_prompt, json.dumps(payload, ensure_ascii=False), cache=True)
+        return _merge_llm_beta(json.loads(txt), stats)
     except Exception:
         # 失败时回退到 OLS
-        beta = beta_yoy if beta_yoy is not None else beta_qoq
-        return {"beta": beta, "rationale": "LLM parse fail. Fallback to OLS.", "method": "yoy" if beta==beta_yoy else "qoq"}
+        return _ols_fallback(stats, "LLM parse fail. Fallback to OLS.")
 
+SENS_LLM_BATCH = int(os.getenv("SIM_SENS_LLM_BATCH") or 24)   # 单次 LLM 调用最多覆盖的 (X,Y) 组合数
+
+SYS_SENS_BATCH = """你是财务灵敏度估计助手。
+现在给你多组 (X, Y) 的 QoQ/YoY 百分比变化序列的最小二乘回归结果（通过原点）：beta_qoq/beta_yoy 及对应相关系数。
+请对每一组分别结合统计结果 + 附件片段，产出一个“合理且可解释”的 β。若两者差异大，请给出选择理由。
+只返回JSON，items 与输入 pairs 一一对应（保留 X_metric/Y_metric 原样）：
+{"items": [{"X_metric": "…", "Y_metric": "…", "beta": 0.12, "method":"yoy|qoq|expert", "rationale": "…"}]}"""
+
+def llm_infer_sensitivity_batch(company: str, pairs: List[tuple],
+                                run_id: Optional[str] = None) -> Dict[tuple, Dict[str, Any]]:
+    """
+    批量版 llm_infer_sensitivity：pairs = [(y_metric, x_metric), ...]
+    统计量在本地逐对计算（序列走 run 级缓存），附件只取一次，所有缺失组合合并成一次 LLM 调用
+    （超过 SENS_LLM_BATCH 时分块）；某组未返回或解析失败则回退到该组的 OLS 结果。
+    返回 {(y_metric, x_metric): {"beta","rationale","method"}}
+    """
+    pairs = list(dict.fromkeys(pairs))
+    stats = {p: _sensitivity_stats(company, p[0], p[1]) for p in pairs}
+    if not pairs:
+        return {}
+    if not OPENAI_API_KEY:
+        return {p: _ols_fallback(stats[p], "LLM disabled. Returned OLS estimate.") for p in pairs}
+
+    attach_snips = _run_attachment_snips(run_id)
+    out: Dict[tuple, Dict[str, Any]] = {}
+    for i in range(0, len(pairs), max(1, SENS_LLM_BATCH)):
+        chunk = pairs[i:i + max(1, SENS_LLM_BATCH)]
+        payload = {
+            "company": company,
+            "pairs": [{"Y_metric": y, "X_metric": x, "stats": stats[(y, x)]} for (y, x) in chunk],
+            "attachments_preview": attach_snips
+        }
+        try:
+            txt = call_llm(SYS_SENS_BATCH, json.dumps(payload, ensure_ascii=False), cache=True)
+            items = json.loads(txt).get("items") or []
+            for it in items:
+                key = ((it or {}).get("Y_metric"), (it or {}).get("X_metric"))
+                if key in stats and key not in out:
+                    try:
+                        out[key] = _merge_llm_beta(it, stats[key])
+                    except Exception:
+                        pass
+        except Exception:
+            pass
+    for p in pairs:
+        if p not in out:
+            out[p] = _ols_fallback(stats[p], "LLM parse fail. Fallback to OLS.")
+    return out
+
+
+def _mc_drivers(sensitivity_rows: List[SensitivityRow],
+                deltas: Optional[Dict[str, Dict[str, float]]],
+                labels: List[str]):
+    """把敏感性行整理成引擎输入：betas/lags + 每个情景的 ΔX（非 percent 单位或 β=0 的行不参与）"""
+    betas, lags = [], []
+    dx: Dict[str, List[float]] = {lb: [] for lb in labels}
+    for row in sensitivity_rows:
+        beta = row.elasticity_value or 0.0
+        if beta == 0.0:
+            continue
+        betas.append(float(beta))
+        lags.append(max(0, int(row.lag_quarters or 0)))
+        for lb in labels:
+            v = 0.0
+            if row.shock_unit == "percent" and deltas and row.factor_name in deltas:
+                v = float(deltas[row.factor_name].get(lb, 0.0))
+            dx[lb].append(v)
+    return betas, lags, dx
+
+def monte_carlo_scenarios(baseline: List[float],
+                          sensitivity_rows: List[SensitivityRow],
+                          samples: int,
+                          horizon: int,
+                          deltas: Optional[Dict[str, Dict[str, float]]] = None,
+                          labels: Optional[List[str]] = None,
+                          quantiles: Optional[List[float]] = None,
+                          seed: Optional[int] = None) -> Dict[str, Dict[str, List[float]]]:
+    """
+    采用“乘法合成”：Y_hat_t * Π_k (1 + beta_k * ΔX_k)，ΔX_k 取自 deltas[factor][label]。
+    一次向量化抽样覆盖全部情景，返回 {label: {pXX..., mean, std}}。
+    """
+    labels = labels or ["base"]
+    betas, lags, dx = _mc_drivers(sensitivity_rows, deltas, labels)
+    base = list(baseline)[:horizon]
+    return run_scenarios(base, betas, lags, dx, samples,
+                         quantiles=quantiles or [0.1, 0.5, 0.9], seed=seed)
 
 def monte_carlo_paths(baseline: List[float],
                       sensitivity_rows: List[SensitivityRow],
@@ -340,42 +511,9 @@ def monte_carlo_paths(baseline: List[float],
                       horizon: int,
                       deltas: Optional[Dict[str, Dict[str, float]]] = None,
                       label: str = "base") -> Dict[str, List[float]]:
-    """
-    采用“乘法合成”：Y_hat_t * Π_k (1 + beta_k * ΔX_k)。
-    这里将 ΔX_k 取自情景字典 deltas[factor][label]，默认 label='base'。
-    """
-    T = horizon
-    base = np.array(baseline, dtype=float)
-    mat = np.zeros((samples, T), dtype=float)
-    mat += base
-    for s in range(samples):
-        factor_mult = np.ones(T, dtype=float)
-        for row in sensitivity_rows:
-            beta = row.elasticity_value or 0.0
-            if beta == 0.0:
-                continue
-            sigma = max(0.0001, 0.2 * abs(beta))
-            beta_draw = np.random.normal(beta, sigma)
-            lag = max(0, int(row.lag_quarters or 0))
-
-            # 以情景的 base 作为中心，不再硬编码 0.1
-            dx = 0.0
-            if row.shock_unit == "percent":
-                if deltas and row.factor_name in deltas:
-                    dx = float(deltas[row.factor_name].get(label, 0.0))
-
-            shock_vec = np.array([(1.0 + beta_draw * dx)] * T)
-            if lag > 0:
-                shock_vec[:lag] = 1.0
-            factor_mult *= shock_vec
-        mat[s, :] = base * factor_mult
-
-    pcts = {
-        "p10": list(np.percentile(mat, 10, axis=0)),
-        "p50": list(np.percentile(mat, 50, axis=0)),
-        "p90": list(np.percentile(mat, 90, axis=0)),
-    }
-    return pcts
+    """兼容旧接口：单情景 p10/p50/p90（另附 mean/std）"""
+    return monte_carlo_scenarios(baseline, sensitivity_rows, samples, horizon,
+                                 deltas=deltas, labels=[label])[label]
 
 def pick_default_Y_from_catalog(catalog: List[str], k: int = 3) -> List[str]:
     """
@@ -423,7 +561,7 @@ def llm_infer_seasonality(company: str, y_metric: str, run_id: Optional[str] = N
 
     user = json.dumps({"company": company, "metric": y_metric, "series": series, "attachments_preview": attach_snips}, ensure_ascii=False)
     try:
-        txt = call_llm(sys, user); d = json.loads(txt)
+        txt = call_llm(sys, user, cache=True); d = json.loads(txt)
         return {
             "seasonal_adjust": bool(d.get("seasonal_adjust", False)),
             "q1": d.get("q1"), "q2": d.get("q2"), "q3": d.get("q3"), "q4": d.get("q4"),
@@ -527,24 +665,85 @@ SYS_REPORT = """你是报告撰写助手。请输出结构化 Markdown（300-600
 """
 
 
-def call_llm(system_prompt: str, user_content: str) -> str:
+SIM_LLM_MODEL = "gpt-4o-mini"
+
+def call_llm(system_prompt: str, user_content: str, cache: bool = False) -> str:
+    """
+    cache=True：按 (model, messages, temperature) 内容寻址缓存；仅缓存可解析为 JSON 的输出，
+    用于 llm_infer_sensitivity / llm_infer_seasonality 这类相同输入应得相同结论的调用。
+    """
     if not OPENAI_API_KEY:
         # 无 Key 时返回最小占位
         return '{"company": "", "X": [], "Y": [], "notes": "LLM disabled."}'
-    resp = openai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role":"system","content":system_prompt},
-                  {"role":"user","content":user_content}],
-        temperature=0.2,
-    )
-    return resp.choices[0].message.content
+    messages = [{"role":"system","content":system_prompt},
+                {"role":"user","content":user_content}]
+
+    def _call() -> str:
+        return _LLM.chat(messages, model=SIM_LLM_MODEL, temperature=0.2)
+
+    if not cache:
+        return _call()
+
+    def _is_json(txt: Any) -> bool:
+        try:
+            json.loads(txt)
+            return True
+        except Exception:
+            return False
+
+    return LLM_CACHE.cached(SIM_LLM_MODEL, messages, 0.2, _call, accept=_is_json)
 
 # =============== Supabase 访问 ===============
 def sb_table_all(table: str) -> List[Dict[str, Any]]:
     return sb.table(table).select("*").execute().data
 
+# ---- catalog 快照（后台按版本探测刷新；请求路径不再整表拉取） ----
+_ALIAS_SPLIT = re.compile(r"[,，/、|;；\s]+")
+
+def _alias_key(x: Any) -> str:
+    return str(x).strip().lower()
+
+def _split_alias_tokens(s: Any) -> List[str]:
+    """支持把 "别名1,别名2/别名3；别名4" 这类分隔串拆开"""
+    if s is None:
+        return []
+    parts = [p.strip() for p in _ALIAS_SPLIT.split(str(s)) if p and p.strip()]
+    return parts or [str(s).strip()]  # 如果没有命中分隔符，就按单值处理
+
+def _build_metric_index(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """建索引：alias/aliases → canonical_name"""
+    idx: Dict[str, str] = {}
+    for r in rows:
+        cn = (r.get("canonical_name") or "").strip()
+        if not cn:
+            continue
+        # 自身也允许匹配
+        idx[_alias_key(cn)] = cn
+        # 单值 alias
+        for tok in _split_alias_tokens(r.get("alias")):
+            idx[_alias_key(tok)] = cn
+        # 数组 aliases
+        arr = r.get("aliases") or []
+        if isinstance(arr, (list, tuple)):
+            for tok in arr:
+                for t in _split_alias_tokens(tok):
+                    idx[_alias_key(t)] = cn
+    return {"rows": rows, "idx": idx}
+
+_METRIC_CAT = CatalogCache(
+    "metric_alias_catalog",
+    lambda: sb.table("metric_alias_catalog").select("*").execute().data or [],
+    build=_build_metric_index,
+    probe=postgrest_probe(SUPABASE_URL, SUPABASE_KEY, "metric_alias_catalog"),
+)
+_COMPANY_CAT = CatalogCache(
+    "company_catalog",
+    lambda: sb.table("company_catalog").select("*").execute().data or [],
+    probe=postgrest_probe(SUPABASE_URL, SUPABASE_KEY, "company_catalog"),
+)
+
 def find_company_by_name_or_best(question: str) -> str:
-    rows = sb.table("company_catalog").select("*").execute().data or []
+    rows = _COMPANY_CAT.get().data
     text = (question or "").lower()
     best = (rows[0].get("display_name") if rows else None) or "XX集团公司"
     for r in rows:
@@ -575,53 +774,20 @@ def as_list(x) -> List[str]:
 def alias_to_canonical(names: List[str]) -> List[str]:
     if not names:
         return []
-    rows = sb.table("metric_alias_catalog").select("*").execute().data or []
-
-    # 小工具：统一 key
-    def _key(x: Any) -> str:
-        return str(x).strip().lower()
-
-    # 支持把 "别名1,别名2/别名3；别名4" 这类分隔串拆开
-    SPLIT = re.compile(r"[,，/、|;；\s]+")
-    def _split_tokens(s: Any) -> List[str]:
-        if s is None:
-            return []
-        parts = [p.strip() for p in SPLIT.split(str(s)) if p and p.strip()]
-        return parts or [str(s).strip()]  # 如果没有命中分隔符，就按单值处理
-
-    # 建索引：alias/aliases → canonical_name
-    idx: Dict[str, str] = {}
-    for r in rows:
-        cn = (r.get("canonical_name") or "").strip()
-        if not cn:
-            continue
-        # 自身也允许匹配
-        idx[_key(cn)] = cn
-
-        # 单值 alias
-        a1 = r.get("alias")
-        for tok in _split_tokens(a1):
-            idx[_key(tok)] = cn
-
-        # 数组 aliases
-        arr = r.get("aliases") or []
-        if isinstance(arr, (list, tuple)):
-            for tok in arr:
-                for t in _split_tokens(tok):
-                    idx[_key(t)] = cn
+    idx = _METRIC_CAT.get().data["idx"]
 
     # 映射输入
     out: List[str] = []
     for nm in names:
-        k = _key(nm)
+        k = _alias_key(nm)
         out.append(idx.get(k, nm))  # 命中则回 canonical，否则保留原词
     # 去重保序
     return list(dict.fromkeys(out))
 
 
 def list_candidate_Y() -> List[str]:
-    rows = sb.table("metric_alias_catalog").select("canonical_name").execute().data
-    return sorted(list({r["canonical_name"] for r in rows}))
+    rows = _METRIC_CAT.get().data["rows"]
+    return sorted(list({r["canonical_name"] for r in rows if r.get("canonical_name")}))
 
 def load_series_from_financial_metrics(company: str, metric: str, max_points: int = 40) -> List[float]:
     """
@@ -629,16 +795,22 @@ def load_series_from_financial_metrics(company: str, metric: str, max_points: in
     注意：financial_metrics 表没有 canonical_name，使用 metric_name 对齐。
     这里的 metric 传入值为“canonical 指标名”，需与 financial_metrics.metric_name 一致。
     """
-    rows = (sb.table("financial_metrics")
-            .select("company_name, metric_name, year, quarter, metric_value")
-            .eq("company_name", company)
-            .eq("metric_name", metric)      # ← 改用 metric_name
-            .order("year", desc=False)
-            .order("quarter", desc=False)
-            .limit(max_points)
-            .execute().data)
+    rows = load_series_rows(company, metric, max_points=max_points)
     return [float(r["metric_value"]) for r in rows] if rows else []
 
+def load_sensitivity_rows(company: str, metrics: List[str]) -> List[Dict[str, Any]]:
+    """(company, canonical_metric in metrics) 的全部敏感性行，一次查询；失败返回空"""
+    ms = sorted({m for m in metrics if m})
+    if not company or not ms:
+        return []
+    try:
+        return (sb.table("sensitivity_analysis").select("*")
+                .eq("company_name", company)
+                .in_("canonical_metric", ms)
+                .execute().data or [])
+    except Exception:
+        return []
+
 def lookup_sensitivity(company: str, metric: str, factor: str) -> Optional[float]:
     rows = (sb.table("sensitivity_analysis")
             .select("*")
@@ -754,6 +926,14 @@ async def upload_attachment(run_id: str = Form(...), file: UploadFile = File(...
 # =============== Seed：解析问题 → 候选敏感性表 + 参数建议 ===============
 @app.post("/simulation_v2/seed")
 def seed(req: SeedRequest):
+    # 与 run 相同：本次请求内的序列读取共用一个 SeriesStore
+    token = _RUN_SERIES.set(SeriesStore())
+    try:
+        return _seed(req)
+    finally:
+        _RUN_SERIES.reset(token)
+
+def _seed(req: SeedRequest):
     import traceback
     stage = "init"
     try:
@@ -767,9 +947,10 @@ def seed(req: SeedRequest):
         stage = "llm-parse"
         company_guess = find_company_by_name_or_best(req.question or "")
 
-        metric_rows = sb.table("metric_alias_catalog") \
-                    .select("canonical_name, description, category, aliases, is_derived") \
-                    .execute().data or []
+        metric_rows = [
+            {k: r.get(k) for k in ("canonical_name", "description", "category", "aliases", "is_derived")}
+            for r in _METRIC_CAT.get().data["rows"]
+        ]
         metric_catalog = [ (r.get("canonical_name") or "").strip() for r in metric_rows ]
 
 
@@ -841,81 +1022,87 @@ def seed(req: SeedRequest):
 
 
         # 2) 敏感性回填（去重 (x,y) 组合；优先DB，缺失则 LLM 推断）
+        #    一次 in_() 取齐 sensitivity_analysis；X∪Y 序列一次预取；缺失组合合并为一次批量 LLM 推断
         stage = "lookup-sensitivity"
+        pairs = list(dict.fromkeys((x, y) for x in (X_raw or []) for y in Y_raw))
+        sens_rows = load_sensitivity_rows(company, Y_raw) if pairs else []
+        by_pair: Dict[tuple, Dict[str, Any]] = {}
+        by_metric: Dict[str, Dict[str, Any]] = {}
+        for r in sens_rows:
+            by_pair.setdefault((r.get("canonical_metric"), r.get("factor_name")), r)
+            by_metric.setdefault(r.get("canonical_metric"), r)
+
+        store = _RUN_SERIES.get()
+        if store is not None and pairs:
+            store.preload([company], list(X_raw) + list(Y_raw))
+
+        missing = []
+        for (x, y) in pairs:
+            v = (by_pair.get((y, x)) or {}).get("elasticity_value")
+            if v is None:
+                missing.append((y, x))
+        inferred = llm_infer_sensitivity_batch(company, missing, run_id=run_id) if missing else {}
+
+        # —— 季节性：同样遵循“查库→LLM→用户可改”；按 Y 只判断一次 —— #
+        seasonality: Dict[str, Dict[str, Any]] = {}
+        for y in dict.fromkeys(y for (_x, y) in pairs):
+            rdb = by_metric.get(y)
+            if rdb and "seasonal_adjust" in rdb:
+                seasonality[y] = {
+                    "seasonal_adjust": bool(rdb.get("seasonal_adjust")),
+                    "source": "db", "note": "命中数据库",
+                    # 带回库里的季度系数（如有）
+                    "q": (rdb.get("seasonality_q1"), rdb.get("seasonality_q2"), rdb.get("seasonality_q3"), rdb.get("seasonality_q4")),
+                }
+            else:
+                s_inf = llm_infer_seasonality(company, y, run_id=run_id)
+                rz = s_inf.get("rationale") or ""
+                seasonality[y] = {
+                    "seasonal_adjust": bool(s_inf.get("seasonal_adjust", False)),
+                    "source": "llm", "note": f"LLM判断季节性｜{rz[:50]}",
+                    "q": (s_inf.get("q1"), s_inf.get("q2"), s_inf.get("q3"), s_inf.get("q4")),
+                }
+
         candidates = []
-        seen_pairs = set()
-        for x in (X_raw or []):
-            for y in Y_raw:
-                key = (x, y)
-                if key in seen_pairs:
-                    continue
-                seen_pairs.add(key)
-
-                sens = lookup_sensitivity(company, y, x)
-                src = "db" if sens is not None else "llm"
-                note = "命中数据库" if sens is not None else "LLM生成（基于表/附件推断）"
-                if sens is None:
-                    inf = llm_infer_sensitivity(company, y, x, run_id=run_id)
-                    sens = inf.get("beta")
-                    if inf.get("rationale"):
-                        note += f"｜{inf['rationale'][:60]}"
-
-                # —— 季节性：同样遵循“查库→LLM→用户可改” —— #
-                seasonal_adjust = None
-                seasonality_source = None
-                seasonality_note = None
-                s_q1 = s_q2 = s_q3 = s_q4 = None  # ← 新增初始化
-                try:
-                    row_db = (sb.table("sensitivity_analysis")
-                            .select("*").eq("company_name", company)
-                            .eq("canonical_metric", y).limit(1).execute().data)
-                    if row_db and "seasonal_adjust" in row_db[0]:
-                        rdb = row_db[0]
-                        seasonal_adjust = bool(rdb.get("seasonal_adjust"))
-                        seasonality_source = "db"
-                        seasonality_note = "命中数据库"
-                        # 带回库里的季度系数（如有）
-                        s_q1, s_q2, s_q3, s_q4 = rdb.get("seasonality_q1"), rdb.get("seasonality_q2"), rdb.get("seasonality_q3"), rdb.get("seasonality_q4")
-                except Exception:
-                    pass
-                if seasonal_adjust is None:
-                    s_inf = llm_infer_seasonality(company, y, run_id=run_id)
-                    seasonal_adjust = bool(s_inf.get("seasonal_adjust", False))
-                    seasonality_source = "llm"
-                    rz = s_inf.get("rationale") or ""
-                    s_q1, s_q2, s_q3, s_q4 = s_inf.get("q1"), s_inf.get("q2"), s_inf.get("q3"), s_inf.get("q4")
-                    seasonality_note = f"LLM判断季节性｜{rz[:50]}"
-
-                # 默认值
-                lag_q = 1
-                unit = "percent"
-                try:
-                    row_db = (sb.table("sensitivity_analysis")
-                            .select("*").eq("company_name", company)
-                            .eq("canonical_metric", y).eq("factor_name", x)
-                            .limit(1).execute().data)
-                    if row_db:
-                        if row_db[0].get("lag_quarters") is not None:
-                            lag_q = int(row_db[0]["lag_quarters"])
-                        if row_db[0].get("shock_unit"):
-                            unit = str(row_db[0]["shock_unit"])
-                except Exception:
-                    pass
-
-                candidates.append({
-                    "company_name": company,
-                    "canonical_metric": y,
-                    "factor_name": x,
-                    "elasticity_value": sens,
-                    "lag_quarters": lag_q,
-                    "shock_unit": unit,
-                    "source_method": src,
-                    "note": note,
-                    "seasonal_adjust": seasonal_adjust,
-                    "seasonality_source": seasonality_source,
-                    "seasonality_note": seasonality_note,
-                    "seasonality_q1": s_q1, "seasonality_q2": s_q2, "seasonality_q3": s_q3, "seasonality_q4": s_q4
-                    })
+        for (x, y) in pairs:
+            row_db = by_pair.get((y, x)) or {}
+            sens = row_db.get("elasticity_value")
+            sens = float(sens) if sens is not None else None
+            src = "db" if sens is not None else "llm"
+            note = "命中数据库" if sens is not None else "LLM生成（基于表/附件推断）"
+            if sens is None:
+                inf = inferred.get((y, x)) or {}
+                sens = inf.get("beta")
+                if inf.get("rationale"):
+                    note += f"｜{inf['rationale'][:60]}"
+
+            # 默认值
+            lag_q = 1
+            unit = "percent"
+            try:
+                if row_db.get("lag_quarters") is not None:
+                    lag_q = int(row_db["lag_quarters"])
+                if row_db.get("shock_unit"):
+                    unit = str(row_db["shock_unit"])
+            except Exception:
+                pass
+
+            seas = seasonality[y]
+            s_q1, s_q2, s_q3, s_q4 = seas["q"]
+            candidates.append({
+                "company_name": company,
+                "canonical_metric": y,
+                "factor_name": x,
+                "elasticity_value": sens,
+                "lag_quarters": lag_q,
+                "shock_unit": unit,
+                "source_method": src,
+                "note": note,
+                "seasonal_adjust": seas["seasonal_adjust"],
+                "seasonality_source": seas["source"],
+                "seasonality_note": seas["note"],
+                "seasonality_q1": s_q1, "seasonality_q2": s_q2, "seasonality_q3": s_q3, "seasonality_q4": s_q4
+                })
 
 
 
@@ -1120,7 +1307,55 @@ def api_lookup_sensitivity(company: str, metric: str, factor: str, run_id: Optio
 # =============== Run：取数 → ARIMA → MonteCarlo → 表格/报告 ===============
 @app.post("/simulation_v2/run")
 def run_sim(req: RunRequest):
+    # 本次 run 的序列读取全部走同一个 SeriesStore（_run_sim 内预取）
+    token = _RUN_SERIES.set(SeriesStore())
+    try:
+        return _run_sim(req)
+    finally:
+        _RUN_SERIES.reset(token)
+
+def _mc_quantiles(mc_cfg: Dict[str, Any]) -> List[float]:
+    """monte_carlo.quantiles 校验：须为 (0, 1) 内的数；始终包含 p10/p50/p90（表格使用）"""
+    raw = mc_cfg.get("quantiles") or []
+    if not isinstance(raw, (list, tuple)):
+        raise HTTPException(400, "monte_carlo.quantiles 须为数组，例如 [0.05, 0.95]")
+    qs = set()
+    for q in raw:
+        try:
+            v = float(q)
+        except (TypeError, ValueError):
+            raise HTTPException(400, f"monte_carlo.quantiles 含非数值：{q!r}")
+        if not (0.0 < v < 1.0):
+            raise HTTPException(400, f"monte_carlo.quantiles 须在 (0, 1) 之间：{q!r}")
+        qs.add(v)
+    return sorted(qs | {0.1, 0.5, 0.9})
+
+def _mc_int(mc_cfg: Dict[str, Any], key: str, default: Optional[int], lo: int, hi: Optional[int] = None) -> Optional[int]:
+    """monte_carlo 的整数参数校验（samples / seed）：须为 [lo, hi] 内的整数，否则 400；缺省返回 default"""
+    raw = mc_cfg.get(key)
+    if raw is None:
+        return default
+    try:
+        if isinstance(raw, bool):
+            raise ValueError
+        v = float(raw)
+        if not v.is_integer():
+            raise ValueError
+        v = int(v)
+    except (TypeError, ValueError, OverflowError):
+        raise HTTPException(400, f"monte_carlo.{key} 须为整数：{raw!r}")
+    if v < lo or (hi is not None and v > hi):
+        rng = f"在 [{lo}, {hi}] 之间" if hi is not None else f">= {lo}"
+        raise HTTPException(400, f"monte_carlo.{key} 须{rng}：{raw!r}")
+    return v
+
+def _run_sim(req: RunRequest):
     run_id = req.run_id
+    # 请求参数先校验，避免取数/建模后才在 numpy 里报 500
+    mc_cfg = req.models.monte_carlo or {}
+    mc_quantiles = _mc_quantiles(mc_cfg)
+    samples = _mc_int(mc_cfg, "samples", 1000, 1, MC_MAX_SAMPLES)
+    mc_seed = _mc_int(mc_cfg, "seed", None, 0)
     skip_report = bool(req.skip_report)
 
     # 1) 公司
@@ -1128,6 +1363,9 @@ def run_sim(req: RunRequest):
 
     # 2) 取 Y 的历史序列；若设置了季调则先去季调
     ys = sorted(list({row.canonical_metric for row in req.sensitivity_rows}))
+    store = _RUN_SERIES.get()
+    if store is not None:
+        store.preload([company], ys)   # 一次 in_() 取齐所有 Y 的历史
     need_seasonal: Dict[str, bool] = {}
     season_coeffs: Dict[str, Dict[str, Optional[float]] ] = {}
     for y in ys:
@@ -1167,10 +1405,10 @@ def run_sim(req: RunRequest):
     # 3) ARIMA 基线
     arima_cfg = req.models.arima
     periods = int(arima_cfg.get("periods", req.horizon_quarters))
-    baseline_map: Dict[str, Dict[str, Any]] = {}
-    for y, seq in series_map.items():
-        r = arima_baseline(seq, int(arima_cfg.get("p", 1)), int(arima_cfg.get("d", 1)), int(arima_cfg.get("q", 1)), periods)
-        baseline_map[y] = r  # {"pred": [...], "lower95":[...], "upper95":[...]}
+    arima_order = (int(arima_cfg.get("p", 1)), int(arima_cfg.get("d", 1)), int(arima_cfg.get("q", 1)))
+    # 多个 Y 一次性提交：命中缓存的直接复用，其余在进程池中并行拟合
+    baseline_map: Dict[str, Dict[str, Any]] = forecast_many(series_map, arima_order, periods)
+    # {y: {"pred": [...], "lower95":[...], "upper95":[...], "cached": bool}}
 
     # 4) 构造情景冲击字典（factor -> {pessimistic, base, optimistic}）
     # 若前端未传，按默认：悲观-5%，平缓0%，乐观+5%
@@ -1202,7 +1440,10 @@ def run_sim(req: RunRequest):
         return (np.array(base_pred, dtype=float) * mult).tolist()
 
     # 6) Monte Carlo 分位路径（与“情景”分开，命名为 MC(p10/50/90)）
-    samples = int(req.models.monte_carlo.get("samples", 1000))
+    #    一次向量化抽样覆盖三个情景；seed 可复现；quantiles 可配置（表格仍输出 p10/p50/p90）
+    mc_labels = ["pessimistic", "base", "optimistic"]
+    mc_map: Dict[str, Dict[str, List[float]]] = {}
+    mc_all: Dict[str, Dict[str, Dict[str, List[float]]]] = {}
 
     # 7) 汇总为宽表（行名 → 实际(近4期) + 预测(未来 periods 期)）
     # 先确定时间坐标：以第一个指标为锚
@@ -1265,10 +1506,13 @@ def run_sim(req: RunRequest):
         wide_table[f"情景-平缓｜{y}"] = [float(x) for x in actual_part] + [float(x) for x in _rz(path_under_scenario(base_pred, "base"))]
         wide_table[f"情景-乐观｜{y}"] = [float(x) for x in actual_part] + [float(x) for x in _rz(path_under_scenario(base_pred, "optimistic"))]
 
-        pcts = monte_carlo_paths(base_pred, req.sensitivity_rows, samples, periods, deltas=deltas, label="base")
+        mc_all[y] = monte_carlo_scenarios(
+            base_pred, req.sensitivity_rows, samples, periods,
+            deltas=deltas, labels=mc_labels, quantiles=mc_quantiles,
+            seed=mc_seed,
+        )
+        pcts = mc_all[y]["base"]
         # 记录 MC 未加季节性的路径，供 XLSX 侧使用
-        if 'mc_map' not in locals():
-            mc_map = {}
         mc_map[y] = pcts
 
         wide_table[f"MC(p10)｜{y}"] = [float(x) for x in actual_part] + [float(x) for x in _rz(pcts["p10"])]
@@ -1604,6 +1848,9 @@ def run_sim(req: RunRequest):
         "report_url": url_md,
         "table_preview": header[:8],
         "sample_rows": list(wide_table.items())[:3],
+        # 各情景 MC 统计（去季调口径）：{metric: {pessimistic|base|optimistic: {pXX, mean, std}}}
+        "monte_carlo": {"samples": samples, "seed": mc_seed, "quantiles": mc_quantiles, "by_metric": mc_all},
+        "arima": {"order": list(arima_order), "cached": {y: bool(r.get("cached")) for y, r in baseline_map.items()}},
         "thinking": thinking
     }
 
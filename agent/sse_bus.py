@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+SSE 事件总线（push 模式，替代 Queue 定时轮询）
+- 生产者可在任意线程调用 publish()/close()：通过 loop.call_soon_threadsafe 交给事件循环，无锁竞争
+- 消费者 `async for event, data in bus` 直接 await，无事件时不唤醒（无 0.1s 轮询延迟，空闲不耗 CPU）
+- 背压：低优先级事件（如“思考”文案）进入有界缓冲；同 key 且尚未发出的旧事件被新事件覆盖（合并），
+  缓冲满时丢弃最旧的低优先级事件；普通事件（start/done/error）永不丢弃
+- stats()：首字节时间（TTFB）、每条事件从 publish 到发出的延迟、合并/丢弃计数，便于压测与监控
+
+用法：
+    bus = EventBus(asyncio.get_running_loop())
+    # 工作线程：bus.publish("progress", ev); ...; bus.close()
+    async for event, data in bus:
+        yield sse_format(event, data)
+"""
+from __future__ import annotations
+import asyncio, json, time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Hashable, List, Optional, Tuple
+
+SSE_LOW_BUFFER = 64
+
+
+def sse_format(event: str, data: Any) -> str:
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata:{payload}\n\n"
+
+
+class _Item:
+    __slots__ = ("event", "data", "low", "key", "t")
+
+    def __init__(self, event: str, data: Any, low: bool, key: Optional[Hashable], t: float) -> None:
+        self.event, self.data, self.low, self.key, self.t = event, data, low, key, t
+
+
+class EventBus:
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None, *, max_low: int = SSE_LOW_BUFFER) -> None:
+        self._loop = loop or asyncio.get_running_loop()
+        self._buf: Deque[_Item] = deque()
+        self._low_by_key: Dict[Hashable, _Item] = {}
+        self._low_count = 0
+        self._max_low = max(1, int(max_low))
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._t0 = time.perf_counter()
+        self._first_ms: Optional[float] = None
+        self._last_emit = self._t0
+        self._lat: List[float] = []
+        self._stats = {"published": 0, "emitted": 0, "coalesced": 0, "dropped": 0}
+
+    # ---- 生产端（线程安全） ----
+    def publish(self, event: str, data: Any, *, low: bool = False, key: Optional[Hashable] = None) -> None:
+        item = _Item(event, data, low, key, time.perf_counter())
+        self._loop.call_soon_threadsafe(self._put, item)
+
+    def close(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._close)
+        except RuntimeError:     # 事件循环已关闭（客户端早已断开）
+            pass
+
+    # ---- 以下只在事件循环线程执行 ----
+    def _put(self, item: _Item) -> None:
+        if self._closed:
+            return
+        self._stats["published"] += 1
+        if item.low:
+            old = self._low_by_key.get(item.key) if item.key is not None else None
+            if old is not None:
+                # 同 key 尚未发出：原位替换为最新内容（保持原有先后位置）
+                old.data, old.t = item.data, item.t
+                self._stats["coalesced"] += 1
+                return
+            if self._low_count >= self._max_low:
+                self._drop_oldest_low()
+            self._low_count += 1
+            if item.key is not None:
+                self._low_by_key[item.key] = item
+        self._buf.append(item)
+        self._ready.set()
+
+    def _drop_oldest_low(self) -> None:
+        for it in self._buf:
+            if it.low:
+                self._buf.remove(it)
+                self._forget(it)
+                self._stats["dropped"] += 1
+                return
+
+    def _forget(self, it: _Item) -> None:
+        if it.low:
+            self._low_count -= 1
+            if it.key is not None and self._low_by_key.get(it.key) is it:
+                del self._low_by_key[it.key]
+
+    def _close(self) -> None:
+        self._closed = True
+        self._ready.set()
+
+    def __aiter__(self) -> AsyncIterator[Tuple[str, Any]]:
+        return self._iter()
+
+    async def _iter(self) -> AsyncIterator[Tuple[str, Any]]:
+        while True:
+            while self._buf:
+                it = self._buf.popleft()
+                self._forget(it)
+                now = time.perf_counter()
+                if self._first_ms is None:
+                    self._first_ms = (now - self._t0) * 1000
+                self._lat.append((now - it.t) * 1000)
+                self._last_emit = now
+                self._stats["emitted"] += 1
+                yield it.event, it.data
+            if self._closed:
+                return
+            self._ready.clear()
+            if not self._buf and not self._closed:
+                await self._ready.wait()
+
+    # ---- 观测 ----
+    def idle_s(self) -> float:
+        """距最近一次发出事件的秒数"""
+        return time.perf_counter() - self._last_emit
+
+    def stats(self) -> Dict[str, Any]:
+        lat = sorted(self._lat)
+        pick = lambda q: round(lat[min(len(lat) - 1, int(q * len(lat)))], 3) if lat else None
+        return {
+            **self._stats,
+            "ttfb_ms": round(self._first_ms, 3) if self._first_ms is not None else None,
+            "latency_p50_ms": pick(0.5),
+            "latency_p95_ms": pick(0.95),
+            "latency_max_ms": round(lat[-1], 3) if lat else None,
+        }
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+轻量任务 DAG 调度（asyncio）
+- 节点 = 协程函数 fn(emit, deps_results) -> result；deps 只表达先后依赖，依赖失败时对应结果为 None
+- 所有依赖完成后才占用并发名额（Semaphore），互不依赖的节点并发执行
+- 节点通过 emit(item) 推送事件（如 SSE 文本）；stream() 按产生顺序逐条产出，实现交错输出
+- 结果按节点 name 存于 results / errors，调用方按“声明顺序”合并，保证最终输出稳定
+
+用法：
+    dag = TaskDAG(max_concurrency=4)
+    dag.add("a", fa)
+    dag.add("b", fb, deps=["a"])
+    async for ev in dag.stream():
+        yield ev
+    dag.results["b"]
+"""
+from __future__ import annotations
+import asyncio, threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+Emit = Callable[[Any], None]
+NodeFn = Callable[[Emit, Dict[str, Any]], Awaitable[Any]]
+
+_DONE = object()
+
+
+class _Node(NamedTuple):
+    name: str
+    fn: NodeFn
+    deps: tuple
+
+
+class TaskDAG:
+    def __init__(self, max_concurrency: int = 4) -> None:
+        self.max_concurrency = max(1, int(max_concurrency))
+        self._nodes: Dict[str, _Node] = {}
+        self.results: Dict[str, Any] = {}
+        self.errors: Dict[str, BaseException] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._queue: Optional[asyncio.Queue] = None
+
+    def add(self, name: str, fn: NodeFn, deps: Sequence[str] = ()) -> str:
+        if name in self._nodes:
+            raise ValueError(f"duplicate node: {name}")
+        for d in deps:
+            if d not in self._nodes:
+                raise ValueError(f"node {name} depends on unknown node {d}")   # 只能依赖已声明节点 → 天然无环
+        self._nodes[name] = _Node(name, fn, tuple(deps))
+        return name
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._nodes)
+
+    # ---- 事件 ----
+    def emit(self, item: Any) -> None:
+        """线程安全：事件循环线程内直接入队；工作线程内转交事件循环"""
+        if self._queue is None:
+            return
+        if threading.get_ident() == self._loop_thread:
+            self._queue.put_nowait(item)
+        else:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def emit_from_thread(self, make: Callable[[], Any]) -> None:
+        """工作线程里产生事件：make() 在事件循环线程执行（避免 seq 等计数器在多线程下竞争）"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(lambda: self._queue.put_nowait(make()))
+
+    # ---- 执行 ----
+    async def stream(self) -> AsyncIterator[Any]:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._queue = asyncio.Queue()
+        sem = asyncio.Semaphore(self.max_concurrency)
+        finished = {name: asyncio.Event() for name in self._nodes}
+
+        async def _run(node: _Node) -> None:
+            try:
+                for d in node.deps:
+                    await finished[d].wait()
+                async with sem:
+                    dep_res = {d: self.results.get(d) for d in node.deps}
+                    self.results[node.name] = await node.fn(self.emit, dep_res)
+            except asyncio.CancelledError:
+                self.errors[node.name] = asyncio.CancelledError()
+                raise
+            except Exception as e:
+                self.errors[node.name] = e
+            finally:
+                finished[node.name].set()
+
+        tasks = [asyncio.create_task(_run(n)) for n in self._nodes.values()]
+
+        async def _watch() -> None:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._queue.put_nowait(_DONE)
+
+        watcher = asyncio.create_task(_watch())
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # 客户端断开等提前退出：取消仍在执行的节点
+            for t in tasks:
+                if not t.done():
+                    t.cancel()
+            if not watcher.done():
+                watcher.cancel()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Token 精确计数与上下文预算
+- count_tokens：tiktoken 精确计数，按 (编码, 文本) 做 LRU 记忆化；tiktoken 不可用（未安装/编码文件无法下载）时
+  退回 CJK 感知估算（汉字≈1 token/字，其它≈4 字符/token），不再用 chars/3.6 一刀切
+- count_messages：按 chat 格式计入每条消息的固定开销
+- pack_by_priority：把可裁剪的数据拆成带优先级与成本的单元，在预算内按优先级贪心装入
+
+环境变量：
+  TOKEN_CACHE_MAX=20000   # 记忆化条目数
+"""
+from __future__ import annotations
+import os, re, json
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+try:
+    import tiktoken
+except ImportError:   # 兜底估算
+    tiktoken = None
+
+TOKEN_CACHE_MAX = int(os.getenv("TOKEN_CACHE_MAX") or 20000)
+
+# 每条 chat 消息的格式开销（role/分隔符），以及回复起始的 priming
+MSG_OVERHEAD = 4
+REPLY_PRIMING = 3
+
+_CJK_RE = re.compile(r"[⺀-鿿가-힯豈-﫿＀-￯]")
+
+
+@lru_cache(maxsize=32)
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception:
+        return None
+    m = (model or "").lower()
+    name = "o200k_base" if any(k in m for k in ("4o", "o1", "o3", "o4", "gpt-5")) else "cl100k_base"
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception:
+        return None
+
+
+def _heuristic(text: str) -> int:
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@lru_cache(maxsize=TOKEN_CACHE_MAX)
+def _count_cached(model: str, text: str) -> int:
+    enc = _encoding(model)
+    if enc is None:
+        return _heuristic(text)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def count_tokens(text: Any, model: str = "gpt-4o") -> int:
+    if text is None:
+        return 0
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False)
+    return _count_cached(model or "", text) if text else 0
+
+
+def count_messages(messages: Sequence[Dict[str, Any]], model: str = "gpt-4o") -> int:
+    total = REPLY_PRIMING
+    for m in messages or []:
+        total += MSG_OVERHEAD + count_tokens(m.get("content") or "", model)
+    return total
+
+
+def is_exact() -> bool:
+    """当前是否为 tiktoken 精确计数"""
+    return _encoding("gpt-4o") is not None
+
+
+class Unit(NamedTuple):
+    """可裁剪的数据单元：group 用于回组装；score 越大越优先保留；cost 为该单元的 token 数"""
+    group: str
+    item: Any
+    score: float
+    cost: int
+
+
+def pack_by_priority(units: Iterable[Unit], budget: int) -> Tuple[List[Unit], int]:
+    """按 score 降序贪心装入（装不下的跳过，继续尝试更小的单元）；返回 (保留单元, 使用的 tokens)"""
+    kept: List[Unit] = []
+    used = 0
+    for u in sorted(units, key=lambda u: (-u.score, u.cost)):
+        if used + u.cost <= budget:
+            kept.append(u)
+            used += u.cost
+    return kept, used
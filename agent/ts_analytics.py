@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+financial_metrics 时序分析（report / freereports 共用）
+- prepare_metrics_frame：季度规范化 + pkey(year*10+q) + 区间过滤，全部向量化（不再逐行 df.apply）
+- summarize_timeseries：一次性把长表铺成 (指标 × 连续季度) 矩阵，按“期”对齐计算
+    qoq  = 本期 / 上一季度 - 1（上一季度缺失则为 None，不再误取更早的点）
+    yoy  = 本期 / 去年同季 - 1（按 year-1 同季度对齐，而非 series[-5]）
+    cagr = 首期 → 末期的年复合增长率（跨度不足一年或首末值非正时为 None）
+  同一 (指标, 季度) 多行时取最后一行；取值全为空的指标仍保留（series 为空、统计项为 None）
+
+输出与原 summarize_timeseries 同结构：{name: {"series": [{period, year, quarter, value}], "latest", "qoq", "yoy", "cagr"}}
+"""
+from __future__ import annotations
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+_Q_LABELS = np.array(["Q1", "Q2", "Q3", "Q4"], dtype=object)
+
+
+def quarter_num(q: Any) -> int:
+    """单值口径（与各 agent 原 _norm_quarter 一致）：'Q3'/'3'/3.0 → 3；非法值 → 1"""
+    s = str(q).strip().upper()
+    try:
+        n = int(s[1:]) if s.startswith("Q") else int(float(s))
+    except Exception:
+        return 1
+    return n if 1 <= n <= 4 else 1
+
+
+def period_key(year: int, quarter: Any) -> int:
+    return int(year) * 10 + quarter_num(quarter)
+
+
+def _quarter_nums(col: pd.Series) -> np.ndarray:
+    """向量化 quarter_num：取去掉前缀 Q 后的数字部分，非法或越界记为 1"""
+    s = col.astype(str).str.strip().str.upper().str.lstrip("Q")
+    n = pd.to_numeric(s, errors="coerce").to_numpy(dtype=np.float64)
+    n = np.where(np.isfinite(n), np.trunc(n), 1.0).astype(np.int64)
+    n[(n < 1) | (n > 4)] = 1
+    return n
+
+
+def prepare_metrics_frame(df: pd.DataFrame, start: Optional[Tuple[int, Any]] = None,
+                          end: Optional[Tuple[int, Any]] = None) -> pd.DataFrame:
+    """
+    输入 financial_metrics 原始行（company_name, year, quarter, metric_name, metric_value）
+    输出：quarter 统一为 'Qn'，新增 pkey，按 [start, end] 过滤，按 (metric_name, pkey) 排序
+    """
+    if df is None or df.empty:
+        return pd.DataFrame() if df is None else df
+    df = df.copy()
+    df["year"] = pd.to_numeric(df["year"], errors="coerce").fillna(0).astype(np.int64)
+    qn = _quarter_nums(df["quarter"])
+    df["quarter"] = _Q_LABELS[qn - 1]
+    df["pkey"] = df["year"].to_numpy() * 10 + qn
+    if start is not None and end is not None:
+        p_start, p_end = period_key(*start), period_key(*end)
+        df = df[(df["pkey"] >= p_start) & (df["pkey"] <= p_end)]
+    return df.sort_values(["metric_name", "pkey"], kind="stable").reset_index(drop=True)
+
+
+def _num(x: float) -> Optional[float]:
+    return None if not np.isfinite(x) else float(x)
+
+
+def summarize_timeseries(df: pd.DataFrame) -> Dict[str, Any]:
+    """
+    输入：company_name, year, quarter, metric_name, metric_value, pkey（prepare_metrics_frame 的输出）
+    输出：按 metric_name 的时序与基础统计（期对齐的 qoq / yoy / cagr）
+    """
+    out: Dict[str, Any] = {}
+    if df is None or df.empty:
+        return out
+
+    pkey = df["pkey"].to_numpy(dtype=np.int64)
+    qidx = (pkey // 10) * 4 + (pkey % 10 - 1)          # 连续季度序号：相邻季度差 1，同季度隔年差 4
+    vals = pd.to_numeric(df["metric_value"], errors="coerce").to_numpy(dtype=np.float64)
+    codes, names = pd.factorize(df["metric_name"], sort=True)
+
+    q0 = int(qidx.min())
+    width = int(qidx.max()) - q0 + 1
+    order = np.argsort(qidx, kind="stable")               # 同一格多行时，后写入者（原顺序靠后）生效
+    M = np.full((len(names), width), np.nan)
+    M[codes[order], qidx[order] - q0] = vals[order]
+
+    has = ~np.isnan(M)
+    first = has.argmax(axis=1)
+    last = width - 1 - has[:, ::-1].argmax(axis=1)
+    rows = np.arange(len(names))
+
+    def _at(offset: int) -> np.ndarray:
+        pos = last - offset
+        v = np.full(len(names), np.nan)
+        ok = pos >= 0
+        v[ok] = M[rows[ok], pos[ok]]
+        return v
+
+    latest = M[rows, last]
+    prev, base = _at(1), _at(4)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        qoq = np.where(prev != 0, latest / prev - 1, np.nan)
+        yoy = np.where(base != 0, latest / base - 1, np.nan)
+        years = (last - first) / 4.0
+        v0 = M[rows, first]
+        cagr = np.where((years >= 1) & (v0 > 0) & (latest > 0), (latest / v0) ** (1 / np.maximum(years, 1)) - 1, np.nan)
+
+    labels_y = [(q0 + j) // 4 for j in range(width)]
+    labels_q = [f"Q{(q0 + j) % 4 + 1}" for j in range(width)]
+    for r, name in enumerate(names):
+        cols = np.flatnonzero(has[r]).tolist()
+        row = M[r].tolist()
+        series = [
+            {"period": f"{labels_y[j]}{labels_q[j]}", "year": labels_y[j], "quarter": labels_q[j], "value": row[j]}
+            for j in cols
+        ]
+        out[name] = {
+            "series": series,
+            "latest": _num(latest[r]),
+            "qoq": _num(qoq[r]),
+            "yoy": _num(yoy[r]),
+            "cagr": _num(cagr[r]),
+        }
+    return out
@@ -287,6 +287,8 @@ const [beautifyResult, setBeautifyResult] = useState<{
   const fileInputRef = useRef<HTMLInputElement>(null);
   const editorRef = useRef<HTMLTextAreaElement>(null);
   const naturalInputRef = useRef<HTMLTextAreaElement>(null);
+  // 美化导出任务轮询：新一次美化或组件卸载时取消
+  const exportPollRef = useRef<{ cancelled: boolean } | null>(null);
 
   const reportTypes = getReportTypes();
 
@@ -341,6 +343,7 @@ const [beautifyResult, setBeautifyResult] = useState<{
   ];
 
   useEffect(() => { loadTemplates(); }, []);
+  useEffect(() => () => { if (exportPollRef.current) exportPollRef.current.cancelled = true; }, []);
   useEffect(() => {
     const fetchCompanies = async () => {
       try {
@@ -565,6 +568,21 @@ const [beautifyResult, setBeautifyResult] = useState<{
           continue;
         }
 
+        if (event === 'export') {
+          // 导出任务完成：补上 PDF/DOCX 链接
+          try {
+            const x = JSON.parse(dataStr);
+            setGeneratedReport((prev: any) => prev ? {
+              ...prev,
+              downloadUrl: x.pdf_url || prev.downloadUrl,
+              fileName: x.file_name || prev.fileName,
+              pdfUrl: x.pdf_url,
+              docxUrl: x.docx_url,
+            } : prev);
+          } catch {/* ignore */}
+          continue;
+        }
+
         if (event === 'error') {
           let msg = dataStr;
           try {
@@ -716,8 +734,41 @@ const [beautifyResult, setBeautifyResult] = useState<{
     finally { setIsExporting(false); }
   };
 
+  async function pollBeautifyExport(jobId: string) {
+    if (exportPollRef.current) exportPollRef.current.cancelled = true;
+    const poll = { cancelled: false };
+    exportPollRef.current = poll;
+    const jobUrl = (BEAUTIFY_BASE ? `${BEAUTIFY_BASE}` : '') + `/beautify/jobs/${jobId}`;
+    try {
+      for (let i = 0; i < 120; i++) {
+        await new Promise(r => setTimeout(r, 1500));
+        if (poll.cancelled) return;
+        const jr = await fetch(jobUrl, { headers: { 'Authorization': `Bearer ${AGENT_TOKEN}` } });
+        if (!jr.ok || poll.cancelled) return;
+        const job = await jr.json();
+        if (poll.cancelled) return;
+        setBeautifyResult((prev: any) => ({
+          ...(prev || {}),
+          html_url: job.html_url ?? prev?.html_url,
+          docx_url: job.docx_url ?? prev?.docx_url,
+          pdf_url: job.pdf_url ?? prev?.pdf_url,
+          pptx_url: job.pptx_url ?? prev?.pptx_url,
+        }));
+        if (job.status !== 'running') {
+          if (job.status === 'failed') toast.error('导出文件生成失败');
+          return;
+        }
+      }
+    } catch (e) {
+      console.error(e);
+    } finally {
+      if (exportPollRef.current === poll) exportPollRef.current = null;
+    }
+  }
+
   async function runBeautify() {
     if (!reportContent?.trim()) { toast.error('请先生成或编辑报告'); return; }
+    if (exportPollRef.current) exportPollRef.current.cancelled = true;
     setIsBeautifying(true); setBeautifyResult(null);
     try {
       const paletteArr = (beautifyOptions.palette || '').split(',').map(s=>s.trim()).filter(Boolean);
@@ -755,6 +806,9 @@ const [beautifyResult, setBeautifyResult] = useState<{
         pptx_download_url: data.pptx_download_url       // ✅ 新增（后端若没返回会自动走兜底）
       });
 
+      // 导出在后台进行：HTML 已可用，立即结束等待；下载链接由后台轮询补齐
+      if (data.export_job_id) void pollBeautifyExport(data.export_job_id);
+
       toast.success('美化完成');
     } catch (e:any) {
       console.error(e);
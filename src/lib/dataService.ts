@@ -993,6 +993,7 @@ export async function beautifyMarkdown(markdown: string, extra?: {
       font_family: 'Inter, "Microsoft YaHei", system-ui, -apple-system, Segoe UI, sans-serif',
       theme: 'light', base_font_size: 16, line_height: 1.75, content_width_px: 920,
     },
+    wait_exports: true,   // 该接口直接返回各格式链接
   };
 
   const resp = await fetch(`${BEAUTIFY_URL}/beautify/run`, {